@@ -0,0 +1,78 @@
+/*
+Draws the binary frames of frames.py on a canvas: the static map is drawn once on an off-screen canvas,
+every step frame copies it and draws the traffic lights and the cars on top.
+*/
+var FrameCanvasModule = function(canvas_width, canvas_height) {
+	var canvas = $(`<canvas width="${canvas_width}" height="${canvas_height}" class="world-grid"/>`)[0];
+	var parent = $('<div style="height:' + canvas_height + 'px;" class="world-grid-parent"></div>')[0];
+	$("#elements").append(parent);
+	parent.append(canvas);
+	var context = canvas.getContext("2d");
+	var lightColors = ["green", "yellow", "red"];
+	var map = null;
+
+	var decode = function(base64) {
+		var bytes = Uint8Array.from(atob(base64), c => c.charCodeAt(0));
+		return new DataView(bytes.buffer);
+	};
+
+	var readStatic = function(view) {
+		var width = view.getUint16(4, true), height = view.getUint16(6, true), nLights = view.getUint32(8, true);
+		var cell = Math.min(canvas_width / width, canvas_height / height);
+		var background = document.createElement("canvas");
+		background.width = canvas_width;
+		background.height = canvas_height;
+		var backgroundContext = background.getContext("2d");
+		backgroundContext.fillStyle = "darkgrey";
+		backgroundContext.fillRect(0, 0, width * cell, height * cell);
+		backgroundContext.fillStyle = "white";
+		// road cells in cell index order, x-major like the road mask
+		var cellX = [], cellY = [];
+		var maskOffset = 12 + 4 * nLights;
+		for (var i = 0; i < width * height; i++) {
+			if ((view.getUint8(maskOffset + (i >> 3)) >> (7 - (i & 7))) & 1) {
+				var x = Math.floor(i / height), y = i % height;
+				cellX.push(x);
+				cellY.push(y);
+				backgroundContext.fillRect(x * cell, (height - 1 - y) * cell, cell, cell);
+			}
+		}
+		var lights = [];
+		for (var light = 0; light < nLights; light++)
+			lights.push(view.getUint32(12 + 4 * light, true));
+		return {height: height, cell: cell, cellX: cellX, cellY: cellY, lights: lights,
+				lightStates: new Array(nLights).fill(-1), background: background};
+	};
+
+	var drawCell = function(roadCell, size, color) {
+		var offset = (1 - size) * map.cell / 2;
+		context.fillStyle = color;
+		context.fillRect(map.cellX[roadCell] * map.cell + offset, (map.height - 1 - map.cellY[roadCell]) * map.cell + offset,
+						 size * map.cell, size * map.cell);
+	};
+
+	this.render = function(data) {
+		if (data.static !== null)
+			map = readStatic(decode(data.static));
+		if (map === null)
+			return;
+		var view = decode(data.frame);
+		var nCars = view.getUint32(8, true), nLights = view.getUint32(12, true);
+		for (var i = 0; i < nLights; i++) {
+			var light = view.getUint32(24 + 4 * (nCars + i), true);
+			map.lightStates[light & 0x3fffffff] = light >>> 30;
+		}
+		context.clearRect(0, 0, canvas_width, canvas_height);
+		context.drawImage(map.background, 0, 0);
+		for (var light = 0; light < map.lights.length; light++)
+			drawCell(map.lights[light], 0.5, lightColors[map.lightStates[light]]);
+		for (var car = 0; car < nCars; car++) {
+			var value = view.getUint32(24 + 4 * car, true);
+			drawCell(value & 0x7fffffff, 0.7, value >>> 31 ? "darkorange" : "black");
+		}
+	};
+
+	this.reset = function() {
+		context.clearRect(0, 0, canvas_width, canvas_height);
+	};
+};
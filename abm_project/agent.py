@@ -32,6 +32,7 @@ class CarAgent(Agent):
     def __init__(self, model, unique_id, path, max_velocity, tolerance):
         super().__init__(unique_id, model)
         self.path = path
+        self.path_cells = model.road_grid.cells_of(path)
         self.pos_i = 0
         self.pos = path[self.pos_i]
         self.max_velocity = max_velocity
@@ -55,9 +56,13 @@ class CarAgent(Agent):
             self.velocity = 0
 
     def destroy(self):
-        self.model.grid.remove_agent(self)
+        self.model.road_grid.remove_agent(self)
         self.model.schedule.remove(self)
         self.model.num_car_agents -= 1
+        self.model.congestion_sum -= self.congestion
+        self.model.haste_sum -= self.haste
+        if self.model.trajectories is not None:
+            self.model.trajectories.record_exits(np.array([self.unique_id]), np.array([self.steps]))
 
     def step(self):
         '''
@@ -74,29 +79,27 @@ class CarAgent(Agent):
         '''
         self.update_congestion()
         self.update_haste()
-        next_path = self.path[self.pos_i + 1:self.pos_i + self.max_velocity + 1]
-        content: [TrafficLightAgent,
-                  CarAgent] = self.model.grid.get_cell_list_contents(next_path)
-        current = self.model.grid.get_cell_list_contents(self.pos)
+        road_grid = self.model.road_grid
+        next_path = self.path_cells[self.pos_i + 1:self.pos_i + self.max_velocity + 1]
+        current = road_grid.light_at[self.path_cells[self.pos_i]]
         traffic_light = False
 
         # check if traffic light on current cell
-        if isinstance(current[0], TrafficLightAgent):
-            if current[0].state != 0:
+        if current != -1:
+            if current != 0:
                 self.velocity = 0
                 return
             else:
                 self.accelerate(int(np.ceil(self.max_velocity - self.velocity)/2))
 
         # if object on next_path, act accordingly
-        if content:
-            next_obj = content[0]
-            distance_to_next = next_path.index(next_obj.pos)
-            if isinstance(next_obj, TrafficLightAgent):
-                if len(content) > 1:
-                    next_car = content[1]
-                    if next_car.pos == next_obj.pos:
-                        distance_to_next -= 1
+        distance_to_next = road_grid.first_obstacle(next_path)
+        if distance_to_next != -1:
+            next_cell = next_path[distance_to_next]
+            if road_grid.light_at[next_cell] != -1:
+                # a car waiting on the traffic light
+                if road_grid.car_at[next_cell] != -1:
+                    distance_to_next -= 1
                 traffic_light = True
 
             if self.velocity > 0 and distance_to_next <= self.velocity:
@@ -113,38 +116,41 @@ class CarAgent(Agent):
                     self.velocity = self.max_velocity
             else:
                 pass
-        self.move(next_path)
+        self.move()
 
-    def move(self, next_path):
+    def move(self):
         """
         Moves agent velocity amount of steps, if end of grid reached, remove agent
         """
         if self.pos_i + self.velocity >= len(self.path):
             self.destroy()
         elif self.velocity > 0:
-            self.model.grid.move_agent(self, next_path[self.velocity-1])
             self.pos_i += self.velocity
+            self.model.road_grid.move_agent(self, self.path[self.pos_i])
         else:
             pass
 
     def update_congestion(self):
         """
-        Update congestion parameter for data collection
+        Update congestion parameter for data collection, and the running total of the model
         """
         self.velocity_sum += self.velocity
         self.max_velocity_sum += self.max_velocity
-        self.congestion = self.velocity_sum/self.max_velocity_sum
+        congestion = self.velocity_sum/self.max_velocity_sum
+        self.model.congestion_sum += congestion - self.congestion
+        self.congestion = congestion
         self.steps += 1
 
     def update_haste(self):
         """
-        Update haste parameter of agent
+        Update haste parameter of agent, and the running total of the model
         """
         haste_probability = (self.velocity_sum/self.steps)/self.max_velocity
 
         if self.steps > 10:
-            if self.congestion < self.tolerance and np.random.uniform() < haste_probability:
+            if self.congestion < self.tolerance and self.model.haste_random.random() < haste_probability:
                 # agent is hasty, increase max velocity
+                self.model.haste_sum += 1 - self.haste
                 self.haste = 1
                 self.max_velocity = self.max_velocity + int(np.ceil(self.max_velocity * 0.25))
                 if self.velocity > self.max_velocity:
@@ -152,6 +158,7 @@ class CarAgent(Agent):
             else:
                 if self.haste != 0:
                     # agent is "normal" again, decrease velocity
+                    self.model.haste_sum -= self.haste
                     self.haste = 0
                     self.max_velocity = 5
                     if self.velocity > self.max_velocity:
@@ -186,6 +193,8 @@ class BuildingAgent(Agent):
     ''' 
     Creates a building agent whose only attributes are a unique_id and its position:
         - pos: (x,y) coordinates in the model grid
+
+    Buildings are only created for the visualisation grid, the simulation uses the road map of the CityLayout.
     '''
     def __init__(self, unique_id, model, pos):
         super().__init__(unique_id, model)
@@ -208,22 +217,24 @@ class IntersectionAgent(Agent):
         self.unique_id = unique_id
         self.pos = pos
         self.counter = 0
-        traffic_light_positions = [(pos[0] - 1, pos[1]),
-                                   (pos[0] + 1, pos[1] - 1),
-                                   (pos[0] + 2, pos[1] + 1),
-                                   (pos[0], pos[1] + 2)]
         self.traffic_lights = []
-        for i in range(2):
-            tlight1 = TrafficLightAgent(self.model.get_new_unique_id(
-            ), self.model, traffic_light_positions[2*i], state=2)
-            tlight2 = TrafficLightAgent(self.model.get_new_unique_id(
-            ), self.model, traffic_light_positions[2*i+1], state=0)
-            self.traffic_lights.append(tlight1)
-            self.traffic_lights.append(tlight2)
+        for traffic_light_pos, state in self.traffic_light_positions(pos):
+            self.traffic_lights.append(TrafficLightAgent(self.model.get_new_unique_id(), self.model,
+                                                         traffic_light_pos, state=state))
 
         self.green_duration = green_light_duration
         self.yellow_duration = 2
 
+    @staticmethod
+    def traffic_light_positions(pos):
+        """
+        Returns the position and initial state of the four traffic lights of the intersection at pos.
+        """
+        return [((pos[0] - 1, pos[1]), 2),
+                ((pos[0] + 1, pos[1] - 1), 0),
+                ((pos[0] + 2, pos[1] + 1), 2),
+                ((pos[0], pos[1] + 2), 0)]
+
     def step(self):
         if self.yellow_duration > 0:
             if self.counter == self.green_duration:
@@ -267,4 +278,5 @@ class TrafficLightAgent(Agent):
             if self.state == 2:
                 self.state = 0
             else:
-                self.state = 2
\ No newline at end of file
+                self.state = 2
+        self.model.road_grid.set_light(self.pos, self.state)
@@ -0,0 +1,202 @@
+import inspect
+
+import numpy as np
+
+from engine import VectorizedEngine
+from layout import CityLayout
+from model import CityModel, n_roads_horizontal, n_roads_vertical, road_width, building_width, building_height
+from occupancy import RoadGrid
+from signals import SignalPlan
+from spawner import Spawner
+from streams import BatchRandomStream, model_streams
+
+'''
+This module describes the simulation of many independent cities in one array state:
+
+- BatchEngine
+- BatchCityModel
+
+The cities share one RoadGrid holding a copy of the road cells per city, so the cars of all cities are kept in
+one VectorizedEngine and their traffic lights in one SignalPlan, and every step costs one pass of array operations
+instead of one per city. As no path leaves its own copy, cars of different cities never interact.
+
+Usage:
+
+- model = BatchCityModel([{"max_car_agents": 100, "tolerance": 0.2}, {"max_car_agents": 200}], seeds=[1, 2])
+- data = model.run(1000), a list with the collected series of every city, as returned by CityModel.run
+'''
+
+# parameters of CityModel that can differ between the cities of a batch
+CITY_PARAMETERS = ("max_car_agents", "cars_per_second", "max_velocity", "tolerance", "green_light_duration")
+
+
+class BatchEngine(VectorizedEngine):
+    '''
+    VectorizedEngine for the cars of all cities of a BatchCityModel.
+
+    Besides the arrays of VectorizedEngine, keeps the city of every car, to update the running totals of the right
+    city and to draw the haste random numbers from the stream of that city.
+    '''
+    arrays = VectorizedEngine.arrays + ('city',)
+
+    def __init__(self, model, kernel=None):
+        super().__init__(model, kernel=kernel)
+        self.city = np.empty(0, dtype=np.int64)
+        self.new_cities = []
+
+    def add_car(self, unique_id, cells, max_velocity, tolerance, city):
+        """
+        Places a new car at the start of its path, an array of road cells in the copy of city.
+        """
+        self.road_grid.place_cars(cells[0], unique_id)
+        self.model.congestion_sum[city] += 1.0
+        self.new_cars.append((unique_id, cells, max_velocity, tolerance))
+        self.new_cities.append(city)
+
+    def append_new_cars(self):
+        if not self.new_cars:
+            return
+        self.city = np.concatenate([self.city, np.array(self.new_cities, dtype=np.int64)])
+        self.new_cities = []
+        super().append_new_cars()
+
+    def add_to_model(self, name, cars, values):
+        totals = getattr(self.model, name)
+        totals += np.bincount(self.city[cars], weights=values, minlength=len(totals)).astype(totals.dtype)
+
+    def haste_draws(self, eligible):
+        cars = np.flatnonzero(eligible)
+        order = np.argsort(self.city[cars], kind='stable')
+        draws = np.empty(len(cars))
+        draws[order] = self.model.haste_random.take(self.city[cars][order])
+        return draws
+
+
+class BatchCityModel:
+    '''
+    Simulates independent cities side by side, all advanced by a single call to step.
+
+    Arguments:
+        - parameters: list with one dictionary per city of the CityModel parameters in CITY_PARAMETERS,
+                      missing parameters take the CityModel defaults
+        - seeds: seed of every city, see CityModel; None draws them from the global numpy random state
+        - route_cache_dir, collect_every: same as in CityModel, shared by all cities
+        - compiled: move the cars with the Numba kernel, like CityModel(engine="compiled")
+        - n_roads_horizontal, n_roads_vertical, road_width, building_width, building_height: layout of the cities,
+                                                                                           see CityModel
+
+    For the same seed, a city gives the same results as CityModel(seed=seed, engine="vectorized") with its parameters.
+    The running totals (congestion_sum, haste_sum, num_car_agents) are arrays with one value per city and the
+    collected model variables are kept in model_vars, one array per step with a value per city.
+    '''
+    def __init__(self, parameters, seeds=None, route_cache_dir=None, collect_every=1, compiled=False,
+                 n_roads_horizontal=n_roads_horizontal, n_roads_vertical=n_roads_vertical, road_width=road_width,
+                 building_width=building_width, building_height=building_height):
+        defaults = {name: parameter.default for name, parameter in inspect.signature(CityModel).parameters.items()
+                    if name in CITY_PARAMETERS}
+        for city_parameters in parameters:
+            unknown = set(city_parameters) - set(CITY_PARAMETERS)
+            if unknown:
+                raise ValueError(f"Parameters {sorted(unknown)} cannot be set per city, expected {CITY_PARAMETERS}")
+        parameters = [dict(defaults, **city_parameters) for city_parameters in parameters]
+        self.n_cities = len(parameters)
+        for name in CITY_PARAMETERS:
+            setattr(self, name, np.array([city_parameters[name] for city_parameters in parameters]))
+        self.collect_every = collect_every
+
+        if seeds is None:
+            seeds = [int(np.random.randint(2 ** 63 - 1, dtype=np.int64)) for _ in range(self.n_cities)]
+        self.seeds = list(seeds)
+        streams = [model_streams(seed) for seed in self.seeds]
+        self.spawn_random = [city_streams["spawn"] for city_streams in streams]
+        self.route_random = [city_streams["routing"] for city_streams in streams]
+        # a city never draws more haste numbers in a step than it has cars
+        self.haste_random = BatchRandomStream([city_streams["haste"].generator for city_streams in streams],
+                                              max(4096, int((self.max_car_agents + self.cars_per_second).max())))
+
+        self.layout = CityLayout.get(n_roads_horizontal, n_roads_vertical, road_width, building_width,
+                                     building_height, route_cache_dir=route_cache_dir)
+        self.starting_points = self.layout.starting_points
+        self.end_points = self.layout.end_points
+        self.routes = self.layout.routes
+        self.road_grid = RoadGrid(self.layout, copies=self.n_cities)
+
+        self.unique_id = 0
+        self.steps = 0
+        self.congestion_sum = np.zeros(self.n_cities)
+        self.haste_sum = np.zeros(self.n_cities, dtype=np.int64)
+        self.num_car_agents = np.zeros(self.n_cities, dtype=np.int64)
+        self.model_vars = {"AverageCongestion": [], "HastePercent": []}
+        # trajectories.TrajectoryRecorder only records a single CityModel
+        self.trajectories = None
+
+        self.spawners = [Spawner(self.layout, self.road_grid, self.spawn_random[city], self.route_random[city],
+                                 max_waiting=self.cars_per_second[city], offset=city * self.road_grid.n_cells)
+                         for city in range(self.n_cities)]
+
+        self.create_traffic_lights()
+        kernel = None
+        if compiled:
+            # imported here as importing Numba takes longer than building a small model, see CityModel
+            from kernels import compiled_move_cars
+            kernel = compiled_move_cars
+        self.car_engine = BatchEngine(self, kernel=kernel)
+
+    def create_traffic_lights(self):
+        """
+        Creates one SignalPlan for the traffic lights of all cities, with the green duration of every city.
+        """
+        light_cells, initial_states = SignalPlan.light_cells_of(self.layout.cell_index, self.layout.intersections)
+        offsets = np.arange(self.n_cities)[:, None, None] * self.road_grid.n_cells
+        self.signal_plan = SignalPlan(self.road_grid, (light_cells + offsets).reshape(-1, light_cells.shape[1]),
+                                      np.tile(initial_states, (self.n_cities, 1)),
+                                      np.repeat(self.green_light_duration, len(light_cells)))
+
+    def create_cars(self, city, demand):
+        """
+        Same as CityModel.create_car_agents, for the given city.
+        """
+        for cells in self.spawners[city].spawn(demand, self.max_car_agents[city] - self.num_car_agents[city]):
+            self.unique_id += 1
+            self.car_engine.add_car(self.unique_id, cells, self.max_velocity[city], self.tolerance[city], city)
+            self.num_car_agents[city] += 1
+
+    def waiting(self):
+        """
+        Returns the number of cars waiting for a free entry point in every city.
+        """
+        return np.array([spawner.waiting for spawner in self.spawners], dtype=np.int64)
+
+    def collect(self):
+        cars = np.maximum(self.num_car_agents, 1)
+        empty = self.num_car_agents == 0
+        self.model_vars["AverageCongestion"].append(np.where(empty, 0.0, 100 - 100 * (self.congestion_sum / cars)))
+        self.model_vars["HastePercent"].append(np.where(empty, 0.0, 100 * self.haste_sum / cars))
+
+    def step(self):
+        ''' Advances every city by one step, in the same order as CityModel.step '''
+        self.signal_plan.step()
+        self.car_engine.step()
+        self.steps += 1
+        demand = np.where(self.num_car_agents < self.max_car_agents, self.cars_per_second, 0)
+        for city in np.flatnonzero(demand + self.waiting()):
+            self.create_cars(city, demand[city])
+        self.car_engine.append_new_cars()
+        if self.steps % self.collect_every == 0:
+            self.collect()
+
+    def get_model_vars(self):
+        """
+        Returns the collected model variables as a dictionary of (collected steps, cities) arrays.
+        """
+        return {name: np.array(values).reshape(len(values), self.n_cities) for name, values in self.model_vars.items()}
+
+    def run(self, max_steps):
+        """
+        Steps the model until max_steps steps have been made and returns a list with, for every city,
+        the collected model variables as a dictionary of arrays, like CityModel.run.
+        """
+        while self.steps < max_steps:
+            self.step()
+        model_vars = self.get_model_vars()
+        return [{name: values[:, city].copy() for name, values in model_vars.items()} for city in range(self.n_cities)]
@@ -0,0 +1,287 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from layout import CityLayout
+from model import CityModel, n_roads_horizontal, road_width
+from routes import RouteTable
+
+'''
+This script measures the performance of CityModel, timing each part of a step separately with a StepProfiler:
+
+- construction of the model
+- create_car_agents (car spawning, including the path search)
+- CarAgent.step (or the VectorizedEngine step)
+- SignalPlan.step (traffic light switching)
+- DataCollector.collect
+
+over a matrix of max_car_agents, max_velocity, engines and grid sizes. The layout command measures the construction
+time and peak memory of the city layout (road graph, route table) and of a model as the grid grows. The imports
+command times the import of the simulation modules in fresh interpreters, as paid by every worker process, and fails
+if they load a plotting, analysis or compiler module (tests/test_imports.py checks the same). The results are written
+to a JSON file so two commits can be compared.
+
+Usage:
+    python3 benchmark.py run --output before.json
+    python3 benchmark.py run --cars 100 500 --steps 500 --roads 4 10 --output after.json
+    python3 benchmark.py compare before.json after.json
+    python3 benchmark.py layout --roads 4 10 20 30 50 --output layout.json
+    python3 benchmark.py imports --max-seconds 1.5
+'''
+
+# modules the simulation core must not import, they are only loaded by plotting, analysis or the compiled engines;
+# pandas is allowed: mesa.datacollection imports it and every CityModel collects its model variables with a
+# DataCollector, so importing it lazily in profiling.py or trajectories.py would not keep it out of a worker
+HEAVY_MODULES = ("matplotlib", "seaborn", "scipy", "numba", "tqdm", "SALib", "tornado")
+
+# run in a fresh interpreter: import the given modules and report the time and the heavy modules loaded
+IMPORT_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+for name in sys.argv[1:]:
+    __import__(name)
+print(json.dumps(dict(seconds=time.perf_counter() - start, loaded=[name for name in {heavy!r}
+                                                                  if name in sys.modules])))
+'''.format(heavy=HEAVY_MODULES)
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def warm_up(engine, steps=20):
+    """
+    Builds and steps a small model with engine, so the first timed configuration of an engine does not pay for
+    importing Numba and loading the compiled kernels.
+    """
+    model = CityModel(seed=0, engine=engine, max_car_agents=20)
+    for _ in range(steps):
+        model.step()
+
+
+def benchmark(parameters, steps, seed=1, measure_memory=True):
+    """
+    Runs a model with the given parameters for steps steps and returns a dictionary with the timings.
+    """
+    start = time.perf_counter()
+    model = CityModel(seed=seed, profile=True, **parameters)
+    construction = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(steps):
+        model.step()
+    total = time.perf_counter() - start
+
+    profile = model.profiler.get_dataframe()
+    timings = dict(signal_step=float(profile["signals"].sum()), car_step=float(profile["cars"].sum()),
+                   create_car_agent=float(profile["spawn"].sum()), datacollector=float(profile["collect"].sum()),
+                   spawned=int(profile["spawned"].sum()), spawn_waiting=int(profile["spawn_waiting"].sum()),
+                   spawn_dropped=int(profile["spawn_dropped"].sum()), destroyed=int(profile["destroyed"].sum()))
+    car_updates = int(profile["car_agents"].sum())
+
+    result = dict(parameters, steps=steps, seed=seed, construction=construction, total=total,
+                  steps_per_second=steps / total,
+                  car_updates=car_updates,
+                  car_updates_per_second=car_updates / timings["car_step"] if timings["car_step"] else None,
+                  create_car_agent_per_call=timings["create_car_agent"] / max(timings["spawned"], 1),
+                  **timings)
+
+    if measure_memory:
+        # tracemalloc slows the model down, so the peak memory is measured in a separate run
+        tracemalloc.start()
+        model = CityModel(seed=seed, **parameters)
+        for _ in range(steps):
+            model.step()
+        result["peak_memory"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+def benchmark_layout(n_roads, building_size=20, measure_memory=True):
+    """
+    Builds the layout of a city with n_roads roads in each direction and returns a dictionary with the construction
+    times of the layout, of its route table alone and of a CityModel using it.
+    """
+    geometry = dict(n_roads_horizontal=n_roads, n_roads_vertical=n_roads, road_width=road_width,
+                    building_width=building_size, building_height=building_size)
+    start = time.perf_counter()
+    layout = CityLayout(**geometry)
+    construction = time.perf_counter() - start
+
+    start = time.perf_counter()
+    RouteTable(layout.road_graph, layout.end_points)
+    routes = time.perf_counter() - start
+
+    # the model takes the layout from the cache of CityLayout.get
+    CityLayout._layouts[tuple(geometry.values())] = layout
+    start = time.perf_counter()
+    CityModel(seed=1, **geometry)
+    model = time.perf_counter() - start
+    del CityLayout._layouts[tuple(geometry.values())]
+
+    result = dict(geometry, width=layout.width, height=layout.height, road_cells=len(layout.road_cells),
+                  intersections=len(layout.intersections), end_points=len(layout.end_points),
+                  construction=construction, routes=routes, model_construction=model)
+    if measure_memory:
+        del layout
+        tracemalloc.start()
+        CityLayout(**geometry)
+        result["peak_memory"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+def run(args):
+    for engine in dict.fromkeys(args.engines):
+        warm_up(engine)
+    results = []
+    for n_roads in args.roads:
+        for engine in args.engines:
+            for max_velocity in args.velocities:
+                for max_car_agents in args.cars:
+                    parameters = dict(max_car_agents=max_car_agents, max_velocity=max_velocity, engine=engine,
+                                      tolerance=args.tolerance, green_light_duration=args.green_light_duration,
+                                      n_roads_horizontal=n_roads, n_roads_vertical=n_roads)
+                    for repeat in range(args.repeats):
+                        result = benchmark(parameters, args.steps, seed=args.seed + repeat,
+                                           measure_memory=not args.no_memory)
+                        results.append(result)
+                        print(f"{engine:>10} roads={n_roads:<3} v={max_velocity:<2} cars={max_car_agents:<4} "
+                              f"{result['steps_per_second']:8.1f} steps/s "
+                              f"{result['car_updates_per_second'] or 0:10.0f} car updates/s "
+                              f"construction {1000 * result['construction']:6.1f} ms "
+                              f"peak {result.get('peak_memory', 0) / 2 ** 20:6.1f} MiB")
+    write_results(args.output, results)
+
+
+def layout(args):
+    results = []
+    for n_roads in args.roads:
+        result = benchmark_layout(n_roads, building_size=args.building_size, measure_memory=not args.no_memory)
+        results.append(result)
+        print(f"roads={n_roads:<3} {result['width']}x{result['height']} cells={result['road_cells']:<7} "
+              f"layout {result['construction']:7.2f} s (routes {result['routes']:7.2f} s) "
+              f"model {1000 * result['model_construction']:7.1f} ms "
+              f"peak {result.get('peak_memory', 0) / 2 ** 20:7.1f} MiB")
+    write_results(args.output, results)
+
+
+def benchmark_imports(modules):
+    """
+    Imports modules in a fresh interpreter and returns a dictionary with the import time and the HEAVY_MODULES
+    loaded.
+    """
+    output = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT, *modules], capture_output=True, text=True,
+                            check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    return json.loads(output)
+
+
+def imports(args):
+    results = []
+    for modules in args.modules:
+        timings = [benchmark_imports(modules.split(",")) for _ in range(args.repeats)]
+        # the fastest repeat, the others include the time of reading the files from disk
+        seconds = min(timing["seconds"] for timing in timings)
+        results.append(dict(modules=modules, seconds=seconds, loaded=timings[0]["loaded"]))
+        print(f"{modules:<20} {1000 * seconds:7.1f} ms  heavy modules: {', '.join(timings[0]['loaded']) or 'none'}")
+    if args.output is not None:
+        write_results(args.output, results)
+
+    failures = [result["modules"] for result in results if result["loaded"]]
+    if args.max_seconds is not None:
+        failures += [result["modules"] for result in results if result["seconds"] > args.max_seconds]
+    if failures:
+        sys.exit(f"Slow or heavy imports: {', '.join(sorted(set(failures)))}")
+
+
+def write_results(path, results):
+    output = dict(revision=git_revision(), python=platform.python_version(), numpy=np.__version__,
+                  machine=platform.machine(), date=time.strftime("%Y-%m-%d %H:%M:%S"), results=results)
+    with open(path, "w") as f:
+        json.dump(output, f, indent=1)
+
+
+def compare(args):
+    """
+    Prints the ratio new/old of the main metrics for every configuration present in both files.
+    """
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    def key(result):
+        # files written before the grid size was a parameter used the default grid
+        return (result.get("n_roads_horizontal", n_roads_horizontal),) + \
+            tuple(result.get(name) for name in ("engine", "max_velocity", "max_car_agents", "steps", "seed"))
+
+    old_results = {key(result): result for result in old["results"]}
+    print(f"{old['revision']} -> {new['revision']}")
+    for result in new["results"]:
+        if key(result) not in old_results:
+            continue
+        before = old_results[key(result)]
+        ratios = " ".join(f"{metric}={result[metric] / before[metric]:.2f}x"
+                          for metric in ("steps_per_second", "construction", "peak_memory")
+                          if result.get(metric) and before.get(metric))
+        print(f"{result['engine']:>10} roads={key(result)[0]:<3} v={result['max_velocity']:<2} "
+              f"cars={result['max_car_agents']:<4} {ratios}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark CityModel step throughput and scaling")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmark matrix")
+    run_parser.add_argument("--cars", type=int, nargs="+", default=[10, 50, 100, 200, 500])
+    run_parser.add_argument("--velocities", type=int, nargs="+", default=[5])
+    run_parser.add_argument("--engines", nargs="+", default=["mesa", "vectorized", "compiled"])
+    run_parser.add_argument("--roads", type=int, nargs="+", default=[4], help="roads in each direction")
+    run_parser.add_argument("--steps", type=int, default=300)
+    run_parser.add_argument("--repeats", type=int, default=1)
+    run_parser.add_argument("--seed", type=int, default=1)
+    run_parser.add_argument("--tolerance", type=float, default=0.5)
+    run_parser.add_argument("--green-light-duration", type=int, default=5)
+    run_parser.add_argument("--no-memory", action="store_true", help="skip the peak memory measurement")
+    run_parser.add_argument("--output", default="benchmark.json")
+    run_parser.set_defaults(func=run)
+
+    layout_parser = commands.add_parser("layout", help="measure the construction of growing layouts")
+    layout_parser.add_argument("--roads", type=int, nargs="+", default=[4, 10, 20, 30, 50],
+                               help="roads in each direction")
+    layout_parser.add_argument("--building-size", type=int, default=20)
+    layout_parser.add_argument("--no-memory", action="store_true", help="skip the peak memory measurement")
+    layout_parser.add_argument("--output", default="layout.json")
+    layout_parser.set_defaults(func=layout)
+
+    imports_parser = commands.add_parser("imports", help="time the simulation imports of a worker process")
+    imports_parser.add_argument("--modules", nargs="+", default=["model", "runner", "batch,snapshot"],
+                                help="comma separated modules imported together in one interpreter")
+    imports_parser.add_argument("--repeats", type=int, default=3)
+    imports_parser.add_argument("--max-seconds", type=float, default=None,
+                                help="also fail if an import takes longer than this")
+    imports_parser.add_argument("--output", default=None, help="JSON file for the timings, none by default")
+    imports_parser.set_defaults(func=imports)
+
+    compare_parser = commands.add_parser("compare", help="compare two benchmark files")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
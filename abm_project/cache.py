@@ -0,0 +1,260 @@
+import argparse
+import functools
+import hashlib
+import inspect
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from model import CityModel
+from snapshot import RUN_ARGUMENTS
+
+'''
+This module describes the local cache of simulation results used by the runner:
+
+- code_fingerprint: hash of the source of the modules that determine the results of a run
+- run_spec: the full specification of a runner job, without its number of steps
+- ResultCache: collected series stored under the hash of their specification
+
+A run is identified by all its CityModel parameters (defaults included, the engine and other arguments that do not
+change the results left out), its seed, its early stopping and the content of its snapshot, plus the fingerprint of
+the simulation code, so changing the model invalidates the cache. The number of steps is not part of the key: the
+collected series of a shorter run are the first values of the series of a longer one (early stopping only fills
+the steps after the stop), so a cached run answers every query with fewer steps and only the longest run is kept.
+
+Every entry is a numpy archive with the series and its specification as JSON, so cached results can be matched to
+their parameters. The least recently used entries are removed once the cache grows above max_bytes.
+
+Usage:
+
+- series = runner.run_jobs(parameter_sets, 10, 1000, cache="results_cache"), reruns only the missing runs
+- python3 cache.py list results_cache, prints the cached runs and their parameters
+'''
+
+# modules whose source determines the collected series of a run
+SIMULATION_MODULES = ("agent.py", "batch.py", "districts.py", "engine.py", "kernels.py", "layout.py", "model.py",
+                      "occupancy.py", "routes.py", "scheduler.py", "signals.py", "snapshot.py", "spawner.py",
+                      "streams.py")
+
+# default size limit of a ResultCache
+MAX_BYTES = 1 << 30
+
+
+@functools.lru_cache(maxsize=None)
+def code_fingerprint(directory=os.path.dirname(os.path.abspath(__file__))):
+    """
+    Returns the hash of the source of SIMULATION_MODULES in directory.
+    """
+    digest = hashlib.sha256()
+    for name in SIMULATION_MODULES:
+        digest.update(name.encode())
+        with open(os.path.join(directory, name), "rb") as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=16)
+def file_hash(path, size, modified):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def plain(value):
+    """
+    Converts numpy values and arrays into their JSON counterparts.
+    """
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    if isinstance(value, (list, tuple)):
+        return [plain(item) for item in value]
+    return value
+
+
+def run_spec(job):
+    """
+    Returns the specification of a runner job (parameters, max_steps, seed, early_stopping, snapshot) as a JSON
+    serializable dictionary, without max_steps. The parameters of a job starting from an empty city are completed
+    with the CityModel defaults; those of a snapshot job are the arguments of Snapshot.restore, the snapshot is
+    identified by the hash of its content.
+    """
+    parameters, _, seed, early_stopping, snapshot = job
+    parameters = {name: value for name, value in parameters.items() if name not in RUN_ARGUMENTS}
+    if snapshot is None:
+        defaults = {name: parameter.default for name, parameter in inspect.signature(CityModel).parameters.items()
+                    if name not in RUN_ARGUMENTS}
+        parameters = dict(defaults, **parameters)
+    else:
+        stat = os.stat(snapshot)
+        snapshot = file_hash(os.path.abspath(snapshot), stat.st_size, stat.st_mtime_ns)
+    return dict(parameters={name: plain(value) for name, value in sorted(parameters.items())}, seed=plain(seed),
+                early_stopping=early_stopping, snapshot=snapshot)
+
+
+class ResultCache:
+    '''
+    Collected series of runner jobs, stored in a directory.
+
+    Arguments:
+        - directory: directory of the cache, created if it does not exist
+        - max_bytes: size above which the least recently used entries are removed
+
+    get and put take runner jobs, (parameters, max_steps, seed, early_stopping, snapshot) tuples, see runner.run_job.
+    A hit marks the entry as recently used by touching its file.
+    '''
+    def __init__(self, directory, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.entries = {}
+        for name in os.listdir(directory):
+            if name.endswith(".npz"):
+                stat = os.stat(os.path.join(directory, name))
+                self.entries[name[:-len(".npz")]] = (stat.st_size, stat.st_mtime_ns)
+
+    def key(self, job):
+        spec = json.dumps(dict(run_spec(job), code=code_fingerprint()), sort_keys=True)
+        return hashlib.sha256(spec.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def read(self, key):
+        """
+        Returns the max_steps, specification and series of an entry, None if it is missing.
+        """
+        try:
+            with np.load(self.path(key), allow_pickle=False) as archive:
+                series = {name[len("series_"):]: archive[name] for name in archive.files if name.startswith("series_")}
+                return int(archive["max_steps"]), json.loads(str(archive["spec"])), series
+        except FileNotFoundError:
+            # removed by another process sharing the cache
+            self.entries.pop(key, None)
+            return None
+
+    def __contains__(self, job):
+        """
+        Returns True if a run of job with at least as many steps is cached, only reading its number of steps.
+        """
+        key = self.key(job)
+        if key not in self.entries:
+            return False
+        try:
+            with np.load(self.path(key), allow_pickle=False) as archive:
+                return int(archive["max_steps"]) >= job[1]
+        except FileNotFoundError:
+            self.entries.pop(key, None)
+            return False
+
+    def get(self, job):
+        """
+        Returns the collected series of job, taken from the cached run with the same specification and at least as
+        many steps, or None.
+        """
+        key = self.key(job)
+        if key not in self.entries:
+            return None
+        entry = self.read(key)
+        if entry is None:
+            return None
+        max_steps, spec, series = entry
+        if max_steps < job[1]:
+            return None
+        if max_steps > job[1]:
+            collect_every = spec["parameters"].get("collect_every", 1)
+            length = job[1] // collect_every
+            if any(len(values) != max_steps // collect_every for values in series.values()):
+                # a snapshot collected with another interval, only the same number of steps is known
+                return None
+            series = {name: values[:length] for name, values in series.items()}
+        now = time.time_ns()
+        os.utime(self.path(key), ns=(now, now))
+        self.entries[key] = (self.entries[key][0], now)
+        return series
+
+    def put(self, job, series):
+        """
+        Stores the collected series of job, unless a run with as many steps is already cached, then removes the
+        least recently used entries above max_bytes.
+        """
+        key = self.key(job)
+        if key in self.entries:
+            entry = self.read(key)
+            if entry is not None and entry[0] >= job[1]:
+                return
+        spec = dict(run_spec(job), code=code_fingerprint())
+        temporary = os.path.join(self.directory, f"{key}.{os.getpid()}.tmp.npz")
+        np.savez(temporary, max_steps=np.array(job[1]), spec=np.array(json.dumps(spec, sort_keys=True)),
+                 **{"series_" + name: np.asarray(values) for name, values in series.items()})
+        os.replace(temporary, self.path(key))
+        stat = os.stat(self.path(key))
+        self.entries[key] = (stat.st_size, stat.st_mtime_ns)
+        self.evict()
+
+    def size(self):
+        return sum(size for size, _ in self.entries.values())
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache holds at most max_bytes.
+        """
+        total = self.size()
+        for key in sorted(self.entries, key=lambda key: self.entries[key][1]):
+            if total <= self.max_bytes:
+                return
+            total -= self.entries.pop(key)[0]
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        self.max_bytes, max_bytes = 0, self.max_bytes
+        self.evict()
+        self.max_bytes = max_bytes
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_dataframe(self):
+        """
+        Returns one row per cached run: its key, parameters, seed, early stopping, snapshot, number of steps, size
+        and whether it was computed by the current code.
+        """
+        records = []
+        for key, (size, _) in self.entries.items():
+            entry = self.read(key)
+            if entry is None:
+                continue
+            max_steps, spec, _ = entry
+            records.append(dict(key=key, **spec.pop("parameters"), seed=spec["seed"],
+                                early_stopping=spec["early_stopping"], snapshot=spec["snapshot"],
+                                max_steps=max_steps, bytes=size, current=spec["code"] == code_fingerprint()))
+        return pd.DataFrame(records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or empty a cache of simulation results")
+    commands = parser.add_subparsers(dest="command", required=True)
+    list_parser = commands.add_parser("list", help="print the cached runs and their parameters")
+    list_parser.add_argument("directory")
+    clear_parser = commands.add_parser("clear", help="remove all cached runs")
+    clear_parser.add_argument("directory")
+    args = parser.parse_args()
+
+    cache = ResultCache(args.directory)
+    if args.command == "list":
+        with pd.option_context("display.max_rows", None, "display.width", 200):
+            print(cache.get_dataframe())
+        print(f"{len(cache)} runs, {cache.size() / 1e6:.1f} MB")
+    else:
+        cache.clear()
+
+
+if __name__ == '__main__':
+    main()
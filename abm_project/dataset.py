@@ -0,0 +1,257 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from store import ResultStore
+
+'''
+This module describes the experiment datasets used by the analysis helpers:
+
+- convert: converts a legacy result file of the data directory into ResultStores
+- open_dataset: opens a ResultStore for reading, its shards are memory-mapped
+- iter_blocks, iter_runs: read a series block by block or the given runs
+- Moments: running mean and standard deviation of blocks of runs
+- run_stats, group_moments, plot_bands: streaming reductions used by model.stats and model.main
+
+The data directory holds the results of earlier experiments in several formats: pickled lists of congestion
+series, pickled dictionaries of DataFrames, one per varied parameter (OFAT runs of mesa's BatchRunner), and CSV
+files with one row per run (Sobol samples, with or without an index column), see read_legacy. Converted, the
+series keep one row per run and every column of a table becomes a series of one value per run, like the sweeps of
+sensitivity.py. The results of run_experiment are already stored that way.
+All reductions read the runs in blocks of block_runs, so their memory does not grow with the number of runs.
+
+Usage:
+
+- python3 dataset.py convert data datasets, converts every legacy file once
+- store = open_dataset("datasets/sa_data19_casey"); columns(store)["average_congestion"]
+- python3 dataset.py stats data_i1000_s1000_gld_mca150_t02, prints model.stats of an experiment
+'''
+
+# runs read at a time by the streaming reductions
+BLOCK_RUNS = 256
+
+# rows of a legacy CSV file converted at a time
+CSV_CHUNK_ROWS = 10000
+
+
+def read_legacy(path):
+    """
+    Yields (name, series, metadata) triples of a legacy result file, series being a dictionary of (runs, steps)
+    arrays:
+
+        - pickled list of congestion series followed by a dictionary of parameters (model.main before the
+          ResultStore): a single triple with the series as AverageCongestion and the parameters as metadata
+        - pickled dictionary of DataFrames (OFAT): one triple per varied parameter, one value per run and column
+        - CSV file: triples with an empty name and one value per run and column, read CSV_CHUNK_ROWS rows at a time
+    """
+    try:
+        # pandas keeps pickles of older pandas versions readable
+        data = pd.read_pickle(path)
+    except Exception:
+        data = None
+    if isinstance(data, list):
+        yield "", {"AverageCongestion": np.array(data[0:-1], dtype=np.float64)}, data[-1]
+        return
+    if isinstance(data, dict):
+        for name, table in data.items():
+            yield name, table_series(table), {"parameter": name}
+        return
+
+    header = pd.read_csv(path, nrows=0)
+    index_col = 0 if header.columns[0].startswith("Unnamed") else None
+    for chunk in pd.read_csv(path, index_col=index_col, chunksize=CSV_CHUNK_ROWS):
+        yield "", table_series(chunk), {}
+
+
+def table_series(table):
+    return {column: table[column].to_numpy(dtype=np.float64)[:, None] for column in table.columns}
+
+
+def convert(path, destination):
+    """
+    Converts the legacy result file path into ResultStores in destination, one per table, with the name of the
+    file as source in their metadata. Returns the directories of the stores, files that were already converted
+    are not read again.
+    """
+    stem = os.path.basename(path).split(".")[0].lstrip("_")
+    target = os.path.join(destination, stem)
+    if not os.path.exists(target):
+        # converted next to the target and renamed at once, so an interrupted conversion is started over
+        tmp_target = target + ".tmp"
+        for name, series, metadata in read_legacy(path):
+            with ResultStore(os.path.join(tmp_target, name),
+                             metadata=dict(metadata, source=os.path.basename(path))) as store:
+                store.extend(series)
+        for root, _, files in os.walk(tmp_target):
+            if "meta.json" in files:
+                ResultStore(root).consolidate()
+        os.replace(tmp_target, target)
+    return sorted(root for root, _, files in os.walk(target) if "meta.json" in files)
+
+
+def convert_all(source="data", destination="datasets"):
+    """
+    Converts every legacy result file found under source, returns the directories of the stores.
+    """
+    directories = []
+    for root, _, files in os.walk(source):
+        for file in sorted(files):
+            directories += convert(os.path.join(root, file), os.path.join(destination, os.path.relpath(root, source)))
+    return directories
+
+
+def open_dataset(path):
+    """
+    Opens the ResultStore in the directory path for reading, without creating it.
+    """
+    if not os.path.exists(os.path.join(path, "meta.json")):
+        raise FileNotFoundError(f"{path} is not a dataset, convert legacy files with dataset.convert first")
+    return ResultStore(path)
+
+
+def iter_blocks(store, name, block_runs=BLOCK_RUNS):
+    """
+    Yields the runs of a series as (runs, steps) blocks of at most block_runs runs, read from the memory-mapped
+    shards in run order.
+    """
+    for chunk in store.chunks(name):
+        for start in range(0, len(chunk), block_runs):
+            yield np.asarray(chunk[start:start + block_runs], dtype=np.float64)
+
+
+def iter_runs(store, name, runs):
+    """
+    Yields the given runs (sorted indices) of a series as memory-mapped rows.
+    """
+    runs = iter(runs)
+    run = next(runs, None)
+    start = 0
+    for chunk in store.chunks(name):
+        while run is not None and run < start + len(chunk):
+            yield chunk[run - start]
+            run = next(runs, None)
+        start += len(chunk)
+
+
+def columns(store):
+    """
+    Returns the series of a converted table as a dictionary of columns, one value per run, memory-mapped as
+    convert consolidates the stores.
+    """
+    return {name: store.array(name)[:, 0] for name in store.series}
+
+
+class Moments:
+    '''
+    Running count, mean and standard deviation per step of the blocks added to it, merged block by block with
+    the pairwise update of Chan et al., so the result equals np.mean and np.std over all runs at once.
+    '''
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, block):
+        """
+        Adds a (runs, steps) block.
+        """
+        n = len(block)
+        if n == 0:
+            return
+        mean = block.mean(axis=0)
+        m2 = ((block - mean) ** 2).sum(axis=0)
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (n / total)
+        self.m2 = self.m2 + m2 + delta ** 2 * (self.count * n / total)
+        self.count = total
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.count)
+
+
+def group_moments(blocks, group_size):
+    """
+    Returns the Moments of every group of group_size consecutive runs of blocks, e.g. the runs of one parameter
+    value of run_experiment.
+    """
+    groups = []
+    run = 0
+    for block in blocks:
+        start = 0
+        while start < len(block):
+            group = (run + start) // group_size
+            end = min(len(block), (group + 1) * group_size - run)
+            if group == len(groups):
+                groups.append(Moments())
+            groups[group].add(block[start:end])
+            start = end
+        run += len(block)
+    return groups
+
+
+def run_stats(blocks):
+    """
+    Streaming version of the statistics of model.stats. blocks is a function returning an iterator over the
+    (runs, steps) blocks of the series, it is read twice.
+
+    Returns the mean and standard deviation over all values, the indices of the runs whose second to last value is
+    above mean + std (jams) and the mean over all values of the jammed runs.
+    """
+    moments = Moments()
+    for block in blocks():
+        moments.add(block.reshape(-1, 1))
+    mean, std = moments.mean.item(), moments.std.item()
+
+    jams = []
+    jam_moments = Moments()
+    run = 0
+    for block in blocks():
+        jammed = block[:, -2] > mean + std
+        jams += (run + np.flatnonzero(jammed)).tolist()
+        jam_moments.add(block[jammed].reshape(-1, 1))
+        run += len(block)
+    mean_jam = jam_moments.mean.item() if jam_moments.count else np.nan
+    return mean, std, jams, mean_jam
+
+
+def plot_bands(store, name, group_size, labels, ax=None):
+    """
+    Plots the mean and a band of one standard deviation per step of every group of group_size consecutive runs
+    of a series, reading the store block by block. Returns the axes.
+    """
+    import matplotlib.pyplot as plt
+
+    ax = ax if ax is not None else plt.gca()
+    for label, moments in zip(labels, group_moments(iter_blocks(store, name), group_size)):
+        xs = np.arange(moments.mean.size)
+        ax.plot(xs, moments.mean, label=label)
+        ax.fill_between(xs, moments.mean - moments.std, moments.mean + moments.std, alpha=0.2)
+    return ax
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert and summarise experiment datasets")
+    commands = parser.add_subparsers(dest="command", required=True)
+    convert_parser = commands.add_parser("convert", help="convert the legacy result files of a directory")
+    convert_parser.add_argument("source", nargs="?", default="data")
+    convert_parser.add_argument("destination", nargs="?", default="datasets")
+    stats_parser = commands.add_parser("stats", help="print the statistics of model.stats for a series")
+    stats_parser.add_argument("path")
+    stats_parser.add_argument("--series", default="AverageCongestion")
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        for directory in convert_all(args.source, args.destination):
+            print(directory, len(open_dataset(directory)), "runs")
+    else:
+        # imported here as model imports the whole simulation
+        from model import stats
+        stats(open_dataset(args.path), args.series)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+import multiprocessing
+import weakref
+
+import numpy as np
+
+from engine import VectorizedEngine
+from kernels import mark_boundary, move_cars, move_district
+
+'''
+This module describes the domain decomposed car engine used by CityModel(engine="districts"):
+
+- partition_districts: splits the road cells into rectangular districts, cutting through the blocks between roads
+- SharedArrays: numpy arrays in shared memory, inherited by the worker processes
+- DistrictEngine: moves the cars of every district in its own worker process
+
+Every district is a rectangle of whole roads and intersections, so its traffic lights are its own and cars only
+cross a district edge along a road. The car arrays and the road cells live in shared memory: a car crossing an edge
+is handed over by moving it to a cell of the next district, which the worker of that district reads in the
+following step. Every step has two passes:
+
+1. every worker finds the cars on its cells and marks the boundary cars, whose look-ahead window reaches another
+   district, claiming their cells of interest (current cell and window)
+2. every worker moves its other cars in activation order, deferring the ones whose cells were claimed by an earlier
+   deferred car; the coordinator then moves the deferred cars of all districts in activation order
+
+Only cars sharing a cell of interest (current cell or look-ahead window) can influence each other. A car that
+moves in a worker shares no cell with an earlier deferred car, and the cars moved by different workers share no
+cell, so the moves happen in the order of CarAgent.step for every pair of cars that interact: the results are the
+same as with the other engines. Congestion, haste and the running totals of the model stay in the coordinator, they
+are vectorized over all cars and the haste random numbers are drawn in activation order.
+
+The workers run the kernels of kernels.py, compiled when Numba is installed. With one CPU per district, a step
+costs the moves of the largest district and of the cars near the district edges.
+
+Usage:
+
+- model = CityModel(engine="districts", districts=(2, 2), n_roads_horizontal=16, n_roads_vertical=16), four
+  worker processes; model.car_engine.close() stops them, they also stop with the model
+'''
+
+# claim_step of a cell that no car claimed yet
+NO_STEP = -1
+
+
+def partition_districts(layout, n_x, n_y):
+    """
+    Returns the district of every road cell of layout, for n_x by n_y districts numbered row by row. The vertical
+    roads are split into n_x groups of consecutive roads and the horizontal roads into n_y groups, the edges between
+    two groups run through the middle of the blocks of buildings between them.
+    """
+    if not (1 <= n_x <= layout.n_roads_horizontal and 1 <= n_y <= layout.n_roads_vertical):
+        raise ValueError(f"Cannot split {layout.n_roads_horizontal} by {layout.n_roads_vertical} roads into "
+                         f"{n_x} by {n_y} districts")
+    edges = []
+    for n_roads, n_districts, block in ((layout.n_roads_horizontal, n_x, layout.building_width),
+                                        (layout.n_roads_vertical, n_y, layout.building_height)):
+        # road i (1-based) starts at block * i + road_width * (i - 1), the edge after it halves the next block
+        last_roads = [len(group) for group in np.array_split(np.arange(n_roads), n_districts)]
+        last_roads = np.cumsum(last_roads)[:-1]
+        edges.append(block * last_roads + layout.road_width * last_roads + block // 2)
+    cells = np.array(layout.road_cells)
+    return np.searchsorted(edges[1], cells[:, 1], side="right") * n_x + \
+        np.searchsorted(edges[0], cells[:, 0], side="right")
+
+
+class SharedArrays:
+    '''
+    Numpy arrays in shared memory, passed to worker processes when they are started.
+
+    Arguments:
+        - shapes: dictionary with the (shape, dtype) of every array
+
+    arrays() returns the arrays, in the process that created them as in the workers.
+    '''
+    def __init__(self, shapes):
+        self.shapes = shapes
+        self.buffers = {name: multiprocessing.RawArray("b", max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1))
+                        for name, (shape, dtype) in shapes.items()}
+
+    def arrays(self):
+        return {name: np.frombuffer(self.buffers[name], dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+                for name, (shape, dtype) in self.shapes.items()}
+
+
+def district_worker(district, cars, road, barrier, connection):
+    """
+    Main loop of the worker process of district: receives the number of cars and the number of every step, runs
+    both passes and sends back its finished and deferred cars, until it receives None.
+    """
+    cars, road = cars.arrays(), road.arrays()
+    claim_step, claim_car = road["claim_step"], road["claim_car"]
+    while True:
+        message = connection.recv()
+        if message is None:
+            return
+        n_cars, step = message
+        own, boundary = mark_boundary(n_cars, district, step, cars["path"], cars["path_length"], cars["pos_i"],
+                                      cars["max_velocity"], road["light_at"], road["cell_district"],
+                                      claim_step[district], claim_car[district])
+        barrier.wait()
+        connection.send(move_district(own, boundary, district, step, cars["path"], cars["path_length"],
+                                      cars["pos_i"], cars["velocity"], cars["max_velocity"], cars["unique_id"],
+                                      road["car_at"], road["light_at"], road["blocked"], claim_step, claim_car))
+
+
+def stop_workers(connections, processes):
+    for connection in connections:
+        try:
+            connection.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+    for process in processes:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+
+
+class DistrictEngine(VectorizedEngine):
+    '''
+    VectorizedEngine whose cars are moved by one worker process per district.
+
+    Arguments:
+        - model: the CityModel the cars live in
+        - districts: (n_x, n_y) number of districts across and along the grid, see partition_districts
+
+    The arrays the workers read and write (unique_id, path, path_length, pos_i, velocity, max_velocity) are views of
+    shared buffers with room for max_car_agents + cars_per_second cars and the longest route; they grow, restarting
+    the workers, if a restored snapshot holds more cars. The occupancy arrays of the model's RoadGrid are replaced by
+    shared ones.
+    '''
+    shared = ('unique_id', 'path', 'path_length', 'pos_i', 'velocity', 'max_velocity')
+
+    def __init__(self, model, districts=(2, 2)):
+        super().__init__(model)
+        self.n_x, self.n_y = districts
+        self.n_districts = self.n_x * self.n_y
+        road_grid = self.road_grid
+        n_cells = len(road_grid.car_at)
+        self.road = SharedArrays(dict(car_at=((n_cells,), np.int64), light_at=((n_cells,), np.int64),
+                                      blocked=((n_cells,), bool), cell_district=((n_cells,), np.int64),
+                                      claim_step=((self.n_districts, n_cells), np.int64),
+                                      claim_car=((self.n_districts, n_cells), np.int64)))
+        road = self.road.arrays()
+        for name in ("car_at", "light_at", "blocked"):
+            road[name][:] = getattr(road_grid, name)
+            setattr(road_grid, name, road[name])
+        road["cell_district"][:] = partition_districts(model.layout, self.n_x, self.n_y)
+        road["claim_step"][:] = NO_STEP
+        self.cell_district = road["cell_district"]
+
+        # number of the current step, claims of earlier steps are ignored
+        self.steps_done = 0
+        self.capacity, self.width = 0, 0
+        self.buffers = None
+        self.workers = None
+        self.reserve(model.max_car_agents + model.cars_per_second, model.layout.routes.distance.max() + 1)
+
+    def reserve(self, capacity, width):
+        """
+        Makes room for capacity cars with paths of width cells in the shared buffers.
+        """
+        if capacity <= self.capacity and width <= self.width:
+            return
+        n = len(self.unique_id)
+        current = {name: getattr(self, name) for name in self.shared}
+        if capacity > self.capacity:
+            self.capacity = max(capacity, 2 * self.capacity)
+        self.width = max(width, self.width)
+        self.cars = SharedArrays({name: ((self.capacity, self.width) if name == "path" else (self.capacity,),
+                                         current[name].dtype) for name in self.shared})
+        self.buffers = self.cars.arrays()
+        self.buffers["path"][:] = -1
+        for name, values in current.items():
+            if name == "path":
+                self.buffers[name][:n, :values.shape[1]] = values
+            else:
+                self.buffers[name][:n] = values
+            setattr(self, name, self.buffers[name][:n])
+        self.start_workers()
+
+    def start_workers(self):
+        if self.workers is not None:
+            self.workers()
+        barrier = multiprocessing.Barrier(self.n_districts)
+        self.connections, processes = [], []
+        for district in range(self.n_districts):
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=district_worker, daemon=True,
+                                              args=(district, self.cars, self.road, barrier, worker_connection))
+            process.start()
+            self.connections.append(connection)
+            processes.append(process)
+        self.workers = weakref.finalize(self, stop_workers, self.connections, processes)
+
+    def close(self):
+        """
+        Stops the worker processes.
+        """
+        self.workers()
+
+    def share(self):
+        """
+        Copies the shared arrays back into the shared buffers if they were replaced, e.g. by Snapshot.restore.
+        """
+        n = len(self.unique_id)
+        path = self.path
+        self.reserve(n, path.shape[1])
+        for name in self.shared:
+            values, buffer = getattr(self, name), self.buffers[name]
+            if np.may_share_memory(values, buffer):
+                continue
+            if name == "path":
+                buffer[:n] = -1
+                buffer[:n, :values.shape[1]] = values
+            else:
+                buffer[:n] = values
+            setattr(self, name, buffer[:n])
+
+    def append(self, cars):
+        self.share()
+        n, k = len(self.unique_id), len(cars["unique_id"])
+        self.reserve(n + k, cars["path"].shape[1])
+        for name, values in cars.items():
+            if name not in self.shared:
+                setattr(self, name, np.concatenate([getattr(self, name), values]))
+                continue
+            buffer = self.buffers[name]
+            if name == "path":
+                buffer[n:n + k] = -1
+                buffer[n:n + k, :values.shape[1]] = values
+            else:
+                buffer[n:n + k] = values
+            setattr(self, name, buffer[:n + k])
+
+    def compact(self, keep):
+        m = np.count_nonzero(keep)
+        for name in self.arrays:
+            kept = getattr(self, name)[keep]
+            if name in self.shared:
+                self.buffers[name][:m] = kept
+                kept = self.buffers[name][:m]
+            setattr(self, name, kept)
+
+    def step(self):
+        """
+        Advances all cars by one step: congestion and haste are updated here, the cars are moved by the workers and
+        the deferred cars here, see the module description.
+        """
+        self.append_new_cars()
+        if len(self.unique_id) == 0:
+            return
+        self.share()
+        self.update_congestion()
+        self.update_haste()
+
+        self.steps_done += 1
+        for connection in self.connections:
+            connection.send((len(self.unique_id), self.steps_done))
+        finished, deferred = [], []
+        for connection in self.connections:
+            district_finished, district_deferred = connection.recv()
+            finished.append(district_finished)
+            deferred.append(district_deferred)
+
+        road_grid = self.road_grid
+        finished.append(move_cars(np.sort(np.concatenate(deferred)), self.path, self.path_length, self.pos_i,
+                                  self.velocity, self.max_velocity, self.unique_id, road_grid.car_at,
+                                  road_grid.light_at, road_grid.blocked))
+        self.remove_cars(np.sort(np.concatenate(finished)))
@@ -0,0 +1,294 @@
+import numpy as np
+
+'''
+This module describes the vectorized car engine used by CityModel(engine="vectorized"):
+
+- VectorizedEngine
+
+Instead of stepping one CarAgent at a time, the state of all cars is kept as structure-of-arrays
+and advanced with batched NumPy operations. The per-car rules are the same as in CarAgent.step.
+
+CarAgent.step is executed in activation order, so a car sees the cars that moved before it in the
+same step on their new cells and the cars after it on their old cells. The engine moves all cars at
+once on the cells of the previous pass, starting from the old cells, until no car changes its target:
+a car only depends on earlier cars, so this fixed point is the result of moving them one by one.
+
+A car whose cars ahead keep their cells is resolved in the first pass, so a standing queue costs one pass and only
+platoons driving off one after another take more: with 500 cars on the default 4 by 4 grid a step takes about 5
+passes of a dozen array operations over all cars, 0.8 ms against 3.4 ms for stepping the CarAgents (0.7 ms against
+0.8 ms with 100 cars). CityModel(engine="compiled") moves the cars one after another with the Numba kernel of
+kernels.py and is faster still; this engine is its fallback without Numba.
+'''
+
+
+class VectorizedEngine:
+    '''
+    Keeps the car agents of a CityModel as arrays and advances all of them each step.
+
+    Arguments:
+        - model: the CityModel the cars live in, its RoadGrid holds the occupancy of the road cells
+        - kernel: optional function that moves the given cars in one call, with the arguments of kernels.move_cars
+                  (e.g. kernels.compiled_move_cars); None advances the cars with NumPy, see advance
+
+    The following arrays are kept per car, in activation (creation) order:
+        - unique_id: car identifier
+        - path: cell indices of the path calculated at birth, padded with -1
+        - path_length, pos_i: length of the path and index of the current position in it
+        - velocity, max_velocity, velocity_sum, max_velocity_sum, congestion, haste, steps, tolerance:
+          same meaning as the CarAgent attributes
+
+    The running totals of the model (congestion_sum, haste_sum, num_car_agents) are updated through add_to_model
+    and the haste random numbers are taken through haste_draws, which BatchEngine overrides.
+    '''
+    arrays = ('unique_id', 'path', 'path_length', 'pos_i', 'velocity', 'max_velocity', 'velocity_sum',
+              'max_velocity_sum', 'congestion', 'haste', 'steps', 'tolerance')
+    def __init__(self, model, kernel=None):
+        self.model = model
+        self.road_grid = model.road_grid
+        self.kernel = kernel
+
+        self.unique_id = np.empty(0, dtype=np.int64)
+        self.path = np.full((0, 1), -1, dtype=np.int64)
+        self.path_length = np.empty(0, dtype=np.int64)
+        self.pos_i = np.empty(0, dtype=np.int64)
+        self.velocity = np.empty(0, dtype=np.int64)
+        self.max_velocity = np.empty(0, dtype=np.int64)
+        self.velocity_sum = np.empty(0, dtype=np.int64)
+        self.max_velocity_sum = np.empty(0, dtype=np.int64)
+        self.congestion = np.empty(0, dtype=np.float64)
+        self.haste = np.empty(0, dtype=np.int64)
+        self.steps = np.empty(0, dtype=np.int64)
+        self.tolerance = np.empty(0, dtype=np.float64)
+
+        # cars created since the last step, appended to the arrays at the start of the next step
+        self.new_cars = []
+
+    def __len__(self):
+        return len(self.unique_id) + len(self.new_cars)
+
+    def add_car(self, unique_id, cells, max_velocity, tolerance):
+        """
+        Places a new car at the start of its path, an array of road cells; equivalent to creating a CarAgent.
+        """
+        self.road_grid.place_cars(cells[0], unique_id)
+        # a new car starts at its maximum velocity
+        self.model.congestion_sum += 1.0
+        self.new_cars.append((unique_id, cells, max_velocity, tolerance))
+
+    def append_new_cars(self):
+        if not self.new_cars:
+            return
+        self.append(self.new_car_arrays())
+        self.new_cars = []
+
+    def new_car_arrays(self):
+        """
+        Returns the arrays of the cars created since the last step, their paths padded with -1.
+        """
+        unique_ids, paths, max_velocities, tolerances = zip(*self.new_cars)
+        n = len(paths)
+        path_length = np.array([len(path) for path in paths], dtype=np.int64)
+        path = np.full((n, path_length.max()), -1, dtype=np.int64)
+        for i, cells in enumerate(paths):
+            path[i, :len(cells)] = cells
+        max_velocity = np.array(max_velocities, dtype=np.int64)
+        return dict(unique_id=np.array(unique_ids, dtype=np.int64), path=path, path_length=path_length,
+                    pos_i=np.zeros(n, dtype=np.int64), velocity=max_velocity, max_velocity=max_velocity,
+                    velocity_sum=np.zeros(n, dtype=np.int64), max_velocity_sum=np.zeros(n, dtype=np.int64),
+                    congestion=np.ones(n), haste=np.zeros(n, dtype=np.int64), steps=np.zeros(n, dtype=np.int64),
+                    tolerance=np.array(tolerances, dtype=np.float64))
+
+    def append(self, cars):
+        """
+        Appends cars, a dictionary with the arrays of new cars, after the cars of the engine.
+        """
+        n, width = len(self.unique_id), max(self.path.shape[1], cars["path"].shape[1])
+        path = np.full((n + len(cars["path"]), width), -1, dtype=np.int64)
+        path[:n, :self.path.shape[1]] = self.path
+        path[n:, :cars["path"].shape[1]] = cars["path"]
+        self.path = path
+        for name, values in cars.items():
+            if name != "path":
+                setattr(self, name, np.concatenate([getattr(self, name), values]))
+
+    def get_car_state(self):
+        """
+        Returns the arrays of the cars used by CityModel.get_car_state, cell being the current cell and next_cell the
+        cell after it on the path (-1 at the end of the path).
+        """
+        self.append_new_cars()
+        cars = np.arange(len(self.unique_id))
+        next_i = np.minimum(self.pos_i + 1, self.path.shape[1] - 1)
+        next_cell = np.where(self.pos_i + 1 < self.path_length, self.path[cars, next_i], -1)
+        state = {name: getattr(self, name).copy() for name in ('velocity', 'max_velocity', 'velocity_sum',
+                                                               'max_velocity_sum', 'haste', 'steps', 'tolerance')}
+        state['cell'] = self.path[cars, self.pos_i]
+        state['next_cell'] = next_cell
+        return state
+
+    def step(self):
+        '''
+        Advances all cars by one step, equivalent to calling CarAgent.step on every car in activation order.
+
+        First congestion and haste are updated for all cars at once, as they only depend on the car itself.
+        Cars standing on a red or yellow traffic light stop; the remaining cars are advanced all at once, see
+        advance, or car by car by the kernel.
+        '''
+        self.append_new_cars()
+        if len(self.unique_id) == 0:
+            return
+        self.update_congestion()
+        self.update_haste()
+        if self.kernel is not None:
+            road_grid = self.road_grid
+            self.remove_cars(self.kernel(np.arange(len(self.unique_id)), self.path, self.path_length, self.pos_i,
+                                         self.velocity, self.max_velocity, self.unique_id, road_grid.car_at,
+                                         road_grid.light_at, road_grid.blocked))
+            return
+
+        cells = self.path[np.arange(len(self.unique_id)), self.pos_i]
+        light = self.road_grid.light_at[cells]
+        # red or yellow light on the current cell: stop
+        self.velocity[light > 0] = 0
+        green = light == 0
+        self.velocity[green] += np.trunc((self.max_velocity[green] - self.velocity[green]) / 2).astype(np.int64)
+
+        active = np.flatnonzero(light <= 0)
+        self.remove_cars(self.advance(active, self.next_paths(active), cells))
+
+    def update_congestion(self):
+        self.velocity_sum += self.velocity
+        self.max_velocity_sum += self.max_velocity
+        congestion = self.velocity_sum / self.max_velocity_sum
+        self.add_to_model('congestion_sum', slice(None), congestion - self.congestion)
+        self.congestion = congestion
+        self.steps += 1
+
+    def update_haste(self):
+        """
+        Same rules as CarAgent.update_haste, a random number is only drawn for cars
+        that are eligible to become hasty, in activation order.
+        """
+        haste_probability = (self.velocity_sum / self.steps) / self.max_velocity
+        mature = self.steps > 10
+        eligible = mature & (self.congestion < self.tolerance)
+        hasty = np.zeros(len(self.unique_id), dtype=bool)
+        hasty[eligible] = self.haste_draws(eligible) < haste_probability[eligible]
+        calm = mature & ~hasty & (self.haste != 0)
+        self.add_to_model('haste_sum', slice(None), (hasty & (self.haste == 0)).astype(np.int64) - calm)
+
+        self.haste[hasty] = 1
+        self.max_velocity[hasty] += np.ceil(self.max_velocity[hasty] * 0.25).astype(np.int64)
+        self.haste[calm] = 0
+        self.max_velocity[calm] = 5
+        np.minimum(self.velocity, self.max_velocity, out=self.velocity)
+
+    def next_paths(self, cars):
+        """
+        Returns the look-ahead window (next max_velocity cells of the path) of the given cars,
+        as an array of cell indices padded with -1.
+        """
+        reach = np.arange(1, self.max_velocity[cars].max(initial=0) + 1)
+        index = self.pos_i[cars, None] + reach
+        valid = (reach <= self.max_velocity[cars, None]) & (index < self.path_length[cars, None])
+        windows = self.path[cars[:, None], np.minimum(index, self.path.shape[1] - 1)]
+        windows[~valid] = -1
+        return windows
+
+    def advance(self, cars, windows, cells):
+        """
+        Updates velocity and position of the given cars, following CarAgent.step in activation order; cells are the
+        current cells of all cars. Returns the cars that reached the end of their path.
+
+        A car sees the cars before it on their new cells and the cars after it on their old cells. Starting from
+        every car on its old cell, all cars are moved again on the cells of the previous pass until no target
+        changes: as a car only depends on earlier cars, this fixed point is the move car by car.
+        """
+        n_cars = len(self.unique_id)
+        car_at = self.road_grid.car_at
+        rows = np.arange(len(cars))
+        in_path = windows >= 0
+        ahead, ahead_car = windows[in_path], np.broadcast_to(cars[:, None], windows.shape)[in_path]
+        light_ahead = np.zeros(windows.shape, dtype=bool)
+        light_ahead[in_path] = self.road_grid.light_at[ahead] != -1
+        # activation order of the car on every cell at the start of the step
+        order_at = np.full(len(car_at), -1, dtype=np.int64)
+        order_at[cells] = np.arange(n_cars)
+        later_car = order_at[ahead] > ahead_car
+        # first car of the activation order ending the step on every cell
+        arrival = np.full(len(car_at), n_cars, dtype=np.int64)
+
+        velocity, max_velocity = self.velocity[cars], self.max_velocity[cars]
+        pos_i, path_length = self.pos_i[cars], self.path_length[cars]
+        target = self.pos_i.copy()
+        car_ahead = np.zeros(windows.shape, dtype=bool)
+        while True:
+            staying = np.flatnonzero(target < self.path_length)
+            new_cells = self.path[staying, target[staying]]
+            np.minimum.at(arrival, new_cells, staying)
+            car_ahead[in_path] = later_car | (arrival[ahead] < ahead_car)
+            arrival[new_cells] = n_cars
+
+            obstacle = car_ahead | light_ahead
+            has_obstacle = obstacle.any(axis=1)
+            distance = obstacle.argmax(axis=1)
+            traffic_light = has_obstacle & light_ahead[rows, distance]
+            # a car waiting on the traffic light cell
+            distance -= traffic_light & car_ahead[rows, distance]
+
+            decelerate = has_obstacle & (velocity > 0) & (distance <= velocity)
+            accelerate = has_obstacle & ~decelerate & (velocity < max_velocity)
+            distance += traffic_light
+
+            new_velocity = velocity.copy()
+            new_velocity[decelerate] = np.maximum(np.ceil(distance[decelerate] / 2), 0).astype(np.int64)
+            accelerated = velocity + np.ceil((max_velocity - velocity) / 2).astype(np.int64)
+            accelerated = np.where(accelerated > distance, distance, np.minimum(accelerated, max_velocity))
+            new_velocity[accelerate] = accelerated[accelerate]
+            new_target = pos_i + new_velocity
+            if np.array_equal(new_target, target[cars]):
+                break
+            target[cars] = new_target
+        self.velocity[cars] = new_velocity
+
+        finished = target[cars] >= path_length
+        moving = ~finished & (new_velocity > 0)
+        self.road_grid.remove_cars(cells[cars[finished | moving]])
+        moved = cars[moving]
+        self.pos_i[moved] = target[moved]
+        self.road_grid.place_cars(self.path[moved, self.pos_i[moved]], self.unique_id[moved])
+        return cars[finished]
+
+    def remove_cars(self, cars):
+        """
+        Removes the given cars from the arrays, keeping the activation order of the others.
+        """
+        if len(cars) == 0:
+            return
+        keep = np.ones(len(self.unique_id), dtype=bool)
+        keep[cars] = False
+        if self.model.trajectories is not None:
+            self.model.trajectories.record_exits(self.unique_id[cars], self.steps[cars])
+        self.add_to_model('congestion_sum', cars, -self.congestion[cars])
+        self.add_to_model('haste_sum', cars, -self.haste[cars])
+        self.add_to_model('num_car_agents', cars, np.full(len(cars), -1))
+        self.compact(keep)
+
+    def compact(self, keep):
+        """
+        Keeps the cars of the boolean mask keep, in activation order.
+        """
+        for name in self.arrays:
+            setattr(self, name, getattr(self, name)[keep])
+
+    def add_to_model(self, name, cars, values):
+        """
+        Adds values, one per car in cars, to the running total name of the model.
+        """
+        setattr(self.model, name, getattr(self.model, name) + values.sum().item())
+
+    def haste_draws(self, eligible):
+        """
+        Returns one uniform random number per eligible car, in activation order.
+        """
+        return self.model.haste_random.uniform(np.count_nonzero(eligible))
@@ -0,0 +1,252 @@
+import argparse
+import gzip
+import struct
+
+import numpy as np
+from mesa import Model
+from mesa.datacollection import DataCollector
+
+from model import CityModel
+
+'''
+This module describes the compact binary frames used to visualise and replay CityModel runs:
+
+- FrameEncoder: encodes the static map once and the dynamic state of every step as small binary frames
+- FrameRecorder: writes the frames of a run to a file
+- read_frames: decodes a recorded file frame by frame
+- ReplayModel: a Mesa model that plays a recorded file back in the browser, see server.py
+
+The static frame holds the grid size, the road cells as a bit mask and the cells of the traffic lights. A step frame
+only holds the dynamic state: the road cell and haste of every car, the traffic lights that changed since the previous
+frame and the model variables, about 4 bytes per car.
+
+Format (little endian):
+    static frame: b"ABMS", width, height (uint16), number of lights (uint32), light cells (uint32 each),
+                  road mask (width * height bits, x-major, numpy.packbits order)
+    step frame:   b"ABMF", step, number of cars, number of changed lights (uint32), AverageCongestion,
+                  HastePercent (float32), cars (uint32 each, road cell | haste << 31),
+                  changed lights (uint32 each, light | state << 30)
+    file:         the static frame and the step frames, each preceded by its length (uint32), gzip compressed if
+                  the path ends with .gz
+
+Usage:
+
+- python3 frames.py record run.frames.gz --steps 2000 --max-car-agents 500, records a run without the browser
+- python3 run.py --replay run.frames.gz, plays it back
+- for frame in read_frames("run.frames.gz"): frame["cars"], frame["lights"], ...
+'''
+
+STATIC_MAGIC = b"ABMS"
+FRAME_MAGIC = b"ABMF"
+STATIC_HEADER = struct.Struct("<4sHHI")
+FRAME_HEADER = struct.Struct("<4sIIIff")
+LENGTH = struct.Struct("<I")
+HASTE_BIT = 1 << 31
+STATE_SHIFT = 30
+
+
+class FrameEncoder:
+    '''
+    Encodes the state of a CityModel (either engine) as binary frames.
+
+    Arguments:
+        - model: the CityModel to encode
+
+    The first step frame holds all traffic lights, the next ones only the lights that switched since the
+    previous frame.
+    '''
+    def __init__(self, model):
+        self.model = model
+        self.light_cells = model.signal_plan.light_cells.ravel()
+        self.light_states = None
+
+    def static_frame(self):
+        """
+        Returns the frame with the map of the city, sent once per model.
+        """
+        layout = self.model.layout
+        return STATIC_HEADER.pack(STATIC_MAGIC, layout.width, layout.height, len(self.light_cells)) + \
+            self.light_cells.astype("<u4").tobytes() + np.packbits(layout.road_mask.ravel()).tobytes()
+
+    def frame(self):
+        """
+        Returns the frame of the current step.
+        """
+        model = self.model
+        state = model.get_car_state()
+        cars = state["cell"].astype("<u4") | (state["haste"].astype("<u4") << 31)
+
+        states = model.road_grid.light_at[self.light_cells]
+        if self.light_states is None:
+            changed = np.arange(len(states))
+        else:
+            changed = np.flatnonzero(states != self.light_states)
+        self.light_states = states
+        lights = changed.astype("<u4") | (states[changed].astype("<u4") << STATE_SHIFT)
+
+        model_vars = model.datacollector.model_vars
+        congestion = model_vars["AverageCongestion"][-1] if model_vars["AverageCongestion"] else 0.0
+        haste = model_vars["HastePercent"][-1] if model_vars["HastePercent"] else 0.0
+        return FRAME_HEADER.pack(FRAME_MAGIC, model.schedule.steps, len(cars), len(lights), congestion, haste) + \
+            cars.tobytes() + lights.tobytes()
+
+
+class FrameRecorder:
+    '''
+    Writes the frames of a CityModel run to a file.
+
+    Arguments:
+        - model: the CityModel to record
+        - path: file the frames are written to, gzip compressed if it ends with .gz
+
+    Call record after every step, or use run. Use it as a context manager or call close when done.
+    '''
+    def __init__(self, model, path):
+        self.encoder = FrameEncoder(model)
+        self.file = gzip.open(path, "wb") if str(path).endswith(".gz") else open(path, "wb")
+        self.write(self.encoder.static_frame())
+        self.record()
+
+    def write(self, frame):
+        self.file.write(LENGTH.pack(len(frame)))
+        self.file.write(frame)
+
+    def record(self):
+        self.write(self.encoder.frame())
+
+    def run(self, steps):
+        """
+        Steps the model steps times, recording a frame after every step.
+        """
+        for _ in range(steps):
+            self.encoder.model.step()
+            self.record()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def iter_records(path):
+    """
+    Yields the raw frames of a recorded file.
+    """
+    with (gzip.open(path, "rb") if str(path).endswith(".gz") else open(path, "rb")) as file:
+        while True:
+            length = file.read(LENGTH.size)
+            if len(length) < LENGTH.size:
+                return
+            yield file.read(LENGTH.unpack(length)[0])
+
+
+def decode_static(frame):
+    """
+    Decodes a static frame into a dictionary with width, height, light_cells, road_mask and road_cells, the (x,y)
+    coordinates of the road cells in cell index order.
+    """
+    magic, width, height, n_lights = STATIC_HEADER.unpack_from(frame)
+    if magic != STATIC_MAGIC:
+        raise ValueError("Not a static frame")
+    offset = STATIC_HEADER.size
+    light_cells = np.frombuffer(frame, dtype="<u4", count=n_lights, offset=offset).astype(np.int64)
+    bits = np.frombuffer(frame, dtype=np.uint8, offset=offset + 4 * n_lights)
+    road_mask = np.unpackbits(bits, count=width * height).astype(bool).reshape(width, height)
+    return dict(width=width, height=height, light_cells=light_cells, road_mask=road_mask,
+                road_cells=np.argwhere(road_mask))
+
+
+def decode_frame(frame, light_states):
+    """
+    Decodes a step frame into a dictionary with step, cars (road cells), haste, lights (the state of every light)
+    and the model variables. light_states holds the states of the previous frame and is updated in place.
+    """
+    magic, step, n_cars, n_lights, congestion, haste_percent = FRAME_HEADER.unpack_from(frame)
+    if magic != FRAME_MAGIC:
+        raise ValueError("Not a step frame")
+    cars = np.frombuffer(frame, dtype="<u4", count=n_cars, offset=FRAME_HEADER.size)
+    lights = np.frombuffer(frame, dtype="<u4", count=n_lights, offset=FRAME_HEADER.size + 4 * n_cars)
+    light_states[lights & ((1 << STATE_SHIFT) - 1)] = lights >> STATE_SHIFT
+    return dict(step=step, cars=(cars & (HASTE_BIT - 1)).astype(np.int64), haste=(cars >> 31).astype(np.int64),
+                lights=light_states.copy(), AverageCongestion=congestion, HastePercent=haste_percent)
+
+
+def read_frames(path):
+    """
+    Yields the decoded step frames of a recorded file, each with the static map under "static".
+    """
+    records = iter_records(path)
+    static = decode_static(next(records))
+    light_states = np.full(len(static["light_cells"]), -1, dtype=np.int64)
+    for frame in records:
+        yield dict(decode_frame(frame, light_states), static=static)
+
+
+class ReplayModel(Model):
+    '''
+    Plays a recorded file back as a Mesa model, every step shows the next frame.
+
+    Arguments:
+        - path: file written by FrameRecorder
+
+    Offers static_frame and frame like FrameEncoder and collects AverageCongestion and HastePercent from the
+    frames, so the visualisation elements of a CityModel can be used for the replay.
+    '''
+    def __init__(self, path):
+        super().__init__()
+        self.records = iter_records(path)
+        self.static = next(self.records)
+        self.current = next(self.records)
+        self.datacollector = DataCollector(model_reporters={
+            "AverageCongestion": lambda model: model.frame_values()[0],
+            "HastePercent": lambda model: model.frame_values()[1]
+        })
+        self.datacollector.collect(self)
+
+    def frame_values(self):
+        return FRAME_HEADER.unpack_from(self.current)[4:]
+
+    def static_frame(self):
+        return self.static
+
+    def frame(self):
+        return self.current
+
+    def step(self):
+        frame = next(self.records, None)
+        if frame is None:
+            # the last frame stays on screen
+            self.running = False
+            return
+        self.current = frame
+        self.datacollector.collect(self)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record the frames of a CityModel run for an offline replay")
+    commands = parser.add_subparsers(dest="command", required=True)
+    record_parser = commands.add_parser("record", help="run a model and record its frames")
+    record_parser.add_argument("path")
+    record_parser.add_argument("--steps", type=int, default=1000)
+    record_parser.add_argument("--seed", type=int, default=1)
+    record_parser.add_argument("--engine", default="vectorized")
+    for name, default in (("max-car-agents", 100), ("cars-per-second", 5), ("max-velocity", 5),
+                          ("green-light-duration", 5), ("n-roads-horizontal", 4), ("n-roads-vertical", 4)):
+        record_parser.add_argument(f"--{name}", type=int, default=default)
+    record_parser.add_argument("--tolerance", type=float, default=1)
+    args = parser.parse_args()
+
+    model = CityModel(seed=args.seed, engine=args.engine, max_car_agents=args.max_car_agents,
+                      cars_per_second=args.cars_per_second, max_velocity=args.max_velocity,
+                      green_light_duration=args.green_light_duration, tolerance=args.tolerance,
+                      n_roads_horizontal=args.n_roads_horizontal, n_roads_vertical=args.n_roads_vertical)
+    with FrameRecorder(model, args.path) as recorder:
+        recorder.run(args.steps)
+
+
+if __name__ == '__main__':
+    main()
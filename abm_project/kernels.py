@@ -0,0 +1,187 @@
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+'''
+This module describes the compiled car kernels used by CityModel(engine="compiled") and CityModel(engine="districts"):
+
+- move_car, move_cars: the velocity and position update of CarAgent.step for one car and for a list of cars, one car
+  after another
+- mark_boundary, move_district: the two passes of a district worker of DistrictEngine, see districts.py
+- compiled_move_cars: move_cars compiled with Numba, None if Numba is not installed
+
+VectorizedEngine needs a dozen array passes over all cars for every round of its fixed point to resolve the
+branches of CarAgent.step (light on the current cell, first obstacle ahead, decelerate or accelerate). A
+compiled loop follows those branches directly in activation order, so a step costs one pass over the cars.
+Congestion and haste do not branch on other cars and stay vectorized in VectorizedEngine.
+
+With Numba installed all kernels are compiled; without it they are plain Python functions, VectorizedEngine then
+falls back to its NumPy passes, which give the same results.
+'''
+
+
+def jit(function):
+    return numba.njit(cache=True, nogil=True)(function) if numba is not None else function
+
+
+@jit
+def move_car(car, path, path_length, pos_i, velocity, max_velocity, unique_id, car_at, light_at, blocked):
+    """
+    Updates the velocity and position of car, following CarAgent.step after the congestion and haste updates, and
+    keeps car_at and blocked up to date. Returns True if the car reached the end of its path, it is then already
+    removed from the road cells.
+    """
+    cell = path[car, pos_i[car]]
+    current = light_at[cell]
+    # red or yellow light on the current cell: stop
+    if current > 0:
+        velocity[car] = 0
+        return False
+    v = velocity[car]
+    v_max = max_velocity[car]
+    if current == 0:
+        # CarAgent truncates half the difference towards zero
+        difference = v_max - v
+        v += difference // 2 if difference >= 0 else -(-difference // 2)
+
+    # first car or traffic light in the next v_max cells of the path
+    distance = -1
+    next_cell = -1
+    for i in range(pos_i[car] + 1, min(pos_i[car] + v_max + 1, path_length[car])):
+        if blocked[path[car, i]]:
+            distance = i - pos_i[car] - 1
+            next_cell = path[car, i]
+            break
+    if distance != -1:
+        traffic_light = light_at[next_cell] != -1
+        # a car waiting on the traffic light
+        if traffic_light and car_at[next_cell] != -1:
+            distance -= 1
+        if v > 0 and distance <= v:
+            if traffic_light:
+                distance += 1
+            v = (distance + 1) // 2 if distance > 0 else 0
+        elif v < v_max:
+            if traffic_light:
+                distance += 1
+            v += (v_max - v + 1) // 2
+            if v > distance:
+                v = distance
+            elif v > v_max:
+                v = v_max
+    velocity[car] = v
+
+    target = pos_i[car] + v
+    if target >= path_length[car]:
+        car_at[cell] = -1
+        blocked[cell] = light_at[cell] != -1
+        return True
+    if v > 0:
+        car_at[cell] = -1
+        blocked[cell] = light_at[cell] != -1
+        pos_i[car] = target
+        cell = path[car, target]
+        car_at[cell] = unique_id[car]
+        blocked[cell] = True
+    return False
+
+
+@jit
+def move_cars(cars, path, path_length, pos_i, velocity, max_velocity, unique_id, car_at, light_at, blocked):
+    """
+    Moves the given cars (indices in the car arrays) one after another with move_car. Returns the cars that reached
+    the end of their path, they are already removed from the road cells.
+    """
+    finished = np.empty(len(cars), dtype=np.int64)
+    n_finished = 0
+    for car in cars:
+        if move_car(car, path, path_length, pos_i, velocity, max_velocity, unique_id, car_at, light_at, blocked):
+            finished[n_finished] = car
+            n_finished += 1
+    return finished[:n_finished]
+
+
+@jit
+def claim(car, start, end, path, claim_step, claim_car, step):
+    """
+    Claims the cells path[car, start:end] for car in the current step, a cell keeps the earliest car claiming it.
+    """
+    for i in range(start, end):
+        cell = path[car, i]
+        if claim_step[cell] != step or claim_car[cell] > car:
+            claim_step[cell] = step
+            claim_car[cell] = car
+
+
+@jit
+def mark_boundary(n_cars, district, step, path, path_length, pos_i, max_velocity, light_at, cell_district,
+                  claim_step, claim_car):
+    """
+    First pass of a district worker. Returns the cars of the first n_cars whose current cell lies in district, in
+    activation order, and which of them are boundary cars: cars whose look-ahead window reaches another district.
+    The cells of interest (current cell and window) of the boundary cars are claimed in the claim arrays of the
+    district. Cars stopped by a light read no other cell, they are never boundary cars.
+    """
+    own = np.empty(n_cars, dtype=np.int64)
+    boundary = np.zeros(n_cars, dtype=np.bool_)
+    n_own = 0
+    for car in range(n_cars):
+        cell = path[car, pos_i[car]]
+        if cell_district[cell] != district:
+            continue
+        own[n_own] = car
+        if light_at[cell] <= 0:
+            end = min(pos_i[car] + max_velocity[car] + 1, path_length[car])
+            for i in range(pos_i[car] + 1, end):
+                if cell_district[path[car, i]] != district:
+                    boundary[n_own] = True
+                    break
+            if boundary[n_own]:
+                claim(car, pos_i[car], end, path, claim_step, claim_car, step)
+        n_own += 1
+    return own[:n_own], boundary[:n_own]
+
+
+@jit
+def move_district(own, boundary, row, step, path, path_length, pos_i, velocity, max_velocity, unique_id, car_at,
+                  light_at, blocked, claim_step, claim_car):
+    """
+    Second pass of a district worker, after every district finished mark_boundary. Moves the cars own of the
+    district with move_car, in activation order, except the deferred ones: boundary cars and cars whose cells of
+    interest were claimed by an earlier deferred car, of any district. A deferred car claims its cells in the claim
+    row of the district. Returns the finished and the deferred cars.
+    """
+    finished = np.empty(len(own), dtype=np.int64)
+    deferred = np.empty(len(own), dtype=np.int64)
+    n_finished = 0
+    n_deferred = 0
+    for k in range(len(own)):
+        car = own[k]
+        cell = path[car, pos_i[car]]
+        if light_at[cell] > 0:
+            velocity[car] = 0
+            continue
+        end = min(pos_i[car] + max_velocity[car] + 1, path_length[car])
+        defer = boundary[k]
+        i = pos_i[car]
+        while not defer and i < end:
+            cell = path[car, i]
+            for other in range(claim_step.shape[0]):
+                if claim_step[other, cell] == step and claim_car[other, cell] < car:
+                    defer = True
+            i += 1
+        if defer:
+            if not boundary[k]:
+                claim(car, pos_i[car], end, path, claim_step[row], claim_car[row], step)
+            deferred[n_deferred] = car
+            n_deferred += 1
+        elif move_car(car, path, path_length, pos_i, velocity, max_velocity, unique_id, car_at, light_at, blocked):
+            finished[n_finished] = car
+            n_finished += 1
+    return finished[:n_finished], deferred[:n_deferred]
+
+
+compiled_move_cars = move_cars if numba is not None else None
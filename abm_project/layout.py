@@ -0,0 +1,163 @@
+import networkx as nx
+import numpy as np
+
+from routes import RouteTable
+
+'''
+This module describes the static map of the city shared by all CityModel instances:
+
+- CityLayout
+
+The layout only depends on the grid geometry, so it is computed once per process (per geometry) and
+reused by every model, which makes constructing a CityModel close to constant time after the first one.
+'''
+
+
+class CityLayout:
+    '''
+    Immutable road map of the city.
+
+    Arguments:
+        - n_roads_horizontal, n_roads_vertical: number of roads in each direction
+        - road_width: width of a road (>= 2), its first two cells are the lanes, one per driving direction
+        - building_width, building_height: size of the blocks of buildings between the roads
+        - route_cache_dir: optional directory where the RouteTable is stored, see RouteTable
+
+    Attributes:
+        - width, height: dimensions of the grid
+        - road_pos, road_pos_x, road_pos_y: coordinates of the road lanes
+        - road_cells: sorted (x,y) coordinates of the road cells
+        - road_mask: (width, height) boolean array, True for road cells
+        - cell_index: (width, height) array with the index of every road cell in road_cells, -1 for buildings
+        - intersections: positions of the intersections
+        - starting_points, end_points: points of entry and exit of the car agents
+        - road_graph: frozen directed graph of the road cells
+        - routes: RouteTable of the road graph towards the end points
+
+    Use CityLayout.get to obtain the shared instance of a geometry.
+    '''
+    _layouts = {}
+
+    def __init__(self, n_roads_horizontal, n_roads_vertical, road_width, building_width, building_height,
+                 route_cache_dir=None):
+        if min(n_roads_horizontal, n_roads_vertical, building_width, building_height) < 1 or road_width < 2:
+            raise ValueError("A CityLayout needs at least one road in each direction, blocks of at least one cell "
+                             "and roads at least two cells wide")
+        self.n_roads_horizontal = n_roads_horizontal
+        self.n_roads_vertical = n_roads_vertical
+        self.road_width = road_width
+        self.building_width = building_width
+        self.building_height = building_height
+        self.width = building_width * (n_roads_horizontal + 1) + n_roads_horizontal * road_width
+        self.height = building_height * (n_roads_vertical + 1) + n_roads_vertical * road_width
+
+        self.road_pos, self.road_pos_x, self.road_pos_y = self.get_road_positions()
+        self.road_mask = np.zeros((self.width, self.height), dtype=bool)
+        self.road_mask[self.road_pos_x, :] = True
+        self.road_mask[:, self.road_pos_y] = True
+        self.road_cells = [tuple(cell) for cell in np.argwhere(self.road_mask).tolist()]
+        self.cell_index = np.full((self.width, self.height), -1, dtype=np.int64)
+        self.cell_index[self.road_mask] = np.arange(len(self.road_cells))
+
+        self.intersections = self.get_intersections()
+        self.starting_points = self.get_starting_points()
+        self.end_points = self.get_end_points()
+        self.road_graph = nx.freeze(self.create_road_graph())
+        self.routes = RouteTable(self.road_graph, self.end_points, cache_dir=route_cache_dir)
+
+        self.road_mask.flags.writeable = False
+        self.cell_index.flags.writeable = False
+
+    @classmethod
+    def get(cls, n_roads_horizontal, n_roads_vertical, road_width, building_width, building_height,
+            route_cache_dir=None):
+        """
+        Returns the layout of the given geometry, creating it only the first time it is requested.
+        """
+        key = (n_roads_horizontal, n_roads_vertical, road_width, building_width, building_height)
+        if key not in cls._layouts:
+            cls._layouts[key] = cls(*key, route_cache_dir=route_cache_dir)
+        return cls._layouts[key]
+
+    @property
+    def building_cells(self):
+        return [tuple(cell) for cell in np.argwhere(~self.road_mask).tolist()]
+
+    def get_road_positions(self):
+        """
+        Returns the x and y coordinates of the road lanes.
+        """
+        road_pos_x = [self.building_width * i + self.road_width * (i - 1)
+                      for i in range(1, self.n_roads_horizontal + 1)] + \
+                     [self.building_width * i + 1 + self.road_width * (i - 1)
+                      for i in range(1, self.n_roads_horizontal + 1)]
+        road_pos_y = [self.building_height * i + self.road_width * (i - 1)
+                      for i in range(1, self.n_roads_vertical + 1)] + \
+                     [self.building_height * i + 1 + self.road_width * (i - 1)
+                      for i in range(1, self.n_roads_vertical + 1)]
+        road_pos = set(road_pos_x + road_pos_y)
+
+        return road_pos, road_pos_x, road_pos_y
+
+    def get_intersections(self):
+        intersection_pos_x = [self.building_width * i + self.road_width * (i - 1)
+                              for i in range(1, self.n_roads_horizontal + 1)]
+        intersection_pos_y = [self.building_height * i + self.road_width * (i - 1)
+                              for i in range(1, self.n_roads_vertical + 1)]
+        return list(set((x, y) for x in intersection_pos_x for y in intersection_pos_y))
+
+    def get_starting_points(self):
+        """
+        Create points of entry on the grid for the car agents, at the start of every lane
+        """
+        lanes_down, lanes_up = self.road_pos_x[:self.n_roads_horizontal], self.road_pos_x[self.n_roads_horizontal:]
+        lanes_right, lanes_left = self.road_pos_y[:self.n_roads_vertical], self.road_pos_y[self.n_roads_vertical:]
+        starting_points_top = [(x, self.height - 1) for x in lanes_down]
+        starting_points_bottom = [(x, 0) for x in lanes_up]
+
+        starting_points_left = [(0, y) for y in lanes_right]
+        starting_points_right = [(self.width - 1, y) for y in lanes_left]
+
+        return starting_points_top + starting_points_bottom + starting_points_left + starting_points_right
+
+    def get_end_points(self):
+        """
+        Create points of exit on the grid for the car agents, at the end of every lane
+        """
+        lanes_down, lanes_up = self.road_pos_x[:self.n_roads_horizontal], self.road_pos_x[self.n_roads_horizontal:]
+        lanes_right, lanes_left = self.road_pos_y[:self.n_roads_vertical], self.road_pos_y[self.n_roads_vertical:]
+        end_points_top = [(x, self.height - 1) for x in lanes_up]
+        end_points_bottom = [(x, 0) for x in lanes_down]
+
+        end_points_left = [(0, y) for y in lanes_left]
+        end_points_right = [(self.width - 1, y) for y in lanes_right]
+
+        return end_points_top + end_points_bottom + end_points_left + end_points_right
+
+    def create_road_graph(self, draw=False):
+        """
+        Create the roads on where the car agents can drive on. Every road has two lanes, the first one drives down
+        (vertical roads) or to the right (horizontal roads) and the second one up or to the left.
+        """
+        graph = nx.DiGraph()
+
+        down = [[(x, y) for y in reversed(range(self.height))] for x in self.road_pos_x[:self.n_roads_horizontal]]
+        up = [[(x, y) for y in range(self.height)] for x in self.road_pos_x[self.n_roads_horizontal:]]
+        right = [[(x, y) for x in range(self.width)] for y in self.road_pos_y[:self.n_roads_vertical]]
+        left = [[(x, y) for x in reversed(range(self.width))] for y in self.road_pos_y[self.n_roads_vertical:]]
+        combined = down + up + right + left
+
+        for path in combined:
+            nx.add_path(graph, path)
+
+        if draw:
+            # imported here to keep plotting out of the simulation imports
+            import matplotlib.pyplot as plt
+
+            positions = {coord: coord for path in combined for coord in path}
+            nx.draw(graph, pos=positions, node_size=100)
+            plt.gca().set_aspect('equal', adjustable='box')
+            plt.show()
+
+        # get shortest path using nx.shortest_path(graph, (0, 86), (20, 0))
+        return graph
@@ -1,36 +1,48 @@
-import networkx as nx
-import matplotlib.pyplot as plt
 import numpy as np
-import seaborn as sns
-import pandas as pd
-import pickle
-import random
 
-from tqdm import tqdm
 from mesa import Model
-from mesa.space import SingleGrid, MultiGrid
-from mesa.time import BaseScheduler
+from mesa.space import MultiGrid
 from mesa.datacollection import DataCollector
-from scipy.spatial.distance import euclidean
 from agent import CarAgent, BuildingAgent, IntersectionAgent
+from engine import VectorizedEngine
+from occupancy import RoadGrid
+from scheduler import CityScheduler
+from signals import SignalPlan
+from spawner import Spawner
+from layout import CityLayout
+from profiling import StepProfiler
+from store import ResultStore
+from streams import model_streams
 
 '''
 
 This file describes the main model, CityModel, and all its functions:
 
-- Intersection, building and car agent creators as well road graph creator
-- Grid initializer
-- Road graph generator
+- Intersection, building and car agent creators, the static map (road graph, entry and exit points) is a CityLayout
+- Grid initializer, the cars and traffic lights are tracked in a RoadGrid, the Mesa grid is only built for visualisation
 - Data collector functions
 
 Usage:
 
 - Instantiate the model using model = CityModel(green_light_duration=gld, max_car_agents=max_cars_agents,
                               tolerance=tolerance)
+  passing engine="vectorized" advances all cars with batched NumPy operations instead of stepping CarAgents (see
+  engine.py), engine="compiled" with the Numba kernel of kernels.py when
+  Numba is installed (the fastest engine), engine="districts" with one worker
+  process per district of the city, for large grids
 - Run the model for a desired number of steps using model.step()
 - Collect the output: data = model.datacollector.get_model_vars_dataframe()
+- Or run it with early stopping, which returns the collected series:
+  data = model.run(max_steps, early_stopping="gridlock")
+- With profile=True, the time spent in each phase of every step: profile = model.profiler.get_dataframe()
+- Per car trajectories and trips: recorder = trajectories.TrajectoryRecorder(model, every=5, fraction=0.1)
+
+Importing this module only loads the simulation (Mesa, NumPy, NetworkX for the road graph), so worker processes start
+quickly: Numba is loaded by the compiled and districts engines, matplotlib and the dataset statistics by main and
+stats, and the module does not seed any global random state, runs are seeded with the seed argument.
 '''
 
+# default geometry of the city, see the layout arguments of CityModel
 n_roads_horizontal = 4
 n_roads_vertical = 4
 
@@ -44,27 +56,57 @@ total_width = building_width * \
 total_height = building_height * \
                (n_roads_vertical + 1) + n_roads_vertical * road_width
 
-random.seed(1)
-np.random.seed(1)
-
 
 class CityModel(Model):
     ''' Creates a City Model
 
     Arguments:
         max_car_agents: maximum amount of cars in the grid at a given time step
-        cars_per_second: amount of cars that enter the grid per second until max_car_agents is reached
+        cars_per_second: amount of cars that want to enter the grid per second until max_car_agents is reached; the
+                         cars that find no free entry point or no room below max_car_agents wait for a later step,
+                         at most cars_per_second of them, the demand beyond that is dropped (spawn_dropped with
+                         profile=True)
         max_velocity: starting maximum velocity for car agents
         tolerance: congestion threshold that will cause a caragent to be "hasty"
         green_light_duration: amount of steps a given traffic light agent will stay red or green
+        signal_offsets: optional number of steps every intersection (in the order of layout.intersections) is ahead
+                        in its light cycle, e.g. signals.green_wave_offsets
+        engine: "mesa" steps every CarAgent through the scheduler, "vectorized" keeps the cars in a VectorizedEngine
+                and gives the same results for a fixed seed, "compiled" moves them with kernels.compiled_move_cars
+                (the same results again), falling back to "vectorized" if Numba is not installed, "districts"
+                splits the city into districts moved by worker processes, see DistrictEngine (the same results again)
+        districts: (n_x, n_y) number of districts across and along the grid with engine="districts"
+        route_cache_dir: optional directory where the RouteTable of the layout is stored and reused between processes
+        collect_every: the model variables are collected every collect_every steps
+        seed: seed of the random streams of the model (spawning, routing and haste), an integer or a numpy SeedSequence;
+              if None it is drawn from the global numpy random state
+        profile: record the time of every phase of a step (signals, cars, spawning, data collection) and the
+                 number of spawned cars, cars waiting to enter, dropped demand and destroyed cars in model.profiler,
+                 a StepProfiler
+        n_roads_horizontal, n_roads_vertical: number of roads in each direction, 4 by default
+        road_width: width of a road, its two lanes are the first two cells
+        building_width, building_height: size of the blocks of buildings between the roads, 20 by default
+
+    The static map of the city (roads, intersections, entry/exit points, road graph and routes) is a CityLayout
+    shared by all models of the same geometry. It is generated from the layout arguments, its construction time
+    grows with the number of road cells, except the route table, which has a row per exit (see RouteTable).
 
     The model collects "AverageCongestion" and "HastePercent" at each step, which can be retrieved through model.datacollector.get_model_vars_dataframe()
+    Both are computed in constant time from running totals that the cars update when their congestion or haste changes.
     '''
-    def __init__(self, max_car_agents=100, cars_per_second=5, max_velocity=5, tolerance=1, green_light_duration=5):
+    def __init__(self, max_car_agents=100, cars_per_second=5, max_velocity=5, tolerance=1, green_light_duration=5,
+                 engine="mesa", districts=(2, 2), route_cache_dir=None, collect_every=1,
+                 seed=None, profile=False, signal_offsets=None, n_roads_horizontal=n_roads_horizontal,
+                 n_roads_vertical=n_roads_vertical, road_width=road_width, building_width=building_width,
+                 building_height=building_height):
         super().__init__()
+        if engine not in ("mesa", "vectorized", "compiled", "districts"):
+            raise ValueError(f"Unknown engine {engine!r}, expected 'mesa', 'vectorized', 'compiled' or 'districts'")
+        self.engine = engine
         self.max_car_agents = max_car_agents
         self.cars_per_second = cars_per_second
         self.green_light_duration = green_light_duration
+        self.signal_offsets = signal_offsets
         self.tolerance = tolerance
 
         self.agents = []
@@ -72,233 +114,375 @@ class CityModel(Model):
         self.unique_id = 0
         self.num_car_agents = 0
         self.max_velocity = max_velocity
+        self.collect_every = collect_every
+        self.profiler = StepProfiler() if profile else None
+        # per car output, set by attaching a trajectories.TrajectoryRecorder
+        self.trajectories = None
+
+        if seed is None:
+            # np.random.seed before creating the model still makes a run reproducible
+            seed = int(np.random.randint(2 ** 63 - 1, dtype=np.int64))
+        self.seed = seed
+        self.streams = model_streams(seed)
+        self.spawn_random = self.streams["spawn"]
+        self.route_random = self.streams["routing"]
+        self.haste_random = self.streams["haste"]
+
+        # running totals of congestion and haste over all cars
+        self.congestion_sum = 0.0
+        self.haste_sum = 0
 
         self.datacollector = DataCollector(model_reporters={
             "AverageCongestion": self.get_average_congestion,
             "HastePercent": self.get_average_haste
         })
 
-        self.schedule = BaseScheduler(self)
-        self.grid = MultiGrid(width=total_width, height=total_height, torus=False)
+        self.schedule = CityScheduler(self)
+        self._grid = None
+        self.layout = CityLayout.get(n_roads_horizontal, n_roads_vertical, road_width, building_width,
+                                     building_height, route_cache_dir=route_cache_dir)
         self.road_graph, self.starting_points, self.end_points = self.initialize_grid()
+        self.routes = self.layout.routes
+
+        self.spawner = Spawner(self.layout, self.road_grid, self.spawn_random, self.route_random,
+                               max_waiting=cars_per_second)
+
+        self.car_engine = None
+        if engine == "vectorized":
+            self.car_engine = VectorizedEngine(self)
+        elif engine == "compiled":
+            # imported here as importing Numba takes longer than building a small model
+            from kernels import compiled_move_cars
+            self.car_engine = VectorizedEngine(self, kernel=compiled_move_cars)
+        elif engine == "districts":
+            from districts import DistrictEngine
+            self.car_engine = DistrictEngine(self, districts)
+
+    @property
+    def grid(self):
+        '''
+        Mesa MultiGrid with buildings, traffic lights and cars, as used by the visualisation.
+        It is built on first access and from then on kept up to date by the road grid.
+        '''
+        if self._grid is None:
+            grid = MultiGrid(width=self.layout.width, height=self.layout.height, torus=False)
+            self.create_buildings(grid)
+            for traffic_light in self.agents:
+                grid.place_agent(traffic_light, pos=traffic_light.pos)
+            for agent in self.schedule.cars.values():
+                grid.place_agent(agent, pos=agent.pos)
+            self.road_grid.mirror = grid
+            self._grid = grid
+        return self._grid
 
     def get_average_congestion(self):
-        all_congestion = [agent.congestion for agent in self.schedule.agents if isinstance(agent, CarAgent)]
-        return 100 - 100 * (sum(all_congestion) / len(all_congestion))
+        if self.num_car_agents == 0:
+            return 0.0
+        return 100 - 100 * (self.congestion_sum / self.num_car_agents)
 
     def get_average_haste(self):
-        all_haste = [agent.haste for agent in self.schedule.agents if isinstance(agent, CarAgent)]
-        return 100 * np.mean(all_haste)
+        if self.num_car_agents == 0:
+            return 0.0
+        return 100 * self.haste_sum / self.num_car_agents
 
     def get_new_unique_id(self):
         self.unique_id += 1
         return self.unique_id
 
     def initialize_grid(self):
-        road_pos = self.create_buildings()
-        road_graph = self.create_road_graph()
+        self.road_grid = RoadGrid(self.layout)
         self.create_intersections()
-        starting_points = self.get_starting_points(road_pos[1], road_pos[2])
-        end_points = self.get_end_points(road_pos[1], road_pos[2])
-        return road_graph, starting_points, end_points
+        return self.layout.road_graph, self.layout.starting_points, self.layout.end_points
 
-    def create_buildings(self):
+    def create_buildings(self, grid):
         """
-        Populates area between roads with buildings.
+        Populates area between roads of the given grid with buildings, only used for visualisation.
         """
-        road_pos_x = [building_width * i + road_width * (i - 1) for i in range(1, n_roads_horizontal + 1)] + \
-                     [building_width * i + 1 + road_width *
-                      (i - 1) for i in range(1, n_roads_horizontal + 1)]
-        road_pos_y = [building_height * i + road_width * (i - 1) for i in range(1, n_roads_vertical + 1)] + \
-                     [building_height * i + 1 + road_width *
-                      (i - 1) for i in range(1, n_roads_vertical + 1)]
-        road_pos = set(road_pos_x + road_pos_y)
-
-        for x, y in self.grid.empties.copy():
-            if not (x in road_pos or y in road_pos):  # not a road -> place building
-                building = BuildingAgent(
-                    unique_id=self.get_new_unique_id(), model=self, pos=(x, y))
-                self.grid.place_agent(building, pos=(x, y))
-
-        return road_pos, road_pos_x, road_pos_y
+        for pos in self.layout.building_cells:
+            building = BuildingAgent(unique_id=self.get_new_unique_id(), model=self, pos=pos)
+            grid.place_agent(building, pos=pos)
 
     def create_intersections(self):
-        intersection_pos_x = [building_width * i + road_width *
-                              (i - 1) for i in range(1, n_roads_horizontal + 1)]
-        intersection_pos_y = [building_height * i + road_width *
-                              (i - 1) for i in range(1, n_roads_vertical + 1)]
-        intersections = set((x, y)
-                            for x in intersection_pos_x for y in intersection_pos_y)
-
-        for intersection_pos in intersections:
+        """
+        Creates the IntersectionAgents and their traffic lights. The lights are switched by a SignalPlan instead of
+        stepping the intersections, which also keeps the state of the TrafficLightAgents up to date.
+        """
+        for intersection_pos in self.layout.intersections:
             intersection = IntersectionAgent(unique_id=self.get_new_unique_id(),
                                              model=self,
                                              pos=intersection_pos,
                                              green_light_duration=self.green_light_duration)
             self.intersections.append(intersection)
-            self.schedule.add(intersection)
 
             for traffic_light in intersection.traffic_lights:
-                self.grid.place_agent(traffic_light, pos=traffic_light.pos)
                 self.schedule.add(traffic_light)
                 self.agents.append(traffic_light)
 
-    def get_starting_points(self, road_pos_x, road_pos_y):
+        self.signal_plan = SignalPlan.from_positions(
+            self.road_grid, self.layout.intersections, self.green_light_duration,
+            offsets=0 if self.signal_offsets is None else self.signal_offsets,
+            traffic_lights=[intersection.traffic_lights for intersection in self.intersections])
+
+    def spawn_demand(self):
         """
-        Create points of entry on the grid for the car agents 
+        Number of new cars that want to enter the grid in a step.
         """
-        starting_points_top = [(x, self.grid.height - 1)
-                               for x in road_pos_x if x % 2 == 0]
-        starting_points_bottom = [(x, 0) for x in road_pos_x if x % 2 != 0]
-
-        starting_points_left = [(0, y) for y in road_pos_y if y % 2 == 0]
-        starting_points_right = [(self.grid.width - 1, y)
-                                 for y in road_pos_y if y % 2 != 0]
+        return self.cars_per_second if self.num_car_agents < self.max_car_agents else 0
 
-        return starting_points_top + starting_points_bottom + starting_points_left + starting_points_right
-
-    def get_end_points(self, road_pos_x, road_pos_y):
+    def create_car_agents(self, demand):
         """
-        Create points of exit on the grid for the car agents
+        Creates the new cars of a step: demand more cars want to enter the grid, the spawner places the ones that find
+        a free entry point, with a random end point and a random shortest path from the route table.
         """
-        end_points_top = [(x, self.grid.height - 1)
-                          for x in road_pos_x if x % 2 != 0]
-        end_points_bottom = [(x, 0) for x in road_pos_x if x % 2 == 0]
-
-        end_points_left = [(0, y) for y in road_pos_y if y % 2 != 0]
-        end_points_right = [(self.grid.width - 1, y)
-                            for y in road_pos_y if y % 2 == 0]
-
-        return end_points_top + end_points_bottom + end_points_left + end_points_right
-
-    def create_car_agent(self):
+        paths = self.spawner.spawn(demand, self.max_car_agents - self.num_car_agents)
+        if self.profiler is not None:
+            self.profiler.count("spawn_waiting", self.spawner.waiting)
+            self.profiler.count("spawn_dropped", self.spawner.dropped)
+        for cells in paths:
+            self.create_car_agent(cells)
+
+    def create_car_agent(self, cells):
         """
-        Creates a new agent, 
-        Picks a random starting point and ending point,
-        Picks random shortest path and places agent.
+        Creates a new agent at the start of the path cells, an array of road cells.
         """
-        start_point = random.choice(self.starting_points)
-        # if the starting cell is not empty, pick a new one
-        while not self.grid.is_cell_empty(start_point):
-            start_point = random.choice(self.starting_points)
-
-        distance = 0
-        while distance < road_width:
-            end_point = random.choice(
-                [point for point in self.end_points if point is not start_point])
-            distance = euclidean(end_point, start_point)
-
-        path = random.choice(list(nx.all_shortest_paths(
-            self.road_graph, start_point, end_point)))
-
-        agent = CarAgent(unique_id=self.get_new_unique_id(),
-                         model=self, path=path, max_velocity=self.max_velocity, tolerance=self.tolerance)
-
-        self.grid.place_agent(agent, pos=path[0])
-        self.schedule.add(agent)
+        if self.car_engine is not None:
+            self.car_engine.add_car(self.get_new_unique_id(), cells, self.max_velocity, self.tolerance)
+        else:
+            road_cells = self.road_grid.road_cells
+            agent = CarAgent(unique_id=self.get_new_unique_id(), model=self,
+                             path=[road_cells[cell] for cell in cells.tolist()], max_velocity=self.max_velocity,
+                             tolerance=self.tolerance)
+
+            self.road_grid.place_agent(agent, pos=agent.path[0])
+            self.schedule.add(agent)
+            self.congestion_sum += agent.congestion
         self.num_car_agents += 1
 
+    def is_cell_empty(self, pos):
+        return self.road_grid.is_cell_empty(pos)
+
     def step(self):
         ''' Advances the model by one step and if the maximum amount of car agents hasn't been reached 
         car_per_second agents will be generated'''
 
-        self.schedule.step()
-        if self.num_car_agents < self.max_car_agents:
-            for _ in range(self.cars_per_second):
-                self.create_car_agent()
-        self.datacollector.collect(self)
-
-    def create_road_graph(self, draw=False):
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.start_step(self.num_car_agents)
+
+        self.signal_plan.step()
+        self.schedule.step_intersections()
+        if profiler is not None:
+            profiler.lap("signals")
+        cars = self.num_car_agents
+        self.schedule.step_cars()
+        if self.car_engine is not None:
+            self.car_engine.step()
+        self.schedule.advance()
+        if profiler is not None:
+            profiler.lap("cars")
+            profiler.count("destroyed", cars - self.num_car_agents)
+
+        cars = self.num_car_agents
+        self.create_car_agents(self.spawn_demand())
+        if self.car_engine is not None:
+            self.car_engine.append_new_cars()
+        if profiler is not None:
+            profiler.lap("spawn")
+            profiler.count("spawned", self.num_car_agents - cars)
+
+        if self.schedule.steps % self.collect_every == 0:
+            self.datacollector.collect(self)
+        if self.trajectories is not None:
+            self.trajectories.record()
+        if profiler is not None:
+            profiler.lap("collect")
+            profiler.end_step()
+
+    def get_car_state(self):
         """
-        Create the roads on where the car agents can drive on.
+        Returns the state of all cars as a dictionary of arrays, in activation order: velocity, max_velocity,
+        velocity_sum, max_velocity_sum, haste, steps, tolerance, cell, the road cell of the car, and next_cell, the road
+        cell that follows it on the path (-1 at the end of the path).
         """
-        graph = nx.DiGraph()
-
-        roads = list(self.grid.empties)
-        roads.sort()
-
-        horizontal_paths_index = [n_roads_horizontal * building_height * road_width * i
-                                  + road_width * total_width * (i - 1)
-                                  for i in range(1, n_roads_vertical + 1)]
-
-        horizontal_paths_left = [roads[i:i + total_width]
-                                 for i in horizontal_paths_index]
-        horizontal_paths_right = [
-            roads[i + total_width:i + 2 * total_width] for i in horizontal_paths_index]
-
-        vertical_paths_down = [[(y, x) for x, y in road]
-                               for road in horizontal_paths_left]
-        vertical_paths_up = [[(y, x) for x, y in road]
-                             for road in horizontal_paths_right]
-
-        reversed = horizontal_paths_left + vertical_paths_up
-        unchanged = horizontal_paths_right + vertical_paths_down
-        combined = reversed + unchanged
-
-        for path in reversed:
-            nx.add_path(graph, path)
-        graph = graph.reverse()
-        for path in unchanged:
-            nx.add_path(graph, path)
-
-        if draw:
-            positions = {coord: coord for path in combined for coord in path}
-            nx.draw(graph, pos=positions, node_size=100)
-            plt.gca().set_aspect('equal', adjustable='box')
-            plt.show()
+        if self.car_engine is not None:
+            return self.car_engine.get_car_state()
+        cars = list(self.schedule.cars.values())
+        state = {name: np.array([getattr(car, name) for car in cars])
+                 for name in ("velocity", "max_velocity", "velocity_sum", "max_velocity_sum", "haste", "steps",
+                              "tolerance")}
+        state["cell"] = np.array([car.path_cells[car.pos_i] for car in cars], dtype=np.int64)
+        state["next_cell"] = np.array([car.path_cells[car.pos_i + 1] if car.pos_i + 1 < len(car.path) else -1
+                                       for car in cars], dtype=np.int64)
+        return state
+
+    def is_gridlocked(self):
+        """
+        Returns True if no car will ever move again: no new car can enter (max_car_agents is reached, or no car waits
+        or comes or no entry point is free, see Spawner.can_spawn) and every car stands still with another car on the
+        next cell of its path. A car in front of a car cannot accelerate, whatever the traffic lights do, so the cars
+        only keep updating their congestion and haste. A car standing still in front of an empty road may still move
+        after a change of its maximum velocity, so it does not count as gridlocked.
+        """
+        if self.num_car_agents == 0 or self.spawner.can_spawn(self.spawn_demand(),
+                                                              self.max_car_agents - self.num_car_agents):
+            return False
+        state = self.get_car_state()
+        return not state["velocity"].any() and (state["next_cell"] != -1).all() and \
+            (self.road_grid.car_at[state["next_cell"]] != -1).all()
+
+    def is_steady(self, window, threshold):
+        """
+        Returns True if the last window collected values of AverageCongestion are stationary: their standard deviation
+        and the difference between the means of both halves of the window are below threshold.
+        """
+        series = self.datacollector.model_vars["AverageCongestion"]
+        if len(series) < window:
+            return False
+        recent = np.array(series[-window:])
+        half = window // 2
+        return recent.std() < threshold and abs(recent[:half].mean() - recent[half:].mean()) < threshold
+
+    def extrapolate_gridlock(self, offsets):
+        """
+        Returns the model variables of a gridlocked model (see is_gridlocked) offsets steps ahead, without stepping it.
 
-        # get shortest path using nx.shortest_path(graph, (0, 86), (20, 0))
-        return graph
+        The velocities stay 0, so the congestion of every car follows from its running sums. The haste of a car is
+        replaced by its expected value, the haste probability while its congestion is below its tolerance, keeping
+        the maximum velocities as they are.
+        """
+        state = self.get_car_state()
+        offsets = np.asarray(offsets)[:, None]
+        steps = state["steps"] + offsets
+        velocity_sum = state["velocity_sum"].astype(float)
+        congestion = velocity_sum / (state["max_velocity_sum"] + offsets * state["max_velocity"])
+        haste_probability = velocity_sum / steps / state["max_velocity"]
+        haste = np.where(steps > 10, np.where(congestion < state["tolerance"], haste_probability, 0.0), state["haste"])
+        return {"AverageCongestion": 100 - 100 * congestion.sum(axis=1) / self.num_car_agents,
+                "HastePercent": 100 * haste.sum(axis=1) / self.num_car_agents}
+
+    def run(self, max_steps, early_stopping=None, window=100, threshold=0.5, check_every=10, checkpoint=None,
+            checkpoint_every=1000):
+        """
+        Steps the model until max_steps steps have been made and returns the collected model variables as a dictionary
+        of arrays, one per reporter.
+
+        Arguments:
+            - early_stopping: None makes every step. "gridlock" stops once the model is gridlocked (see is_gridlocked)
+              and fills the rest of the series with extrapolate_gridlock. "steady" also stops once AverageCongestion is
+              stationary (see is_steady) and fills the rest of every series with its mean over the last window, or with
+              extrapolate_gridlock if all cars stand still.
+            - window, threshold: arguments of is_steady, window counts collected values
+            - check_every: number of steps between two checks
+            - checkpoint: optional path where a Snapshot of the model is saved every checkpoint_every steps, an
+              interrupted run continues with Snapshot.load(checkpoint).restore().run(max_steps, checkpoint=checkpoint)
+
+        The series have the same length with or without early stopping, the filled values are also added to the
+        datacollector. The HastePercent filled after a gridlock is the expected value of extrapolate_gridlock, a single
+        run would draw the haste of every car and typically lies a few points away from it. The step at which the
+        model stopped and the reason ("gridlock", "steady" or None) are kept in stopped_at and stop_reason.
+        """
+        if early_stopping not in (None, "gridlock", "steady"):
+            raise ValueError(f"Unknown early_stopping {early_stopping!r}, expected None, 'gridlock' or 'steady'")
+        if checkpoint is not None:
+            # imported here as the snapshot module itself imports CityModel from this module
+            from snapshot import Snapshot
+        self.stop_reason = None
+        while self.schedule.steps < max_steps:
+            self.step()
+            if checkpoint is not None and self.schedule.steps % checkpoint_every == 0:
+                Snapshot.of(self).save(checkpoint)
+            if early_stopping is None or self.schedule.steps % check_every != 0 or self.schedule.steps == max_steps:
+                continue
+            if self.is_gridlocked():
+                self.stop_reason = "gridlock"
+                break
+            if early_stopping == "steady" and self.is_steady(window, threshold):
+                self.stop_reason = "steady"
+                break
+        self.stopped_at = self.schedule.steps
+
+        model_vars = self.datacollector.model_vars
+        if self.stop_reason is not None:
+            offsets = np.arange(self.stopped_at + 1, max_steps + 1)
+            offsets = offsets[offsets % self.collect_every == 0] - self.stopped_at
+            # a steady model in which no car moves nor enters is extrapolated as a gridlock
+            standing_still = self.num_car_agents >= self.max_car_agents and not self.get_car_state()["velocity"].any()
+            if self.stop_reason == "gridlock" or standing_still:
+                filled = self.extrapolate_gridlock(offsets)
+            else:
+                filled = {name: np.full(len(offsets), np.mean(values[-window:])) for name, values in model_vars.items()}
+            for name, values in filled.items():
+                model_vars[name].extend(values.tolist())
+        return {name: np.array(values) for name, values in model_vars.items()}
 
 
 def run_experiment(number_iterations, max_steps, experiment_name, green_light_duration, max_cars_agents,
-                   tolerance):
+                   tolerance, n_workers=1, seed=1, early_stopping=None, common_random_numbers=False, cache=None):
     """ Takes:
         number of runs, maximum steps per run and experiment name +
-        parameters (max_velocity, green_light_duration,green_light_duration, max_cars_agents, tolerance)
-
-        Outputs a list with all the runs congestions data, with the last element of the list being the model parameters,
-        Saves the output as "experiment_name.p" and returns it
+        parameters (max_velocity, green_light_duration,green_light_duration, max_cars_agents, tolerance) +
+        number of worker processes (None uses all cores) and the base seed from which every run gets its own seed +
+        early stopping of the runs in gridlock or steady state (see CityModel.run) +
+        common_random_numbers, giving the i-th run of every green light duration the same seed +
+        cache, a ResultCache or its directory, from which the runs already simulated are taken (see runner.iter_jobs)
+
+        Streams the congestion data of every run into a ResultStore in the directory "experiment_name" as soon as it
+        finishes, with the parameters of the experiment as metadata, and returns the store.
+        If the directory already holds part of the same experiment, the remaining runs are added to it.
     """
     tolerances = [0, 0.25, 0.5, 0.75, 1]
     car_agents = [10, 20, 50, 100, 200]
     green_light_duration = [2, 3, 5, 7, 8]
-    all_data = [green_light_duration]
-    for gld in green_light_duration:
-        for _ in tqdm(range(number_iterations)):
-            model = CityModel(green_light_duration=gld, max_car_agents=max_cars_agents,
-                              tolerance=tolerance)
-            for _ in range(max_steps):
-                model.step()
-
-            # Returns a pandas.DataFrame
-            data = model.datacollector.get_model_vars_dataframe()
-            data = data.iloc[:, 0].values
-            all_data.append(data)
-
-    # The final output is a list with all of the congestion data from each run,
-    # in a list object, and the parameters of the run as the last item of the list, in a dic
-    name = experiment_name + ".pickle"
-    pickle.dump(all_data, open(name, "wb"))
-    return all_data
-
-
-def stats(data):
-    mean = np.average(data[0:-1])
-    std = np.std(data[0:-1])
-    counter = 0
-    all_grid_lock = []
-    for l in data[0:-1]:
-        if l[-2] > mean + std:
-            counter += 1
-            all_grid_lock.append(l)
-    mean_lock = np.average(all_grid_lock)
+    metadata = dict(number_iterations=number_iterations, max_steps=max_steps,
+                    green_light_duration=green_light_duration, max_car_agents=max_cars_agents,
+                    tolerance=tolerance, seed=seed)
+    if early_stopping is not None:
+        metadata["early_stopping"] = early_stopping
+    if common_random_numbers:
+        metadata["common_random_numbers"] = True
+    parameter_sets = [dict(green_light_duration=gld, max_car_agents=max_cars_agents, tolerance=tolerance)
+                      for gld in green_light_duration]
+    # imported here as the runner itself imports CityModel from this module
+    from runner import iter_jobs
+
+    with ResultStore(experiment_name, metadata=metadata) as store:
+        for result in iter_jobs(parameter_sets, number_iterations, max_steps, seed=seed, n_workers=n_workers,
+                                start=len(store), early_stopping=early_stopping,
+                                common_random_numbers=common_random_numbers, cache=cache):
+            store.append({"AverageCongestion": result["AverageCongestion"]})
+    return store
+
+
+def stats(data, name="AverageCongestion"):
+    """ Takes:
+        a list of runs (without its last element, as in the old pickles) or a ResultStore, whose series name is read
+        block by block
+
+        Prints the mean and standard deviation over all values and the runs that end in a jam, their second to last
+        value being above mean + std, and returns those runs, memory-mapped for a ResultStore.
+    """
+    from dataset import iter_blocks, iter_runs, run_stats
+
+    if isinstance(data, ResultStore):
+        blocks = lambda: iter_blocks(data, name)
+    else:
+        data = np.asarray(data[0:-1], dtype=np.float64)
+        blocks = lambda: iter([data])
+    mean, std, jams, mean_lock = run_stats(blocks)
+    runs = len(data)
+    counter = len(jams)
     print("Mean: ", mean, "Std: ", std, "Mean Jam: ",
-          mean_lock, "Number of jams: ", counter, "-", counter / len(data[0:-1]), "%")
-    return all_grid_lock
+          mean_lock, "Number of jams: ", counter, "-", counter / runs, "%")
+    if isinstance(data, ResultStore):
+        return list(iter_runs(data, name, jams))
+    return [data[run] for run in jams]
 
 
 def main():
+    # imported here to keep plotting out of the simulation imports
+    import matplotlib.pyplot as plt
+    from dataset import plot_bands
+
     iterations = 1000
     steps = 1000
     green_light_duration = ""
@@ -307,13 +491,13 @@ def main():
 
     experiment_name = f'data_i{iterations}_s{steps}_gld{green_light_duration}_mca{max_car_agents}_t{str(tolerance).replace(".", "")}'
     print(experiment_name)
-    run_experiment(number_iterations=iterations,
-                   max_steps=steps,
-                   experiment_name=experiment_name,
-                   green_light_duration=green_light_duration,
-                   max_cars_agents=max_car_agents,
-                   tolerance=tolerance)
-    all_data = pickle.load(open(experiment_name + ".pickle", "rb"))
+    store = run_experiment(number_iterations=iterations,
+                           max_steps=steps,
+                           experiment_name=experiment_name,
+                           green_light_duration=green_light_duration,
+                           max_cars_agents=max_car_agents,
+                           tolerance=tolerance,
+                           n_workers=None)
     # for _data in all_data:
     #     if isinstance(_data, list):
     #         plt.plot(_data[10:len(_data)])
@@ -324,15 +508,10 @@ def main():
     #     plt.plot(_data)
     # plt.show()
 
-    car_agents = all_data.pop(0)
-    all_data = np.array(all_data).reshape((len(car_agents), iterations, steps))
-    for i, data_var in enumerate(all_data):
-        mean = np.mean(data_var, axis=0)
-        std = np.std(data_var, axis=0)
-        xs = range(mean.size)
-
-        plt.plot(xs, mean, label=car_agents[i])
-        plt.fill_between(xs, mean - std, mean + std, alpha=0.2)
+    car_agents = store.metadata["green_light_duration"]
+    # streamed from the store block by block, the runs of every parameter value are consecutive
+    plot_bands(store, "AverageCongestion", iterations, car_agents)
+    xs = range(steps)
     plt.xlabel("Timesteps")
     plt.ylabel("Congestion")
     plt.title(f"{iterations} iterations, tolerance={tolerance}, green light duration = {green_light_duration}")
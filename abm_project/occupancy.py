@@ -0,0 +1,93 @@
+import numpy as np
+
+'''
+This module describes the road occupancy layer CityModel uses during the simulation:
+
+- RoadGrid
+
+Only road cells are tracked, in two integer arrays indexed by road cell, so the cars can find the next
+obstacle along their path with an array slice instead of collecting agents from a Mesa MultiGrid.
+'''
+
+
+class RoadGrid:
+    '''
+    Occupancy of the road cells of the city.
+
+    Arguments:
+        - layout: CityLayout of the city, its road_cells and cell_index define the cell index
+        - copies: number of independent copies of the city, copy i holds the road cells i * n_cells to
+                  (i + 1) * n_cells - 1, used by BatchCityModel
+
+    Attributes:
+        - car_at: unique_id of the car on every road cell, -1 if empty
+        - light_at: state of the traffic light on every road cell (0 green, 1 yellow, 2 red), -1 if there is none
+        - blocked: True for every road cell with a car or a traffic light
+        - mirror: optional Mesa grid that is kept up to date with the cars, used for visualisation
+    '''
+    def __init__(self, layout, copies=1):
+        self.width = layout.width
+        self.height = layout.height
+        self.road_cells = layout.road_cells
+        self.cell_index = layout.cell_index
+        self.n_cells = len(self.road_cells)
+
+        self.car_at = np.full(copies * self.n_cells, -1, dtype=np.int64)
+        self.light_at = np.full(copies * self.n_cells, -1, dtype=np.int64)
+        self.blocked = np.zeros(copies * self.n_cells, dtype=bool)
+        self.mirror = None
+
+    def cells_of(self, path):
+        """
+        Converts a list of (x,y) coordinates into an array of cell indices.
+        """
+        return self.cell_index[tuple(np.array(path).T)]
+
+    def is_cell_empty(self, pos):
+        return not self.blocked[self.cell_index[pos]]
+
+    def set_light(self, pos, state):
+        cell = self.cell_index[pos]
+        self.light_at[cell] = state
+        self.blocked[cell] = True
+
+    def set_lights(self, cells, states):
+        self.light_at[cells] = states
+        self.blocked[cells] = True
+
+    def first_obstacle(self, cells):
+        """
+        Returns the position in cells of the first car or traffic light, -1 if the cells are free.
+        """
+        blocked = self.blocked[cells]
+        if not len(blocked):
+            return -1
+        first = blocked.argmax()
+        return first if blocked[first] else -1
+
+    def place_cars(self, cells, unique_ids):
+        self.car_at[cells] = unique_ids
+        self.blocked[cells] = True
+
+    def remove_cars(self, cells):
+        self.car_at[cells] = -1
+        self.blocked[cells] = self.light_at[cells] != -1
+
+    def place_agent(self, agent, pos):
+        self.place_cars(self.cell_index[pos], agent.unique_id)
+        agent.pos = pos
+        if self.mirror is not None:
+            self.mirror.place_agent(agent, pos)
+
+    def move_agent(self, agent, pos):
+        self.remove_cars(self.cell_index[agent.pos])
+        self.place_cars(self.cell_index[pos], agent.unique_id)
+        if self.mirror is not None:
+            self.mirror.move_agent(agent, pos)
+        agent.pos = pos
+
+    def remove_agent(self, agent):
+        self.remove_cars(self.cell_index[agent.pos])
+        if self.mirror is not None:
+            self.mirror.remove_agent(agent)
+        agent.pos = None
@@ -0,0 +1,84 @@
+import time
+
+import pandas as pd
+
+'''
+This module describes the instrumentation CityModel(profile=True) uses to record where the time of a step goes:
+
+- StepProfiler
+
+Usage:
+
+- model = CityModel(profile=True)
+- Run the model for a desired number of steps using model.step()
+- Collect the per step timings and event counts: profile = model.profiler.get_dataframe()
+'''
+
+
+class StepProfiler:
+    '''
+    Records, for every step of a CityModel, the time spent in each phase and the number of events.
+
+    Phases:
+        - signals: switching the traffic lights (SignalPlan) and stepping other scheduled agents
+        - cars: stepping the cars, CarAgents or the VectorizedEngine
+        - spawn: creating new cars, including the path search
+        - collect: collecting the model variables
+
+    Events:
+        - car_agents: number of cars at the start of the step
+        - spawned: cars created
+        - spawn_waiting: cars waiting to enter at the end of the step, see Spawner
+        - spawn_dropped: cars of the demand of the step dropped as too many cars were already waiting
+        - destroyed: cars that left the grid
+
+    Besides the per step rows, the cumulative time and number of calls of every phase are kept in totals and calls.
+    '''
+    phases = ("signals", "cars", "spawn", "collect")
+    events = ("car_agents", "spawned", "spawn_waiting", "spawn_dropped", "destroyed")
+
+    def __init__(self):
+        self.rows = []
+        self.totals = dict.fromkeys(self.phases, 0.0)
+        self.calls = dict.fromkeys(self.phases, 0)
+        self.row = None
+        self.last = None
+
+    def start_step(self, car_agents):
+        self.row = dict.fromkeys(self.phases, 0.0)
+        self.row.update(dict.fromkeys(self.events, 0))
+        self.row["car_agents"] = car_agents
+        self.last = time.perf_counter()
+
+    def lap(self, phase):
+        """
+        Adds the time since the previous lap (or the start of the step) to phase.
+        """
+        now = time.perf_counter()
+        self.row[phase] += now - self.last
+        self.totals[phase] += now - self.last
+        self.calls[phase] += 1
+        self.last = now
+
+    def count(self, event, n=1):
+        # events outside of a step, e.g. create_car_agents called directly, are not recorded
+        if self.row is not None:
+            self.row[event] += n
+
+    def end_step(self):
+        self.rows.append(self.row)
+        self.row = None
+
+    def get_dataframe(self):
+        """
+        Returns one row per step, with the time of every phase in seconds and the event counts.
+        """
+        return pd.DataFrame(self.rows, columns=self.phases + self.events)
+
+    def get_summary(self):
+        """
+        Returns the cumulative time, number of calls and mean time per call of every phase.
+        """
+        summary = pd.DataFrame({"time": self.totals, "calls": self.calls})
+        summary["time_per_call"] = summary["time"] / summary["calls"].clip(lower=1)
+        return summary
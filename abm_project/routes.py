@@ -0,0 +1,182 @@
+import hashlib
+import os
+import random
+
+import networkx as nx
+import numpy as np
+
+'''
+This module describes the route table used by CityModel to give car agents a random shortest path:
+
+- RouteTable
+
+For every exit point the table stores the shortest-path DAG towards it: the distance of each road cell
+to the exit and the number of shortest paths from that cell, built with one breadth first search from all exits
+at once, one array operation per distance level. A uniformly random shortest path between
+any entry and the exit is then sampled in O(path length), walking the DAG and choosing every next cell
+with probability proportional to its number of shortest paths, instead of enumerating all of them with
+nx.all_shortest_paths. Only the cells with more than one successor (the intersections) take a decision, the
+straight runs between them are copied at once.
+'''
+
+# largest table (end points x road cells) kept as lists for random_path
+LIST_TABLE_SIZE = 2 ** 20
+
+
+class RouteTable:
+    '''
+    Shortest-path DAGs of a road graph towards a set of end points.
+
+    Arguments:
+        - road_graph: directed graph of road cells created by CityModel.create_road_graph
+        - end_points: (x,y) exit points of the grid
+        - cache_dir: optional directory where the table is stored, keyed by the grid geometry,
+          so it is only computed once per layout
+
+    The following arrays are stored, rows follow end_points and columns the sorted road cells:
+        - distance: number of moves to the end point, -1 if the end point can not be reached (int32)
+        - path_count: number of shortest paths to the end point (as float, it overflows integers on large grids)
+    '''
+    def __init__(self, road_graph, end_points, cache_dir=None):
+        self.nodes = sorted(road_graph.nodes)
+        self.node_index = {node: i for i, node in enumerate(self.nodes)}
+        self.successors = [sorted(self.node_index[succ] for succ in road_graph.successors(node))
+                           for node in self.nodes]
+        self.end_points = list(end_points)
+        self.end_index = {end: i for i, end in enumerate(self.end_points)}
+        # forced_run of the cells random_nodes came across
+        self.runs = {}
+
+        path = None
+        if cache_dir is not None:
+            path = os.path.join(cache_dir, f"routes_{self.geometry_key()}.npz")
+        if path is not None and os.path.exists(path):
+            with np.load(path) as cached:
+                self.distance, self.path_count = cached["distance"], cached["path_count"]
+        else:
+            self.distance, self.path_count = self.build()
+            if path is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                # workers sharing cache_dir load the file as soon as it exists, so it appears complete at once
+                temporary = f"{path}.{os.getpid()}.tmp.npz"
+                np.savez(temporary, distance=self.distance, path_count=self.path_count)
+                os.replace(temporary, path)
+
+        # plain lists are much faster than numpy arrays for the per-cell walk in random_path, but on large grids
+        # they take several times the memory of the arrays, there the rows are read through memoryviews instead
+        if self.distance.size <= LIST_TABLE_SIZE:
+            self._distance = self.distance.tolist()
+            self._path_count = self.path_count.tolist()
+        else:
+            self._distance = [memoryview(row) for row in self.distance]
+            self._path_count = [memoryview(row) for row in self.path_count]
+
+    def geometry_key(self):
+        """
+        Hash of the road cells, their connections and the end points.
+        """
+        key = hashlib.sha1()
+        key.update(np.array(self.nodes, dtype=np.int64).tobytes())
+        for succ in self.successors:
+            key.update(np.array(succ + [-1], dtype=np.int64).tobytes())
+        key.update(np.array(self.end_points, dtype=np.int64).tobytes())
+        return key.hexdigest()
+
+    def build(self):
+        """
+        Breadth first search from all end points at once over the reversed road graph. The cells one move further
+        from an end point are the unvisited predecessors of the current level, and every cell adds its number of
+        shortest paths to its predecessors one move further.
+        """
+        n_nodes, n_ends = len(self.nodes), len(self.end_points)
+        sources = np.repeat(np.arange(n_nodes), [len(succ) for succ in self.successors])
+        targets = np.array([next_node for succ in self.successors for next_node in succ], dtype=np.int64)
+        # (max predecessors, cells) array of the predecessors of every cell, padded with the extra cell n_nodes
+        order = np.argsort(targets, kind='stable')
+        sources, targets = sources[order], targets[order]
+        rank = np.arange(len(targets)) - np.searchsorted(targets, targets)
+        predecessors = np.full((rank.max() + 1 if len(rank) else 1, n_nodes), n_nodes, dtype=np.int64)
+        predecessors[rank, targets] = sources
+
+        # one row per end point plus a column for the padding cell, which is never reached; in the flat views,
+        # cell node of end point i is at i * (n_nodes + 1) + node
+        stride = n_nodes + 1
+        distance = np.full((n_ends, stride), -1, dtype=np.int32)
+        path_count = np.zeros((n_ends, stride), dtype=np.float64)
+        distance[:, n_nodes] = -2
+        dist, count = distance.reshape(-1), path_count.reshape(-1)
+        frontier = np.array([self.node_index[end] for end in self.end_points], dtype=np.int64) \
+            + np.arange(n_ends) * stride
+        dist[frontier], count[frontier] = 0, 1
+        level = 0
+        while len(frontier):
+            ends, nodes = np.divmod(frontier, stride)
+            prev = (np.take(predecessors, nodes, axis=1) + ends * stride).ravel()
+            new = np.sort(prev[dist[prev] == -1])
+            dist[new] = level + 1
+            on_path = dist[prev] == level + 1
+            np.add.at(count, prev[on_path], np.tile(count[frontier], len(predecessors))[on_path])
+            # two cells of the level can share a predecessor
+            frontier = new[np.concatenate(([True], new[1:] != new[:-1]))] if len(new) else new
+            level += 1
+        return distance[:, :n_nodes], path_count[:, :n_nodes]
+
+    def random_path(self, start, end, rng=random):
+        """
+        Returns a uniformly random shortest path from start to end as a list of (x,y) coordinates.
+        """
+        nodes = self.nodes
+        return [nodes[node] for node in self.random_nodes(start, end, rng=rng)]
+
+    def random_nodes(self, start, end, rng=random):
+        """
+        Returns a uniformly random shortest path from start to end as a list of indices in nodes.
+
+        The runs of cells with a single successor are added at once, see forced_run, rng is only drawn from where
+        the path has more than one shortest continuation.
+        """
+        distance, path_count = self._distance[self.end_index[end]], self._path_count[self.end_index[end]]
+        node = self.node_index[start]
+        left = distance[node]
+        if left == -1:
+            raise nx.NetworkXNoPath(f"Target {end} cannot be reached from given sources")
+
+        path = [node]
+        runs = self.runs
+        while left > 0:
+            run = runs.get(node)
+            if run is None:
+                run = runs[node] = self.forced_run(node)
+            if run:
+                # every cell of the run is one move closer to the end point
+                if len(run) >= left:
+                    path += run[:left]
+                    break
+                path += run
+                node = run[-1]
+                left -= len(run)
+            options = [succ for succ in self.successors[node] if distance[succ] == left - 1]
+            if len(options) > 1:
+                r = rng.random() * path_count[node]
+                for node in options:
+                    r -= path_count[node]
+                    if r < 0:
+                        break
+            else:
+                node = options[0]
+            path.append(node)
+            left -= 1
+        return path
+
+    def forced_run(self, node):
+        """
+        Returns the cells that follow node as long as every cell has a single successor, the first cells of any path
+        leaving node.
+        """
+        run = []
+        successors = self.successors[node]
+        while len(successors) == 1 and len(run) < len(self.nodes):
+            node = successors[0]
+            run.append(node)
+            successors = self.successors[node]
+        return run
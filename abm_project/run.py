@@ -1,11 +1,20 @@
-from server import server
+import argparse
+
+from server import server, replay_server
 
 '''
 This script runs the main model, opening its visualization in a browser window 
 
 Usage:
     python3 run.py
+    python3 run.py --replay run.frames.gz, plays back a run recorded with frames.py
 '''
 
 if __name__ == '__main__':
-    server.launch()
+    parser = argparse.ArgumentParser(description="Visualize CityModel in the browser")
+    parser.add_argument("--replay", help="file recorded with frames.py to play back instead of running the model")
+    args = parser.parse_args()
+    if args.replay is not None:
+        replay_server(args.replay).launch()
+    else:
+        server.launch()
@@ -0,0 +1,198 @@
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from batch import BatchCityModel
+from cache import ResultCache
+from model import CityModel
+from snapshot import Snapshot
+
+'''
+This module runs independent CityModel simulations in parallel over a pool of worker processes:
+
+- iter_jobs: runs a list of (parameters, replicate) jobs and yields the collected series in job order
+- run_jobs: same as iter_jobs, returning a list
+- sweep: parallel counterpart of mesa's BatchRunner for parameter sweeps
+
+With batch_size, the runs are grouped and every group is simulated together in one BatchCityModel. With snapshot,
+every run continues a warmed up model saved as a Snapshot instead of starting from an empty city. With cache, the
+runs found in a ResultCache are not simulated again and the new ones are added to it.
+
+Every job gets its own seed, derived from a base seed and the position of the job, so the results do not
+depend on the number of workers or on the order in which the workers finish. With common_random_numbers the seed
+only depends on the replicate, so every parameter set is run with the same random streams, which reduces the variance
+of the differences between parameter sets (OFAT, Sobol).
+
+Usage:
+
+- series = run_jobs([{"max_car_agents": 100}, {"max_car_agents": 200}], number_iterations=10, max_steps=1000,
+                    n_workers=8)
+- data = sweep({"max_car_agents": [50, 100, 200]}, {"tolerance": 0.2}, iterations=10, max_steps=300)
+- data = sweep({"tolerance": [0.2, 0.5, 0.8]}, iterations=10, max_steps=1300, snapshot="warm.npz"), 1000 steps
+  after a snapshot taken at step 300
+- series = run_jobs(parameter_sets, 10, 1000, cache="results_cache"), a second call reads every run from the cache
+'''
+
+
+def job_seeds(seed, number_jobs):
+    """
+    Derives one independent integer seed per job from the base seed.
+    """
+    children = np.random.SeedSequence(seed).spawn(number_jobs)
+    return [int(child.generate_state(1)[0]) for child in children]
+
+
+def run_job(job):
+    """
+    Runs a single model with the given parameters and seed for max_steps steps, see CityModel.run for early_stopping.
+    If the job has a snapshot path, the model is restored from it with the seed and parameters, see Snapshot.restore.
+    Returns the collected model variables as a dictionary of arrays, one per reporter.
+    """
+    parameters, max_steps, seed, early_stopping, snapshot = job
+    if snapshot is None:
+        model = CityModel(seed=seed, **parameters)
+    else:
+        model = Snapshot.load(snapshot).restore(seed=seed, **parameters)
+    return model.run(max_steps, early_stopping=early_stopping)
+
+
+def run_batch_job(jobs):
+    """
+    Runs a list of jobs, all with the same max_steps and without early stopping, together in one BatchCityModel.
+    Returns the results of the jobs, in order, like run_job.
+    """
+    parameter_sets = [dict(parameters) for parameters, _, _, _, _ in jobs]
+    shared = {}
+    for name in ("collect_every", "route_cache_dir"):
+        values = {parameters.pop(name, None) for parameters in parameter_sets}
+        if len(values) > 1:
+            raise ValueError(f"All runs of a batch need the same {name}")
+        if values != {None}:
+            shared[name] = values.pop()
+    for parameters in parameter_sets:
+        # all engines give the same results
+        parameters.pop("engine", None)
+    model = BatchCityModel(parameter_sets, seeds=[seed for _, _, seed, _, _ in jobs], **shared)
+    return model.run(jobs[0][1])
+
+
+def iter_jobs(parameter_sets, number_iterations, max_steps, seed=1, n_workers=None, chunksize=None,
+              display_progress=True, start=0, early_stopping=None, common_random_numbers=False, batch_size=None,
+              snapshot=None, cache=None):
+    """ Takes:
+        a list of parameter dictionaries for CityModel, the number of runs per parameter set,
+        maximum steps per run, a base seed and the number of worker processes (defaults to all cores)
+
+        Runs every parameter set number_iterations times and yields the collected model variables of each run as soon as
+        it is available, ordered as the serial loop
+        "for parameters in parameter_sets: for replicate in range(number_iterations)".
+        The first start runs are skipped, which resumes an interrupted experiment with the same seeds.
+        With n_workers=1 the runs are executed in this process.
+        early_stopping ends the runs that are gridlocked or stationary early, see CityModel.run.
+        With common_random_numbers the i-th replicate of every parameter set gets the same seed.
+        With batch_size, up to batch_size consecutive runs are simulated together in one BatchCityModel, which gives
+        the same results; it does not support early_stopping and chunksize then counts batches.
+        With snapshot, the path of a Snapshot file, every run forks from the saved model with its own seed, the
+        parameter sets can then only hold the arguments of Snapshot.restore and max_steps includes the steps of the
+        snapshot.
+        With cache, a ResultCache or its directory, the runs already in the cache are taken from it (also from a
+        cached run with more steps) and only the others are simulated and then added to it.
+    """
+    jobs = [dict(parameters) for parameters in parameter_sets for _ in range(number_iterations)]
+    if common_random_numbers:
+        seeds = job_seeds(seed, number_iterations) * len(parameter_sets)
+    else:
+        seeds = job_seeds(seed, len(jobs))
+    jobs = list(zip(jobs, itertools.repeat(max_steps), seeds, itertools.repeat(early_stopping),
+                    itertools.repeat(snapshot)))[start:]
+    if batch_size is not None and (early_stopping is not None or snapshot is not None):
+        raise ValueError("early_stopping and snapshot are not supported with batch_size")
+    if cache is None:
+        yield from execute_jobs(jobs, n_workers, chunksize, display_progress, batch_size)
+        return
+
+    if not isinstance(cache, ResultCache):
+        cache = ResultCache(cache)
+    # the cached series are only read when their run is yielded, so a sweep keeps at most one of them in memory
+    cached = [job in cache for job in jobs]
+    results = execute_jobs([job for job, hit in zip(jobs, cached) if not hit], n_workers, chunksize,
+                           display_progress, batch_size)
+    for job, hit in zip(jobs, cached):
+        result = cache.get(job) if hit else None
+        if result is None:
+            # a cached run can also have been evicted by another process sharing the cache in the meantime
+            result = next(results) if not hit else run_job(job)
+            cache.put(job, result)
+        yield result
+
+
+def execute_jobs(jobs, n_workers, chunksize, display_progress, batch_size):
+    """
+    Runs the jobs, see iter_jobs, and yields their results in order.
+    """
+    # imported here as the worker processes import this module to run the jobs
+    from tqdm import tqdm
+
+    if n_workers is None:
+        n_workers = os.cpu_count()
+
+    if batch_size is None:
+        function, tasks = run_job, jobs
+    else:
+        function, tasks = run_batch_job, [jobs[i:i + batch_size] for i in range(0, len(jobs), batch_size)]
+
+    if n_workers == 1:
+        results = map(function, tqdm(tasks, disable=not display_progress))
+        yield from results if batch_size is None else itertools.chain.from_iterable(results)
+        return
+
+    if chunksize is None:
+        # a few chunks per worker keeps the workers busy without paying the inter-process overhead per run
+        chunksize = max(1, len(tasks) // (4 * n_workers))
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        results = tqdm(executor.map(function, tasks, chunksize=chunksize), total=len(tasks),
+                       disable=not display_progress)
+        yield from results if batch_size is None else itertools.chain.from_iterable(results)
+
+
+def run_jobs(parameter_sets, number_iterations, max_steps, seed=1, n_workers=None, chunksize=None,
+             display_progress=True, early_stopping=None, common_random_numbers=False, batch_size=None, snapshot=None,
+             cache=None):
+    """
+    Same as iter_jobs, but returns the results of all runs as a list.
+    """
+    return list(iter_jobs(parameter_sets, number_iterations, max_steps, seed=seed, n_workers=n_workers,
+                          chunksize=chunksize, display_progress=display_progress, early_stopping=early_stopping,
+                          common_random_numbers=common_random_numbers, batch_size=batch_size, snapshot=snapshot,
+                          cache=cache))
+
+
+def sweep(variable_parameters, fixed_parameters=None, iterations=1, max_steps=1000, seed=1, n_workers=None,
+          chunksize=None, display_progress=True, early_stopping=None, common_random_numbers=False,
+          batch_size=None, snapshot=None, cache=None):
+    """
+    Runs every combination of variable_parameters (a dictionary of parameter names to lists of values)
+    iterations times, like mesa's BatchRunner, but spread over n_workers processes.
+
+    Returns a DataFrame with one row per run: the variable parameters, "Run" and the value of every
+    model reporter at the last step.
+    """
+    names = list(variable_parameters)
+    combinations = list(itertools.product(*(variable_parameters[name] for name in names)))
+    parameter_sets = [dict(fixed_parameters or {}, **dict(zip(names, values))) for values in combinations]
+    results = run_jobs(parameter_sets, iterations, max_steps, seed=seed, n_workers=n_workers, chunksize=chunksize,
+                       display_progress=display_progress, early_stopping=early_stopping,
+                       common_random_numbers=common_random_numbers, batch_size=batch_size, snapshot=snapshot,
+                       cache=cache)
+
+    records = []
+    runs = [values for values in combinations for _ in range(iterations)]
+    for run, (values, result) in enumerate(zip(runs, results)):
+        record = dict(zip(names, values))
+        record["Run"] = run
+        record.update({name: series[-1] for name, series in result.items()})
+        records.append(record)
+    return pd.DataFrame(records)
@@ -0,0 +1,84 @@
+from mesa import Agent
+
+from agent import CarAgent, IntersectionAgent
+
+'''
+This module describes the scheduler used by CityModel:
+
+- CityScheduler
+'''
+
+
+class CityScheduler:
+    '''
+    Activates the agents of a CityModel, keeping them in separate pools by type:
+
+        - intersections: IntersectionAgents, activated first, in the order they were added
+        - stepped: any other agent with a step method, activated next
+        - cars: CarAgents, activated last, in the order they were added
+        - passive: agents without a step of their own (TrafficLightAgents), never activated
+
+    This is the same activation order as a mesa BaseScheduler filled with intersections and traffic lights first and
+    cars as they enter the grid, without stepping the traffic lights. CityModel itself only adds traffic lights and
+    cars, its intersections are switched by a SignalPlan. The pools are insertion-ordered dictionaries, so adding
+    and removing an agent is O(1) and keeps the order of the others.
+
+    Offers the interface of mesa's BaseScheduler (add, remove, step, steps, time, agents, get_agent_count).
+    '''
+    def __init__(self, model):
+        self.model = model
+        self.steps = 0
+        self.time = 0
+        self.intersections = {}
+        self.stepped = {}
+        self.cars = {}
+        self.passive = {}
+
+    def pool(self, agent):
+        if isinstance(agent, CarAgent):
+            return self.cars
+        if isinstance(agent, IntersectionAgent):
+            return self.intersections
+        if type(agent).step is Agent.step:
+            return self.passive
+        return self.stepped
+
+    def add(self, agent):
+        pool = self.pool(agent)
+        if agent.unique_id in pool:
+            raise Exception("Agent with unique id {0} already added to scheduler".format(repr(agent.unique_id)))
+        pool[agent.unique_id] = agent
+
+    def remove(self, agent):
+        del self.pool(agent)[agent.unique_id]
+
+    def step(self):
+        self.step_intersections()
+        self.step_cars()
+        self.advance()
+
+    def step_intersections(self):
+        """
+        Activates the intersections and the other agents with a step, the first phase of step.
+        """
+        for intersection in list(self.intersections.values()):
+            intersection.step()
+        for agent in list(self.stepped.values()):
+            agent.step()
+
+    def step_cars(self):
+        # a car can only remove itself while stepping, so the snapshot never holds a removed car
+        for car in list(self.cars.values()):
+            car.step()
+
+    def advance(self):
+        self.steps += 1
+        self.time += 1
+
+    def get_agent_count(self):
+        return len(self.intersections) + len(self.stepped) + len(self.cars) + len(self.passive)
+
+    @property
+    def agents(self):
+        return list(self.intersections.values()) + list(self.passive.values()) + \
+               list(self.stepped.values()) + list(self.cars.values())
@@ -0,0 +1,210 @@
+import argparse
+import os
+
+import numpy as np
+
+from runner import iter_jobs
+from store import ResultStore
+
+try:
+    from SALib.analyze import sobol
+    from SALib.sample import saltelli
+except ImportError:
+    sobol = saltelli = None
+
+'''
+This module runs the Sobol sensitivity analysis of CityModel as a resumable pipeline:
+
+- SobolSweep
+
+The Saltelli samples are generated once and kept with the results. Every model evaluation (sample, replicate)
+is run in parallel through the runner and its last reporter values are streamed into a ResultStore, so an
+interrupted sweep continues where it stopped and the Sobol indices can be computed from the samples that are
+already complete, also while the sweep is still running in another process.
+
+Requires SALib (pip install SALib).
+
+Usage:
+
+- sweep = SobolSweep("sobol_congestion", n_samples=500, replicates=20, max_steps=300)
+- sweep.run(n_workers=8)
+- indices = sweep.analyze()
+
+or from the command line:
+    python3 sensitivity.py run sobol_congestion --samples 500 --replicates 20 --steps 300
+    python3 sensitivity.py analyze sobol_congestion
+'''
+
+# the parameters and bounds of Sensitivity_analysis.ipynb
+PROBLEM = {
+    'num_vars': 3,
+    'names': ['max_car_agents', 'tolerance', 'green_light_duration'],
+    'bounds': [[20, 200], [0, 1], [2, 8]]
+}
+
+# CityModel parameters that only take integer values, the samples are truncated
+INTEGER_PARAMETERS = ("max_car_agents", "cars_per_second", "max_velocity", "green_light_duration")
+
+
+def require_salib():
+    if sobol is None:
+        raise ImportError("The Sobol analysis requires SALib, install it with pip install SALib")
+
+
+class SobolSweep:
+    '''
+    Saltelli sampling, parallel evaluation and Sobol analysis of CityModel, stored in a directory.
+
+    Arguments:
+        - directory: directory of the ResultStore with the results and the samples (samples.npy)
+        - problem: SALib problem, with CityModel parameters as names
+        - n_samples: base number of samples N, the sweep evaluates N * (2D + 2) parameter sets (N * (D + 2)
+                     without second order indices) replicates times each
+        - replicates: number of runs per parameter set, the analysis uses the mean over the replicates
+        - max_steps: number of steps of every run
+        - seed: base seed of the runs
+        - second_order: compute second order indices
+        - fixed_parameters: CityModel parameters shared by all runs
+        - common_random_numbers: give replicate i of every parameter set the same seed, see runner.iter_jobs
+
+    Reopening a directory with different arguments raises a ValueError, like ResultStore.
+    '''
+    def __init__(self, directory, problem=PROBLEM, n_samples=500, replicates=20, max_steps=300, seed=1,
+                 second_order=True, fixed_parameters=None, common_random_numbers=False):
+        self.directory = directory
+        self.problem = problem
+        self.replicates = replicates
+        self.max_steps = max_steps
+        self.seed = seed
+        self.second_order = second_order
+        self.fixed_parameters = dict(fixed_parameters or {})
+        self.common_random_numbers = common_random_numbers
+        metadata = dict(problem=problem, n_samples=n_samples, replicates=replicates, max_steps=max_steps,
+                        seed=seed, second_order=second_order, fixed_parameters=self.fixed_parameters,
+                        common_random_numbers=common_random_numbers)
+        self.store = ResultStore(directory, metadata=metadata)
+
+        samples_path = os.path.join(directory, "samples.npy")
+        if os.path.exists(samples_path):
+            self.samples = np.load(samples_path)
+        else:
+            require_salib()
+            self.samples = saltelli.sample(problem, n_samples, calc_second_order=second_order)
+            np.save(samples_path, self.samples)
+
+    @classmethod
+    def open(cls, directory):
+        """
+        Opens an existing sweep with its stored arguments.
+        """
+        return cls(directory, **ResultStore(directory).metadata)
+
+    @property
+    def block_size(self):
+        """
+        Number of parameter sets per base sample.
+        """
+        dimensions = self.problem['num_vars']
+        return 2 * dimensions + 2 if self.second_order else dimensions + 2
+
+    def parameter_sets(self):
+        """
+        Converts the samples into CityModel parameter dictionaries.
+        """
+        parameter_sets = []
+        for values in self.samples:
+            parameters = dict(self.fixed_parameters)
+            for name, value in zip(self.problem['names'], values):
+                parameters[name] = int(value) if name in INTEGER_PARAMETERS else float(value)
+            parameter_sets.append(parameters)
+        return parameter_sets
+
+    def __len__(self):
+        """
+        Number of runs of the sweep.
+        """
+        return len(self.samples) * self.replicates
+
+    def completed(self):
+        """
+        Number of runs written to disk.
+        """
+        return len(self.store)
+
+    def run(self, n_workers=None, chunksize=None, batch_size=None, display_progress=True, cache=None):
+        """
+        Runs the remaining runs of the sweep over n_workers processes (see runner.iter_jobs), writing the last value
+        of every reporter of each run to the store. The runs are ordered by sample, so the samples complete one
+        after another. With cache, the runs found in that ResultCache are not simulated again.
+        """
+        with self.store:
+            for result in iter_jobs(self.parameter_sets(), self.replicates, self.max_steps, seed=self.seed,
+                                    n_workers=n_workers, chunksize=chunksize, display_progress=display_progress,
+                                    start=len(self.store), common_random_numbers=self.common_random_numbers,
+                                    batch_size=batch_size, cache=cache):
+                self.store.append({name: series[-1:] for name, series in result.items()})
+
+    def outputs(self, reporter="AverageCongestion"):
+        """
+        Returns the mean over the replicates of the last value of reporter, for the samples whose replicates
+        have all been written, in sample order.
+        """
+        # reading the shards directly leaves the store untouched while another process is still writing to it
+        store = ResultStore(self.directory)
+        chunks = [chunk[:, -1] for chunk in store.chunks(reporter)]
+        values = np.concatenate(chunks) if chunks else np.empty(0)
+        complete = len(values) // self.replicates
+        return values[:complete * self.replicates].reshape(complete, self.replicates).mean(axis=1)
+
+    def analyze(self, reporter="AverageCongestion", **kwargs):
+        """
+        Returns the Sobol indices (SALib ResultDict) of reporter, using the complete blocks of Saltelli samples.
+        While the sweep is running, this gives the indices of a smaller N. Extra arguments go to SALib's
+        sobol.analyze.
+        """
+        require_salib()
+        outputs = self.outputs(reporter)
+        blocks = len(outputs) // self.block_size
+        if blocks == 0:
+            raise ValueError(f"No complete block of {self.block_size} samples in {self.directory} yet")
+        return sobol.analyze(self.problem, outputs[:blocks * self.block_size], calc_second_order=self.second_order,
+                             **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sobol sensitivity analysis of CityModel")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="start or resume a sweep")
+    run_parser.add_argument("directory")
+    run_parser.add_argument("--samples", type=int, default=500)
+    run_parser.add_argument("--replicates", type=int, default=20)
+    run_parser.add_argument("--steps", type=int, default=300)
+    run_parser.add_argument("--seed", type=int, default=1)
+    run_parser.add_argument("--first-order-only", action="store_true", help="skip the second order indices")
+    run_parser.add_argument("--common-random-numbers", action="store_true")
+    run_parser.add_argument("--workers", type=int, default=None)
+    run_parser.add_argument("--batch-size", type=int, default=None)
+    run_parser.add_argument("--cache", default=None, help="directory of a result cache shared between sweeps")
+
+    analyze_parser = commands.add_parser("analyze", help="print the indices of the completed samples")
+    analyze_parser.add_argument("directory")
+    analyze_parser.add_argument("--reporter", default="AverageCongestion")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        sweep = SobolSweep(args.directory, n_samples=args.samples, replicates=args.replicates, max_steps=args.steps,
+                           seed=args.seed, second_order=not args.first_order_only,
+                           common_random_numbers=args.common_random_numbers)
+        sweep.run(n_workers=args.workers, batch_size=args.batch_size, cache=args.cache)
+    else:
+        sweep = SobolSweep.open(args.directory)
+        print(f"{sweep.completed()} of {len(sweep)} runs completed")
+        indices = sweep.analyze(args.reporter)
+        for key in ("S1", "ST"):
+            for name, value, confidence in zip(sweep.problem['names'], indices[key], indices[key + "_conf"]):
+                print(f"{key} {name:>22} {value:7.3f} +- {confidence:.3f}")
+
+
+if __name__ == '__main__':
+    main()
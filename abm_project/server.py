@@ -1,32 +1,45 @@
+import base64
+
 from mesa.visualization.UserParam import UserSettableParameter
-from model import *
-from agent import BuildingAgent, CarAgent, TrafficLightAgent
-from mesa.visualization.modules import CanvasGrid, ChartModule
-from mesa.visualization.ModularVisualization import ModularServer
+from model import CityModel
+from frames import FrameEncoder, ReplayModel
+from mesa.visualization.modules import ChartModule
+from mesa.visualization.ModularVisualization import ModularServer, VisualizationElement
 
 '''
-This script describes the agents visual characteristic used in the browser animation (agent_portrayal) as well
-as initializes the animation (server), creating a grid (grid) and a set of charts tracking model output (chart)
+This script initializes the browser animation (server), creating a grid (grid) and a set of charts tracking model
+output (chart). The colors of the agents are set in FrameCanvasModule.js.
+
+The grid is a FrameCanvas, which only sends the compact frames of frames.py to the browser, instead of a CanvasGrid
+with one portrayal per agent and building. replay_server plays a file recorded with frames.FrameRecorder.
 '''
 
-def agent_portrayal(agent):
-    portrayal = {"Shape": "rect",
-                 "Filled": "true",
-                 "Layer": 0,
-                 "Color": "black",
-                 "w": 0.5,
-                 "h": 0.5,
-                 "r": 3}
-    if isinstance(agent, BuildingAgent):
-        portrayal["Color"] = "darkgrey"
-    if isinstance(agent, TrafficLightAgent):
-        portrayal["Color"] = agent.colors[agent.state]
-        portrayal["Layer"] = 1
-        portrayal["w"] = 0.25
-        portrayal["h"] = 0.25
-    if isinstance(agent, CarAgent) and agent.haste == 1:
-        portrayal["Color"] = "darkorange"
-    return portrayal
+
+class FrameCanvas(VisualizationElement):
+    '''
+    Draws a CityModel or a ReplayModel from binary frames (see frames.py), drawn by FrameCanvasModule.js.
+
+    Arguments:
+        - canvas_width, canvas_height: size of the canvas in pixels
+
+    The static map is only sent with the first frame of every new model, the step frames hold the cars, the traffic
+    lights that switched and the model variables.
+    '''
+    local_includes = ["FrameCanvasModule.js"]
+
+    def __init__(self, canvas_width=600, canvas_height=600):
+        super().__init__()
+        self.js_code = f"elements.push(new FrameCanvasModule({canvas_width}, {canvas_height}));"
+        self.model = None
+        self.source = None
+
+    def render(self, model):
+        static = None
+        if model is not self.model:
+            self.model = model
+            self.source = model if isinstance(model, ReplayModel) else FrameEncoder(model)
+            static = base64.b64encode(self.source.static_frame()).decode()
+        return {"static": static, "frame": base64.b64encode(self.source.frame()).decode()}
 
 
 chart = ChartModule([
@@ -38,7 +51,7 @@ cars_per_second = UserSettableParameter('slider', "Number of new Cars per second
 max_velocity = UserSettableParameter('slider', "Maximum allowed velocity", 5, 1, 10, 1)
 green_light_duration = UserSettableParameter('slider', "Traffic Light green/red duration", 5, 1, 20, 1)
 
-grid = CanvasGrid(agent_portrayal, total_width, total_height, n_roads_horizontal * total_width+1, n_roads_vertical * total_height+1)
+grid = FrameCanvas(600, 600)
 server = ModularServer(CityModel, [grid, chart], "City Model",
                        {  # UI Input params
                            'max_car_agents': max_car_agents,
@@ -46,3 +59,10 @@ server = ModularServer(CityModel, [grid, chart], "City Model",
                            'green_light_duration': green_light_duration,
                            'max_velocity': max_velocity
                         })
+
+
+def replay_server(path):
+    """
+    Returns a server that plays back the frames recorded in path.
+    """
+    return ModularServer(ReplayModel, [FrameCanvas(600, 600), chart], "City Model replay", {'path': path})
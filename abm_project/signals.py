@@ -0,0 +1,181 @@
+import numpy as np
+
+from agent import IntersectionAgent
+
+'''
+This module describes the traffic light controller of CityModel:
+
+- SignalPlan
+- green_wave_offsets: offsets that make the intersections switch one after another along the roads
+
+The traffic lights of an intersection follow a fixed cycle (green, yellow, red), so their states at step t follow
+from t, the durations and the offset of the intersection. Instead of stepping every IntersectionAgent each tick, the
+plan keeps the next switch of every group of intersections with the same timing in a timing wheel and only updates
+the groups that switch.
+'''
+
+
+class SignalPlan:
+    '''
+    Traffic light states of a set of intersections, updated at their switch events.
+
+    Arguments:
+        - road_grid: RoadGrid the states are written to
+        - light_cells: (intersections, lights) array with the road cell of every traffic light
+        - initial_states: states of the traffic lights at step 0 without offset, 0 (green) or 2 (red)
+        - green_duration: steps a light stays green (>= 1), one value or one per intersection
+        - yellow_duration: steps a light stays yellow
+        - offsets: steps every intersection is ahead in its cycle, one value or one per intersection (>= 0)
+        - traffic_lights: optional list with the TrafficLightAgents of every intersection, their state is kept
+                          up to date for the visualisation
+
+    Without offsets, the states after t steps are the ones of IntersectionAgents stepped t times: the counter of an
+    intersection goes 0, 1, ..., green + yellow and then cycles through 1, ..., green + yellow, the green lights turn
+    yellow when it reaches green and all lights switch (yellow to red, red to green) when it reaches green + yellow.
+    '''
+    def __init__(self, road_grid, light_cells, initial_states, green_duration, yellow_duration=2, offsets=0,
+                 traffic_lights=None):
+        self.road_grid = road_grid
+        self.light_cells = np.asarray(light_cells)
+        n_intersections = len(self.light_cells)
+        self.initial_states = np.broadcast_to(initial_states, self.light_cells.shape)
+        self.green_duration = np.broadcast_to(np.asarray(green_duration, dtype=np.int64), (n_intersections,))
+        self.yellow_duration = yellow_duration
+        self.period = self.green_duration + yellow_duration
+        self.offsets = np.broadcast_to(np.asarray(offsets, dtype=np.int64), (n_intersections,))
+        if (self.offsets < 0).any():
+            raise ValueError("The offsets of a SignalPlan cannot be negative")
+        if (self.green_duration < 1).any():
+            raise ValueError("The green duration of a SignalPlan has to be at least 1")
+        self.traffic_lights = traffic_lights
+
+        self.create_groups()
+        self.seek(0)
+
+    def create_groups(self):
+        """
+        Groups the intersections with the same green duration and offset, as they always switch together. Every group
+        keeps the cells of its traffic lights and their states over two cycles, the states repeat after that.
+        """
+        members = {}
+        for intersection, key in enumerate(zip(self.green_duration.tolist(), self.offsets.tolist())):
+            members.setdefault(key, []).append(intersection)
+        self.groups = []
+        for (green, offset), intersections in members.items():
+            intersections = np.array(intersections)
+            period = green + self.yellow_duration
+            table = np.stack([self.states_after(np.full(len(intersections), calls), intersections).ravel()
+                              for calls in range(1, 2 * period + 1)])
+            traffic_lights = None
+            if self.traffic_lights is not None:
+                traffic_lights = [traffic_light for intersection in intersections
+                                  for traffic_light in self.traffic_lights[intersection]]
+            self.groups.append((intersections, self.light_cells[intersections].ravel(), table, green, offset,
+                                traffic_lights))
+
+    @staticmethod
+    def light_cells_of(cell_index, intersections):
+        """
+        Returns the (intersections, lights) arrays of road cells and initial states of the traffic lights of the
+        IntersectionAgents at the given positions.
+        """
+        light_cells, initial_states = [], []
+        for intersection_pos in intersections:
+            positions, states = zip(*IntersectionAgent.traffic_light_positions(intersection_pos))
+            light_cells.append([cell_index[pos] for pos in positions])
+            initial_states.append(states)
+        return (np.array(light_cells, dtype=np.int64).reshape(len(light_cells), -1),
+                np.array(initial_states, dtype=np.int64).reshape(len(light_cells), -1))
+
+    @classmethod
+    def from_positions(cls, road_grid, intersections, green_duration, yellow_duration=2, offsets=0,
+                       traffic_lights=None):
+        """
+        Creates the plan of the traffic lights of IntersectionAgents at the given positions.
+        """
+        light_cells, initial_states = cls.light_cells_of(road_grid.cell_index, intersections)
+        return cls(road_grid, light_cells, initial_states, green_duration, yellow_duration=yellow_duration,
+                   offsets=offsets, traffic_lights=traffic_lights)
+
+    def states_at(self, t, intersections):
+        """
+        Returns the (intersections, lights) states of the traffic lights of the given intersections at step t.
+        """
+        return self.states_after(t + self.offsets[intersections], intersections)
+
+    def states_after(self, calls, intersections):
+        """
+        Returns the states of the traffic lights of the given intersections after calls steps of their cycle.
+        """
+        period = self.period[intersections]
+        started = calls >= 1
+        # number of full switches and position in the current cycle, -1 before the first step
+        switches = np.where(started, (calls - 1) // period, 0)
+        position = np.where(started, (calls - 1) % period, -1)
+        green_state = np.where(position >= self.green_duration[intersections], 1, 0)[:, None]
+        swapped = (switches % 2 == 1)[:, None]
+        initially_green = self.initial_states[intersections] == 0
+        return np.where(initially_green, np.where(swapped, 2, green_state), np.where(swapped, green_state, 2))
+
+    def next_switch(self, t, intersections):
+        """
+        Returns the first step after t at which the lights of every given intersection change.
+        """
+        offsets = self.offsets[intersections]
+        period = self.period[intersections]
+        counter = t + offsets - 1
+        # the switches happen when the counter (calls - 1) is congruent to green (to yellow) or to 0 (full switch)
+        to_yellow = counter + 1 + (self.green_duration[intersections] - counter - 1) % period
+        full = counter + 1 + (-counter - 1) % period
+        # the very first call does not switch
+        full = np.where(full < period, full + period, full)
+        switch = np.minimum(to_yellow, full) if self.yellow_duration > 0 else full
+        return switch + 1 - offsets
+
+    def seek(self, t):
+        """
+        Sets the lights to their states at step t and schedules the next switch of every group, used to start the plan
+        and to restore a model from a snapshot.
+        """
+        self.t = t
+        states = self.states_at(t, np.arange(len(self.light_cells)))
+        self.road_grid.set_lights(self.light_cells.ravel(), states.ravel())
+        if self.traffic_lights is not None:
+            for traffic_lights, intersection_states in zip(self.traffic_lights, states.tolist()):
+                for traffic_light, state in zip(traffic_lights, intersection_states):
+                    traffic_light.state = state
+        # step -> list of groups that switch at that step
+        self.wheel = {}
+        for group, switch in enumerate(self.next_switch(t, np.array([group[0][0] for group in self.groups]))):
+            self.wheel.setdefault(int(switch), []).append(group)
+
+    def step(self):
+        """
+        Advances the plan by one step, equivalent to stepping all IntersectionAgents once.
+        Only the groups of intersections that switch at this step are updated.
+        """
+        self.t += 1
+        due = self.wheel.pop(self.t, None)
+        if due is None:
+            return
+        for group in due:
+            _, cells, table, green, offset, traffic_lights = self.groups[group]
+            counter = self.t + offset - 1
+            period = green + self.yellow_duration
+            states = table[counter % (2 * period)]
+            self.road_grid.set_lights(cells, states)
+            if traffic_lights is not None:
+                for traffic_light, state in zip(traffic_lights, states.tolist()):
+                    traffic_light.state = state
+            # the next counter congruent to green (to yellow) or to 0 (full switch)
+            delay = min((green - counter - 1) % period, (-counter - 1) % period) + 1
+            self.wheel.setdefault(self.t + delay, []).append(group)
+
+
+def green_wave_offsets(intersections, velocity):
+    """
+    Returns offsets for the given intersection positions such that a car driving at velocity towards increasing x and
+    y reaches every intersection the same number of steps after it switched.
+    """
+    distance = np.array([x + y for x, y in intersections])
+    return (distance.max() - distance) // velocity
@@ -0,0 +1,189 @@
+import inspect
+import json
+import os
+
+import numpy as np
+
+from agent import CarAgent
+from model import CityModel
+from streams import STREAMS
+
+'''
+This module describes the checkpoints of CityModel:
+
+- Snapshot
+
+A snapshot holds the full dynamic state of a model: the parameters, the counters and running totals, the step of the
+signal plan, the state of every car, the random streams and the collected model variables. It is stored as a
+compressed numpy archive of flat arrays plus a JSON header, without pickling any Mesa object, so it only depends on
+the parameters and not on the engine: a snapshot of a CityModel(engine="mesa") can be continued with the vectorized
+engine and the other way around.
+
+Usage:
+
+- model.run(300); Snapshot.of(model).save("warm.npz"), fills the city once
+- model = Snapshot.load("warm.npz").restore(), continues exactly where the model stopped
+- models = [Snapshot.load("warm.npz").restore(seed=seed) for seed in seeds], forks continuations with their own
+  random streams, runner.run_jobs(..., snapshot="warm.npz") runs them in parallel
+- model.run(100000, checkpoint="run.npz") saves a snapshot every checkpoint_every steps, see CityModel.run
+'''
+
+SNAPSHOT_VERSION = 2
+
+# CityModel arguments that do not change the simulated state, they can be chosen again when restoring
+RUN_ARGUMENTS = ("engine", "districts", "route_cache_dir", "profile", "seed")
+
+# CityModel parameters a continuation can change, they only apply to the cars created after the restore
+FORK_PARAMETERS = ("max_car_agents", "cars_per_second", "max_velocity", "tolerance")
+
+# car state besides the path, in the order of VectorizedEngine.arrays
+CAR_ARRAYS = ("unique_id", "pos_i", "velocity", "max_velocity", "velocity_sum", "max_velocity_sum", "congestion",
+              "haste", "steps", "tolerance")
+
+
+class Snapshot:
+    '''
+    Dynamic state of a CityModel.
+
+    Arguments:
+        - header: dictionary with the parameters, counters and states of the random streams, stored as JSON
+        - arrays: dictionary of numpy arrays with the cars (car_*, the paths as road cell indices in one flat array)
+                  and the collected model variables (collected_*)
+
+    Use Snapshot.of to take a snapshot of a model and Snapshot.load to read one from disk.
+    '''
+    def __init__(self, header, arrays):
+        if header.get("version") != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version {header.get('version')}, expected {SNAPSHOT_VERSION}")
+        self.header = header
+        self.arrays = arrays
+
+    @classmethod
+    def of(cls, model):
+        """
+        Takes a snapshot of model, a CityModel with either engine.
+        """
+        names = [name for name in inspect.signature(CityModel).parameters if name not in RUN_ARGUMENTS]
+        parameters = {name: getattr(model, name, None) for name in names}
+        parameters.update({name: getattr(model.layout, name) for name in names if hasattr(model.layout, name)})
+        if parameters["signal_offsets"] is not None:
+            parameters["signal_offsets"] = np.asarray(parameters["signal_offsets"]).tolist()
+        # numpy scalars, e.g. parameters taken from a sample array, are not JSON serializable
+        parameters = {name: value.item() if isinstance(value, np.generic) else value
+                      for name, value in parameters.items()}
+
+        arrays = cls.car_arrays(model)
+        random_states = {}
+        for name in STREAMS:
+            random_states[name] = model.streams[name].get_state()
+        for name, values in model.datacollector.model_vars.items():
+            arrays["collected_" + name] = np.array(values, dtype=np.float64)
+
+        header = dict(version=SNAPSHOT_VERSION, parameters=parameters,
+                      seed=model.seed if isinstance(model.seed, int) else None,
+                      steps=model.schedule.steps, unique_id=model.unique_id, num_car_agents=model.num_car_agents,
+                      congestion_sum=model.congestion_sum, haste_sum=model.haste_sum, signal_step=model.signal_plan.t,
+                      spawn_waiting=model.spawner.waiting, random=random_states)
+        return cls(header, arrays)
+
+    @staticmethod
+    def car_arrays(model):
+        """
+        Returns the state of the cars of model as arrays, in activation order.
+        """
+        engine = model.car_engine
+        if engine is not None:
+            engine.append_new_cars()
+            arrays = {"car_" + name: getattr(engine, name).copy() for name in CAR_ARRAYS}
+            path_length = engine.path_length
+            paths = engine.path[np.arange(engine.path.shape[1]) < path_length[:, None]]
+        else:
+            cars = list(model.schedule.cars.values())
+            arrays = {"car_" + name: np.array([getattr(car, name) for car in cars],
+                                              dtype=np.float64 if name in ("congestion", "tolerance") else np.int64)
+                      for name in CAR_ARRAYS}
+            path_length = np.array([len(car.path_cells) for car in cars], dtype=np.int64)
+            paths = np.concatenate([car.path_cells for car in cars] + [np.empty(0, dtype=np.int64)])
+        arrays["car_path_length"] = path_length
+        arrays["car_paths"] = paths.astype(np.int32)
+        return arrays
+
+    def save(self, path):
+        """
+        Writes the snapshot to path as a compressed numpy archive. The file is replaced at once, so an interrupted
+        save leaves the previous snapshot intact.
+        """
+        temporary = f"{path}.tmp.npz"
+        np.savez_compressed(temporary, header=np.array(json.dumps(self.header)), **self.arrays)
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as archive:
+            arrays = {name: archive[name] for name in archive.files}
+        return cls(json.loads(str(arrays.pop("header"))), arrays)
+
+    @property
+    def steps(self):
+        return self.header["steps"]
+
+    def restore(self, seed=None, **arguments):
+        """
+        Returns a new CityModel in the state of the snapshot.
+
+        Arguments:
+            - seed: None continues the random streams of the snapshot, giving the same results as the model the
+                    snapshot was taken of; otherwise the streams are started anew from seed, which forks an
+                    independent continuation
+            - arguments: the CityModel arguments that do not change the state (engine, districts, route_cache_dir,
+                         profile) and new values of FORK_PARAMETERS, the cars of the snapshot keep their own
+        """
+        unknown = set(arguments) - set(RUN_ARGUMENTS) - set(FORK_PARAMETERS)
+        if unknown:
+            raise ValueError(f"Arguments {sorted(unknown)} cannot be changed when restoring a snapshot, "
+                             f"expected {RUN_ARGUMENTS + FORK_PARAMETERS}")
+        header, arrays = self.header, self.arrays
+        model = CityModel(seed=header["seed"] if seed is None else seed, **dict(header["parameters"], **arguments))
+
+        model.schedule.steps = model.schedule.time = header["steps"]
+        model.signal_plan.seek(header["signal_step"])
+        self.restore_cars(model)
+        model.unique_id = header["unique_id"]
+        model.num_car_agents = header["num_car_agents"]
+        model.congestion_sum = header["congestion_sum"]
+        model.haste_sum = header["haste_sum"]
+        model.spawner.waiting = min(header["spawn_waiting"], model.spawner.max_waiting)
+        if seed is None:
+            for name in STREAMS:
+                model.streams[name].set_state(header["random"][name])
+        for name, values in model.datacollector.model_vars.items():
+            values.extend(arrays["collected_" + name].tolist())
+        return model
+
+    def restore_cars(self, model):
+        arrays = {name[len("car_"):]: values for name, values in self.arrays.items() if name.startswith("car_")}
+        path_length = arrays["path_length"]
+        paths = np.split(arrays["paths"].astype(np.int64), np.cumsum(path_length)[:-1]) if len(path_length) else []
+        road_grid = model.road_grid
+        road_grid.place_cars(np.array([cells[pos_i] for cells, pos_i in zip(paths, arrays["pos_i"])], dtype=np.int64),
+                             arrays["unique_id"])
+
+        engine = model.car_engine
+        if engine is not None:
+            for name in CAR_ARRAYS:
+                setattr(engine, name, arrays[name].astype(getattr(engine, name).dtype))
+            engine.path_length = path_length.astype(np.int64)
+            engine.path = np.full((len(path_length), max(path_length.max(initial=0), 1)), -1, dtype=np.int64)
+            for car, cells in enumerate(paths):
+                engine.path[car, :len(cells)] = cells
+            return
+
+        road_cells = road_grid.road_cells
+        for car, cells in enumerate(paths):
+            agent = CarAgent(model=model, unique_id=int(arrays["unique_id"][car]),
+                             path=[road_cells[cell] for cell in cells.tolist()],
+                             max_velocity=int(arrays["max_velocity"][car]), tolerance=float(arrays["tolerance"][car]))
+            for name in CAR_ARRAYS:
+                setattr(agent, name, arrays[name][car].item())
+            agent.pos = agent.path[agent.pos_i]
+            model.schedule.add(agent)
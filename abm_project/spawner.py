@@ -0,0 +1,103 @@
+import numpy as np
+
+'''
+This module describes how new cars enter the city:
+
+- Spawner
+
+Every step a CityModel asks for cars_per_second new cars. Instead of picking entry points at random until a free
+one comes up, the spawner looks up which entry cells are free in the RoadGrid, which the cars keep up to date as
+they move, and draws the origins of all cars of the step among them at once. The destinations are drawn from a
+table of the valid exits of every entry, computed once. Cars that find no free entry, or no room below
+max_car_agents, wait for a later step, so a step never spins on a blocked city and its spawning cost is bounded by
+the number of cars. At most max_waiting cars wait, the demand above that is dropped and counted in dropped.
+'''
+
+
+class Spawner:
+    '''
+    Origins, destinations and paths of the new cars of one city.
+
+    Arguments:
+        - layout: CityLayout of the city
+        - road_grid: RoadGrid the cars are placed in
+        - spawn_random: RandomStream of the origins and destinations
+        - route_random: RandomStream of the paths, see RouteTable.random_nodes
+        - max_waiting: largest number of cars waiting to enter, the demand of further steps is dropped
+        - offset: index of the first road cell of the city in road_grid (its copy in a BatchCityModel)
+
+    A destination is valid for an entry if it is at least one road width away and reachable, every valid
+    destination being equally likely, as when drawing exit points until a valid one comes up. The origins of the
+    cars of a step are distinct free entries, each equally likely.
+    '''
+    def __init__(self, layout, road_grid, spawn_random, route_random, max_waiting, offset=0):
+        self.road_grid = road_grid
+        self.routes = layout.routes
+        self.spawn_random = spawn_random
+        self.route_random = route_random
+        self.max_waiting = max_waiting
+        self.offset = offset
+        self.waiting = 0
+        # cars of the demand of the last call to spawn that were dropped as max_waiting cars were already waiting
+        self.dropped = 0
+
+        self.entry_points = list(layout.starting_points)
+        self.end_points = list(layout.end_points)
+        self.entry_cells = layout.cell_index[tuple(np.array(self.entry_points).T)] + offset
+        self.node_cells = layout.cell_index[tuple(np.array(self.routes.nodes).T)] + offset
+
+        # (entries, exits) table of the valid destinations of every entry, padded with -1
+        entries, exits = np.array(self.entry_points), np.array(self.end_points)
+        distance = np.sqrt(((entries[:, None, :] - exits[None, :, :]) ** 2).sum(axis=2))
+        entry_nodes = [self.routes.node_index[point] for point in self.entry_points]
+        reachable = self.routes.distance[:, entry_nodes].T != -1
+        valid = (distance >= layout.road_width) & reachable
+        self.exit_count = valid.sum(axis=1)
+        self.exits = np.full((len(entries), max(self.exit_count.max(initial=0), 1)), -1, dtype=np.int64)
+        for entry, exit_row in enumerate(valid):
+            self.exits[entry, :self.exit_count[entry]] = np.flatnonzero(exit_row)
+        self.has_exits = self.exit_count > 0
+
+    def free_entries(self):
+        """
+        Returns the entries (indices in entry_points) whose cell is free and that have a valid destination.
+        """
+        return np.flatnonzero(~self.road_grid.blocked[self.entry_cells] & self.has_exits)
+
+    def can_spawn(self, demand, capacity):
+        """
+        Returns True if spawn(demand, capacity) would let a car enter, without drawing any random number.
+        """
+        return min(self.waiting + demand, self.max_waiting) > 0 and capacity > 0 and len(self.free_entries()) > 0
+
+    def spawn(self, demand, capacity):
+        """
+        Adds demand cars to the waiting ones and returns the paths, as arrays of road cells, of the cars that can
+        enter now: at most one per free entry and at most capacity, the room left in the grid. The other cars keep
+        waiting, up to max_waiting of them.
+        """
+        waiting = self.waiting + demand
+        self.waiting = min(waiting, self.max_waiting)
+        self.dropped = waiting - self.waiting
+        if not self.waiting or capacity <= 0:
+            return []
+        free = self.free_entries().tolist()
+        n = min(self.waiting, len(free), capacity)
+        if not n:
+            return []
+        self.waiting -= n
+
+        # the first n entries of a random permutation of the free ones
+        draws = self.spawn_random.uniform(2 * n).tolist()
+        for i in range(n):
+            j = i + int(draws[i] * (len(free) - i))
+            free[i], free[j] = free[j], free[i]
+        origins = np.array(free[:n], dtype=np.int64)
+        destinations = self.exits[origins, (np.array(draws[n:]) * self.exit_count[origins]).astype(np.int64)]
+
+        paths = []
+        for origin, destination in zip(origins.tolist(), destinations.tolist()):
+            nodes = self.routes.random_nodes(self.entry_points[origin], self.end_points[destination],
+                                             rng=self.route_random)
+            paths.append(self.node_cells[nodes])
+        return paths
@@ -0,0 +1,177 @@
+import json
+import os
+
+import numpy as np
+
+'''
+This module describes the on-disk store experiment results are streamed into:
+
+- ResultStore
+
+A store is a directory with a meta.json file (experiment parameters and the list of shards) and, for
+every collected series, .npy shards holding one row per run. Runs are buffered in memory and written as
+a new shard every chunk_size runs, so a crash only loses the runs of the current chunk. Re-opening the
+directory continues where it stopped and all shards can be read back memory-mapped.
+
+Usage:
+
+- store = ResultStore("data_experiment", metadata={"max_car_agents": 150, "tolerance": 0.2})
+- store.append({"AverageCongestion": series}); store.close()
+- store.extend({"AverageCongestion": runs}), adds a (runs, steps) array at once
+- congestion = ResultStore("data_experiment").array("AverageCongestion"), reads the shards without changing them
+- store.consolidate(), merges the shards into one, which array then memory-maps
+'''
+
+
+class ResultStore:
+    '''
+    Appendable, chunked store of equally long result series.
+
+    Arguments:
+        - path: directory of the store, created if it does not exist
+        - metadata: JSON serializable parameters of the experiment, when the store already exists they
+          have to be equal to the stored ones (resuming a different experiment is an error)
+        - chunk_size: number of runs written per shard
+    '''
+    def __init__(self, path, metadata=None, chunk_size=100):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.buffer = []
+
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                self.meta = json.load(f)
+            if metadata is not None and self.meta["metadata"] != json.loads(json.dumps(metadata)):
+                raise ValueError(f"{path} holds results of an experiment with different parameters")
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.meta = {"metadata": metadata or {}, "series": None, "shards": []}
+            self.write_meta()
+
+    @property
+    def metadata(self):
+        return self.meta["metadata"]
+
+    @property
+    def series(self):
+        return list(self.meta["series"] or [])
+
+    def __len__(self):
+        """
+        Number of runs written to disk.
+        """
+        return sum(shard["runs"] for shard in self.meta["shards"])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write_meta(self):
+        # write and rename so the shard list on disk is never half written
+        tmp_path = os.path.join(self.path, "meta.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.meta, f, indent=1)
+        os.replace(tmp_path, os.path.join(self.path, "meta.json"))
+
+    def append(self, result):
+        """
+        Adds one run, a dictionary of series name to 1D array.
+        """
+        if self.meta["series"] is None:
+            self.meta["series"] = {name: len(values) for name, values in result.items()}
+        elif set(result) != set(self.meta["series"]):
+            raise ValueError(f"Expected series {sorted(self.meta['series'])}, got {sorted(result)}")
+        self.buffer.append(result)
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def extend(self, results):
+        """
+        Adds several runs at once, a dictionary of series name to (runs, steps) array, written as one shard after
+        the buffered runs.
+        """
+        self.flush()
+        results = {name: np.asarray(rows) for name, rows in results.items()}
+        if self.meta["series"] is None:
+            self.meta["series"] = {name: rows.shape[1] for name, rows in results.items()}
+        elif set(results) != set(self.meta["series"]):
+            raise ValueError(f"Expected series {sorted(self.meta['series'])}, got {sorted(results)}")
+        self.write_shard(results)
+
+    def flush(self):
+        """
+        Writes the buffered runs as a new shard.
+        """
+        if not self.buffer:
+            return
+        self.write_shard({name: np.array([result[name] for result in self.buffer]) for name in self.meta["series"]})
+        self.buffer = []
+
+    def write_shard(self, results):
+        index = self.next_shard_index()
+        for name in self.meta["series"]:
+            tmp_path = os.path.join(self.path, f"{name}.{index:05d}.tmp.npy")
+            np.save(tmp_path, results[name])
+            os.replace(tmp_path, self.shard_path(name, index))
+        self.meta["shards"].append({"index": index, "runs": len(results[name])})
+        self.write_meta()
+
+    def close(self):
+        self.flush()
+
+    def next_shard_index(self):
+        return self.meta["shards"][-1]["index"] + 1 if self.meta["shards"] else 0
+
+    def shard_path(self, name, index):
+        return os.path.join(self.path, f"{name}.{index:05d}.npy")
+
+    def chunks(self, name):
+        """
+        Yields the shards of a series as memory-mapped (runs, steps) arrays, in run order.
+        """
+        for shard in self.meta["shards"]:
+            yield np.load(self.shard_path(name, shard["index"]), mmap_mode="r")
+
+    def consolidate(self):
+        """
+        Merges all shards into a single one per series, copying one shard at a time.
+        """
+        self.flush()
+        if len(self.meta["shards"]) <= 1:
+            return
+        index = self.next_shard_index()
+        for name, steps in self.meta["series"].items():
+            tmp_path = os.path.join(self.path, f"{name}.{index:05d}.tmp.npy")
+            merged = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float64, shape=(len(self), steps))
+            start = 0
+            for chunk in self.chunks(name):
+                merged[start:start + len(chunk)] = chunk
+                start += len(chunk)
+            merged.flush()
+            del merged
+            os.replace(tmp_path, self.shard_path(name, index))
+
+        old_shards = self.meta["shards"]
+        self.meta["shards"] = [{"index": index, "runs": len(self)}]
+        self.write_meta()
+        for shard in old_shards:
+            for name in self.meta["series"]:
+                os.remove(self.shard_path(name, shard["index"]))
+
+    def array(self, name):
+        """
+        Returns all runs of a series, the written ones followed by the buffered ones, as one (runs, steps) array.
+        The store is only read: a store of a single shard without buffered runs gives the memory-mapped shard,
+        otherwise the shards are copied into memory; call consolidate first to merge them on disk.
+        """
+        chunks = list(self.chunks(name))
+        if self.buffer:
+            chunks.append(np.array([result[name] for result in self.buffer]))
+        if len(chunks) == 1:
+            return chunks[0]
+        if not chunks:
+            return np.empty((0, self.meta["series"][name] if self.meta["series"] else 0))
+        return np.concatenate(chunks)
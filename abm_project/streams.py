@@ -0,0 +1,125 @@
+import numpy as np
+
+'''
+This module describes the random number streams of CityModel:
+
+- RandomStream
+- BatchRandomStream: the streams of the cities of a BatchCityModel, drawn from together
+- model_streams: the independent streams of one model, derived from its seed
+
+Every model draws from its own numpy Generators, one per purpose, so a run only depends on its seed and the
+draws of one purpose (e.g. haste) do not shift when another purpose (e.g. spawning) draws more or less often.
+'''
+
+STREAMS = ("spawn", "routing", "haste")
+
+
+class RandomStream:
+    '''
+    Uniform random numbers in [0, 1) from a numpy Generator, generated in batches.
+
+    Arguments:
+        - generator: numpy Generator the numbers are drawn from
+        - buffer_size: number of values generated at once
+
+    Scalar draws (random, choice) and array draws (uniform) consume the same sequence, so drawing n scalars
+    gives the same numbers as one array of size n. random has the interface of random.random, so a stream can be
+    passed to RouteTable.random_path.
+    '''
+    def __init__(self, generator, buffer_size=4096):
+        self.generator = generator
+        self.buffer_size = buffer_size
+        # a list, indexing it is much faster than indexing a numpy array for scalar draws
+        self.buffer = []
+        self.index = 0
+        self.refill_state = self.generator.bit_generator.state
+
+    def refill(self):
+        # the generator state the buffer is generated from, see get_state
+        self.refill_state = self.generator.bit_generator.state
+        self.buffer = self.generator.random(self.buffer_size).tolist()
+        self.index = 0
+
+    def random(self):
+        if self.index == len(self.buffer):
+            self.refill()
+        value = self.buffer[self.index]
+        self.index += 1
+        return value
+
+    def uniform(self, size):
+        """
+        Returns the next size values as an array.
+        """
+        values = self.buffer[self.index:self.index + size]
+        self.index += len(values)
+        while len(values) < size:
+            self.refill()
+            more = self.buffer[:size - len(values)]
+            self.index = len(more)
+            values += more
+        return np.array(values, dtype=np.float64)
+
+    def choice(self, sequence):
+        return sequence[int(self.random() * len(sequence))]
+
+    def get_state(self):
+        """
+        Returns the state of the stream as a dictionary of integers and strings: the state of the generator before the
+        current buffer was generated, the size of the buffer and the position in it, from which set_state continues
+        the exact same sequence.
+        """
+        return dict(generator=self.refill_state, size=len(self.buffer), index=self.index)
+
+    def set_state(self, state):
+        self.generator.bit_generator.state = state["generator"]
+        self.refill_state = state["generator"]
+        self.buffer = self.generator.random(state["size"]).tolist() if state["size"] else []
+        self.index = state["index"]
+
+
+class BatchRandomStream:
+    '''
+    Uniform random numbers in [0, 1) from one numpy Generator per city, generated in batches.
+
+    Arguments:
+        - generators: numpy Generator of every city
+        - buffer_size: number of values generated at once per city, at least the largest number of values
+                       taken from one city at once
+
+    Every city consumes its generator in the same order as a RandomStream of the same generator would.
+    '''
+    def __init__(self, generators, buffer_size=4096):
+        self.generators = list(generators)
+        self.buffer_size = buffer_size
+        self.buffer = np.empty((len(self.generators), buffer_size))
+        # every buffer starts exhausted
+        self.index = np.full(len(self.generators), buffer_size, dtype=np.int64)
+
+    def take(self, cities):
+        """
+        Returns one value per entry of cities (an array of city indices sorted by city), each city taking the
+        next values of its own stream.
+        """
+        counts = np.bincount(cities, minlength=len(self.generators))
+        for city in np.flatnonzero(self.index + counts > self.buffer_size):
+            left = self.buffer[city, self.index[city]:].copy()
+            self.buffer[city, :len(left)] = left
+            self.buffer[city, len(left):] = self.generators[city].random(self.buffer_size - len(left))
+            self.index[city] = 0
+        # position of every entry among the entries of its city
+        first = np.searchsorted(cities, cities)
+        rank = np.arange(len(cities)) - first
+        values = self.buffer[cities, self.index[cities] + rank]
+        self.index += counts
+        return values
+
+
+def model_streams(seed):
+    """
+    Returns a dictionary with one RandomStream per purpose in STREAMS, spawned from seed
+    (an integer or a numpy SeedSequence).
+    """
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    return {name: RandomStream(np.random.default_rng(child)) for name, child in zip(STREAMS, seed.spawn(len(STREAMS)))}
@@ -0,0 +1,255 @@
+import argparse
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+'''
+This module describes the per car output of CityModel, next to the model variables of the DataCollector:
+
+- ColumnBuffer: preallocated typed columns, optionally keeping only the rows of the last blocks (a ring buffer)
+- TrajectoryRecorder: records the position, velocity, congestion and haste of the cars every few steps, and the spawn
+  and exit step of every trip
+- load_trajectories: reads an exported file back as DataFrames
+
+Mesa's agent reporters build a dictionary per car and step. The recorder copies the arrays of the cars into
+preallocated columns instead, only every `every` steps and for a fixed part of the cars, chosen by a hash of their
+unique_id so a sampled car is followed over its whole trip. With last_steps, only the rows of the last recorded steps
+are kept, in a buffer that stops growing once it holds them, so the recorder can run along arbitrarily long runs.
+Trips are recorded when a car leaves the grid, whatever the sampling interval, so travel times are exact.
+
+Usage:
+
+- model = CityModel(...); recorder = TrajectoryRecorder(model, every=5, fraction=0.1)
+- model.run(2000), both engines record after every step
+- recorder.save("run.trajectories.npz"), or recorder.get_dataframes() for the positions and the trips
+- positions, trips = load_trajectories("run.trajectories.npz"); (trips.exit_step - trips.spawn_step).mean()
+'''
+
+# columns of the recorded positions, one row per sampled car and recorded step
+POSITION_COLUMNS = (("step", np.int32), ("unique_id", np.int64), ("pos_i", np.int32), ("cell", np.int32),
+                    ("velocity", np.int16), ("congestion", np.float32), ("haste", np.int8))
+
+# columns of the trips, one row per sampled car, exit_step is -1 for the cars still in the grid
+TRIP_COLUMNS = (("unique_id", np.int64), ("spawn_step", np.int32), ("exit_step", np.int32))
+
+# Knuth's multiplicative hash, spreads consecutive unique_ids evenly over [0, 2**32)
+HASH_MULTIPLIER = 2654435761
+
+
+class ColumnBuffer:
+    '''
+    Typed columns filled block by block.
+
+    Arguments:
+        - columns: (name, dtype) pairs
+        - capacity: number of rows allocated at first, the columns double in size when full
+        - last_blocks: None keeps every row, otherwise only the rows of the last last_blocks blocks are kept and the
+                       rows of older blocks are overwritten
+    '''
+    def __init__(self, columns, capacity, last_blocks=None):
+        self.capacity = max(int(capacity), 1)
+        self.columns = {name: np.empty(self.capacity, dtype=dtype) for name, dtype in columns}
+        self.last_blocks = last_blocks
+        self.blocks = deque()
+        self.start = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, block):
+        """
+        Appends a block, a dictionary with an array (or scalar) per column, all arrays having the same length.
+        """
+        n = max((len(values) for values in block.values() if np.ndim(values)), default=1)
+        if self.last_blocks is not None:
+            self.blocks.append(n)
+            while len(self.blocks) > self.last_blocks:
+                dropped = self.blocks.popleft()
+                self.start = (self.start + dropped) % self.capacity
+                self.size -= dropped
+        if self.size + n > self.capacity:
+            self.grow(max(2 * self.capacity, self.size + n))
+
+        end = (self.start + self.size) % self.capacity
+        first = min(n, self.capacity - end)
+        for name, column in self.columns.items():
+            values = np.broadcast_to(block[name], n)
+            column[end:end + first] = values[:first]
+            column[:n - first] = values[first:]
+        self.size += n
+
+    def grow(self, capacity):
+        for name, column in self.columns.items():
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[:self.size] = self.ordered(column)
+            self.columns[name] = grown
+        self.capacity = capacity
+        self.start = 0
+
+    def ordered(self, column):
+        end = self.start + self.size
+        if end <= self.capacity:
+            return column[self.start:end]
+        return np.concatenate([column[self.start:], column[:end - self.capacity]])
+
+    def arrays(self):
+        """
+        Returns a copy of the rows held, oldest first, as a dictionary of arrays.
+        """
+        return {name: self.ordered(column).copy() for name, column in self.columns.items()}
+
+
+class TrajectoryRecorder:
+    '''
+    Records the cars of a CityModel (either engine), it attaches itself to the model and records after every step.
+
+    Arguments:
+        - model: the CityModel to record
+        - every: positions are recorded every `every` steps
+        - fraction: part of the cars recorded, the same cars for the positions and the trips
+        - last_steps: None keeps the positions of the whole run, otherwise only those of the last last_steps recorded
+                      steps; the trips are always kept
+        - capacity: rows allocated for the positions at first, by default enough for last_steps (or 100) recorded
+                    steps with fraction * max_car_agents cars
+
+    The step of a row is model.schedule.steps after the step. A car spawned in step spawn_step leaves the grid in
+    step exit_step, after exit_step - spawn_step updates; cars already in the grid when the recorder was attached
+    get their spawn step from the number of steps they have been driving.
+    '''
+    def __init__(self, model, every=1, fraction=1.0, last_steps=None, capacity=None):
+        if every < 1:
+            raise ValueError("every must be at least 1")
+        if not 0 <= fraction <= 1:
+            raise ValueError("fraction must be between 0 and 1")
+        self.model = model
+        self.every = every
+        self.fraction = fraction
+        self.threshold = int(round(fraction * 2 ** 32))
+        if capacity is None:
+            capacity = int(np.ceil(fraction * model.max_car_agents)) * (last_steps or 100)
+        self.positions = ColumnBuffer(POSITION_COLUMNS, capacity, last_blocks=last_steps)
+        self.trips = ColumnBuffer(TRIP_COLUMNS, np.ceil(fraction * model.max_car_agents))
+        model.trajectories = self
+        self.record()
+
+    def sampled(self, unique_id):
+        """
+        Returns the mask of the recorded cars among unique_id.
+        """
+        if self.threshold >= 2 ** 32:
+            return np.ones(len(unique_id), dtype=bool)
+        return (unique_id.astype(np.uint64) * np.uint64(HASH_MULTIPLIER)) % np.uint64(2 ** 32) < self.threshold
+
+    def record(self):
+        """
+        Records the positions of the sampled cars if the current step is a recorded one, called by CityModel.step.
+        """
+        step = self.model.schedule.steps
+        if step % self.every:
+            return
+        columns = self.car_columns()
+        sampled = self.sampled(columns["unique_id"])
+        self.positions.append(dict({name: values[sampled] for name, values in columns.items()}, step=step))
+
+    def car_columns(self):
+        """
+        Returns the unique_id, pos_i, cell, velocity, congestion, haste and steps of all cars, in activation order.
+        """
+        model = self.model
+        engine = model.car_engine
+        if engine is not None:
+            engine.append_new_cars()
+            columns = {name: getattr(engine, name) for name in ("unique_id", "pos_i", "velocity", "congestion",
+                                                                 "haste", "steps")}
+            columns["cell"] = engine.path[np.arange(len(engine.unique_id)), engine.pos_i]
+            return columns
+        cars = list(model.schedule.cars.values())
+        columns = {name: np.array([getattr(car, name) for car in cars],
+                                  dtype=np.float64 if name == "congestion" else np.int64)
+                   for name in ("unique_id", "pos_i", "velocity", "congestion", "haste", "steps")}
+        columns["cell"] = np.array([car.path_cells[car.pos_i] for car in cars], dtype=np.int64)
+        return columns
+
+    def record_exits(self, unique_id, steps):
+        """
+        Records the trips of the cars unique_id leaving the grid in the current step after steps updates each,
+        called by the engines when they remove cars.
+        """
+        sampled = self.sampled(unique_id)
+        if not sampled.any():
+            return
+        # in activation order, the order of the removals depends on the engine
+        order = np.argsort(unique_id[sampled], kind="stable")
+        exit_step = self.model.schedule.steps + 1
+        self.trips.append(dict(unique_id=unique_id[sampled][order], spawn_step=exit_step - steps[sampled][order],
+                               exit_step=exit_step))
+
+    def get_trips(self):
+        """
+        Returns the trips of the sampled cars as a dictionary of arrays: the finished ones in the order they left the
+        grid, followed by the cars still in the grid (exit_step -1).
+        """
+        trips = self.trips.arrays()
+        columns = self.car_columns()
+        sampled = self.sampled(columns["unique_id"])
+        unique_id = columns["unique_id"][sampled]
+        driving = dict(unique_id=unique_id, spawn_step=self.model.schedule.steps - columns["steps"][sampled],
+                       exit_step=np.full(len(unique_id), -1))
+        return {name: np.concatenate([trips[name], driving[name].astype(dtype)]) for name, dtype in TRIP_COLUMNS}
+
+    def get_dataframes(self):
+        """
+        Returns the positions and the trips as DataFrames.
+        """
+        return pd.DataFrame(self.positions.arrays()), pd.DataFrame(self.get_trips())
+
+    def save(self, path):
+        """
+        Writes the positions and the trips to path, one array per column: a numpy archive (position_<column> and
+        trip_<column>), or two CSV files if path ends with .csv (<path> for the positions and <path stem>.trips.csv).
+        """
+        positions, trips = self.positions.arrays(), self.get_trips()
+        if str(path).endswith(".csv"):
+            pd.DataFrame(positions).to_csv(path, index=False)
+            pd.DataFrame(trips).to_csv(str(path)[:-len(".csv")] + ".trips.csv", index=False)
+            return
+        np.savez(path, **{"position_" + name: values for name, values in positions.items()},
+                 **{"trip_" + name: values for name, values in trips.items()})
+
+    def close(self):
+        """
+        Stops recording, the recorded rows stay available.
+        """
+        if self.model.trajectories is self:
+            self.model.trajectories = None
+
+
+def load_trajectories(path):
+    """
+    Reads a numpy archive written by TrajectoryRecorder.save, returns the positions and the trips as DataFrames.
+    """
+    with np.load(path, allow_pickle=False) as archive:
+        positions = {name[len("position_"):]: archive[name] for name in archive.files if name.startswith("position_")}
+        trips = {name[len("trip_"):]: archive[name] for name in archive.files if name.startswith("trip_")}
+    return pd.DataFrame(positions), pd.DataFrame(trips)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarise the trips of a recorded trajectory file")
+    parser.add_argument("path")
+    args = parser.parse_args()
+
+    positions, trips = load_trajectories(args.path)
+    finished = trips[trips.exit_step >= 0]
+    travel_time = finished.exit_step - finished.spawn_step
+    print(f"{len(positions)} positions of {positions.unique_id.nunique()} cars in "
+          f"{positions.step.nunique()} steps")
+    print(f"{len(finished)} finished trips, travel time mean {travel_time.mean():.2f} "
+          f"std {travel_time.std():.2f} max {travel_time.max()}")
+    print(f"{len(trips) - len(finished)} cars still driving")
+
+
+if __name__ == '__main__':
+    main()
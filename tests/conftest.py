@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the simulation modules import each other as top level modules, as when running the scripts in abm_project
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "abm_project"))
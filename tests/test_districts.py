@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from districts import DistrictEngine, partition_districts
+from layout import CityLayout
+from model import CityModel
+from snapshot import Snapshot
+
+'''
+DistrictEngine must move the cars exactly as the single process engine: the deferral of the boundary cars and the
+claims of kernels.mark_boundary and kernels.move_district keep the activation order of every pair of interacting cars.
+'''
+
+UNEVEN_CITY = dict(n_roads_horizontal=6, n_roads_vertical=5, building_width=8, building_height=6)
+
+
+def assert_same_step(reference, model):
+    np.testing.assert_array_equal(model.car_engine.unique_id, reference.car_engine.unique_id)
+    expected, actual = reference.get_car_state(), model.get_car_state()
+    for name in expected:
+        np.testing.assert_array_equal(actual[name], expected[name], err_msg=name)
+    assert (model.congestion_sum, model.haste_sum, model.num_car_agents) == \
+        (reference.congestion_sum, reference.haste_sum, reference.num_car_agents)
+
+
+def assert_same_run(reference, model, steps):
+    try:
+        for _ in range(steps):
+            reference.step()
+            model.step()
+            assert_same_step(reference, model)
+    finally:
+        model.car_engine.close()
+    assert model.datacollector.model_vars == reference.datacollector.model_vars
+
+
+@pytest.mark.parametrize("districts, parameters", [
+    ((1, 1), dict(max_car_agents=200, cars_per_second=5)),
+    ((2, 2), dict(max_car_agents=300, cars_per_second=5)),
+    ((2, 2), dict(max_car_agents=1000, cars_per_second=20, tolerance=0.3)),
+    ((3, 2), dict(UNEVEN_CITY, max_car_agents=600, cars_per_second=10, max_velocity=7)),
+    ((4, 1), dict(max_car_agents=400, cars_per_second=8)),
+    ((4, 4), dict(max_car_agents=400, cars_per_second=8)),
+])
+def test_districts_match_compiled_engine(districts, parameters):
+    assert_same_run(CityModel(seed=7, engine="compiled", **parameters),
+                    CityModel(seed=7, engine="districts", districts=districts, **parameters), steps=300)
+
+
+def test_restored_snapshot_grows_the_shared_arrays():
+    model = CityModel(seed=3, engine="vectorized", max_car_agents=500, cars_per_second=10)
+    model.run(200)
+    snapshot = Snapshot.of(model)
+    # the snapshot holds more cars than the capacity planned for max_car_agents=100
+    restored = snapshot.restore(engine="districts", max_car_agents=100)
+    assert_same_run(snapshot.restore(engine="compiled", max_car_agents=100), restored, steps=200)
+
+
+def test_full_city_keeps_the_workers(monkeypatch):
+    # the shared arrays have room for max_car_agents + cars_per_second cars, which a full city never exceeds
+    starts = []
+    start_workers = DistrictEngine.start_workers
+    monkeypatch.setattr(DistrictEngine, "start_workers", lambda engine: starts.append(start_workers(engine)))
+    parameters = dict(max_car_agents=150, cars_per_second=20)
+    model = CityModel(seed=5, engine="districts", **parameters)
+    capacity = model.car_engine.capacity
+    assert_same_run(CityModel(seed=5, engine="compiled", **parameters), model, steps=500)
+    assert model.num_car_agents == parameters["max_car_agents"]
+    assert len(starts) == 1
+    assert model.car_engine.capacity == capacity
+
+
+def test_partition_covers_all_districts():
+    layout = CityLayout(**UNEVEN_CITY, road_width=2)
+    district = partition_districts(layout, 3, 2)
+    assert len(district) == len(layout.road_cells)
+    assert set(district.tolist()) == set(range(6))
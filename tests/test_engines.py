@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+import kernels
+from model import CityModel
+
+'''
+The car engines must give the same results as stepping every CarAgent: the same cars in the same state after every
+step and the same collected model variables.
+'''
+
+STEPS = 200
+
+PARAMETER_SETS = [dict(max_car_agents=100),
+                  dict(max_car_agents=400, tolerance=0.5, green_light_duration=3, cars_per_second=10),
+                  dict(max_car_agents=60, max_velocity=8, tolerance=0.7)]
+
+
+def assert_same_cars(expected, actual):
+    assert expected.keys() == actual.keys()
+    for name in expected:
+        np.testing.assert_array_equal(expected[name], actual[name], err_msg=name)
+
+
+def assert_same_results(reference, model):
+    """
+    Steps both models and compares their cars after every step and their collected model variables at the end.
+    """
+    for _ in range(STEPS):
+        reference.step()
+        model.step()
+        assert_same_cars(reference.get_car_state(), model.get_car_state())
+
+    assert model.num_car_agents == reference.num_car_agents
+    collected = model.datacollector.model_vars
+    np.testing.assert_array_equal(collected["HastePercent"], reference.datacollector.model_vars["HastePercent"])
+    # the running congestion total is summed in another order, which only changes the last bits
+    np.testing.assert_allclose(collected["AverageCongestion"], reference.datacollector.model_vars["AverageCongestion"],
+                               rtol=1e-10)
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+@pytest.mark.parametrize("parameters", PARAMETER_SETS)
+def test_vectorized_engine_matches_mesa(parameters, seed):
+    assert_same_results(CityModel(seed=seed, engine="mesa", **parameters),
+                        CityModel(seed=seed, engine="vectorized", **parameters))
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+@pytest.mark.parametrize("parameters", PARAMETER_SETS)
+def test_compiled_engine_matches_mesa(parameters, seed):
+    # without Numba the compiled engine is the vectorized one
+    pytest.importorskip("numba")
+    assert_same_results(CityModel(seed=seed, engine="mesa", **parameters),
+                        CityModel(seed=seed, engine="compiled", **parameters))
+
+
+@pytest.mark.parametrize("parameters", PARAMETER_SETS)
+def test_python_kernel_matches_mesa(parameters, monkeypatch):
+    # the plain Python functions behind the Numba kernels, move_cars looks move_car up in the module at every call
+    monkeypatch.setattr(kernels, "move_car", getattr(kernels.move_car, "py_func", kernels.move_car))
+    model = CityModel(seed=1, engine="vectorized", **parameters)
+    model.car_engine.kernel = getattr(kernels.move_cars, "py_func", kernels.move_cars)
+    assert_same_results(CityModel(seed=1, engine="mesa", **parameters), model)
@@ -0,0 +1,14 @@
+from benchmark import HEAVY_MODULES, benchmark_imports
+
+'''
+Worker processes import the simulation core, it must not load plotting, analysis or compiler modules.
+'''
+
+# seconds, generous: about 0.5 s on a laptop, the plotting imports alone took 2.5 s more
+MAX_IMPORT_SECONDS = 5
+
+
+def test_simulation_core_imports_no_heavy_module():
+    timing = benchmark_imports(["model", "runner"])
+    assert not set(timing["loaded"]) & set(HEAVY_MODULES), timing["loaded"]
+    assert timing["seconds"] < MAX_IMPORT_SECONDS
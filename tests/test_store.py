@@ -0,0 +1,23 @@
+import os
+
+import numpy as np
+
+from store import ResultStore
+
+
+def test_array_reads_without_changing_the_shards(tmp_path):
+    store = ResultStore(str(tmp_path), chunk_size=2)
+    runs = [np.arange(5.0) + run for run in range(5)]
+    for run in runs:
+        store.append({"AverageCongestion": run})
+    files = sorted(os.listdir(tmp_path))
+
+    # two shards and a buffered run
+    np.testing.assert_array_equal(store.array("AverageCongestion"), runs)
+    assert sorted(os.listdir(tmp_path)) == files
+
+    store.close()
+    store.consolidate()
+    merged = ResultStore(str(tmp_path)).array("AverageCongestion")
+    assert isinstance(merged, np.memmap)
+    np.testing.assert_array_equal(merged, runs)